@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from starlette.datastructures import Headers, MutableHeaders
+from backend.core.config import settings
+from backend.database import store_document_timings
+from backend.services.tracing import PROFILE_HEADER, TRACE_HEADER, StackSampler, end_trace, profiler, start_trace, trace_id_from
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+async def store_trace(trace):
+    """Saves a finished trace with every document it processed."""
+    if not trace.document_uids:
+        return
+    try:
+        await asyncio.to_thread(store_document_timings, trace.document_uids, trace.to_dict())
+    except Exception as e:
+        logger.error(f"Could not store trace {trace.trace_id}: {e}")
+
+
+class TracingMiddleware:
+    """
+    Runs every HTTP request inside a trace. The trace id is taken from the X-Trace-Id request
+    header (or generated) and echoed in the response. Requests carrying X-Profile with the
+    profiling token, or armed through POST /debug/profile, are also stack-sampled and their
+    profile is linked from the X-Profile-Url response header.
+
+    A plain ASGI middleware, so streamed responses are traced until their last chunk.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        trace, token = start_trace(trace_id_from(headers.get(TRACE_HEADER)), f"{scope['method']} {scope['path']}")
+        sampler = None
+        if profiler.should_profile(scope["path"], headers.get(PROFILE_HEADER)):
+            sampler = StackSampler(trace, settings.PROFILING_INTERVAL_MS)
+            sampler.start()
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                response_headers = MutableHeaders(scope=message)
+                response_headers.append(TRACE_HEADER, trace.trace_id)
+                if sampler is not None:
+                    response_headers.append("X-Profile-Url", f"/debug/profiles/{trace.trace_id}")
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            end_trace(trace, token)
+            if sampler is not None:
+                profiler.store(await asyncio.to_thread(sampler.stop))
+            await store_trace(trace)
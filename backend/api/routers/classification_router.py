@@ -1,45 +1,166 @@
 from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from backend.database import collection
-from backend.services.classification import Classifier
+from backend.core.config import settings
+from backend.services.classification import Classifier, CLASSIFICATION_LABELS, fingerprint_details, load_vendor_names
+from backend.services.invoice_rules import ClassificationDecision, classify_by_rules
+from backend.services.document_session import DocumentConflict, DocumentNotFound, DocumentSession, VERSION_FIELD
+from backend.services.metrics import CACHE_LOOKUPS
+from backend.services.token_accounting import charge_to
+from backend.services.tracing import attach_document
+from pydantic import BaseModel, Field
+from pymongo import UpdateOne
+from typing import Any, Dict, Optional
+import asyncio
+import copy
+import json
+import logging
 
 router = APIRouter(tags=["Classification"])
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 classifier_client = Classifier()
 
+# Number of ambiguous documents sent to the model in one classification request
+MODEL_BATCH_SIZE = 20
+# Query operators that run server-side code or compare fields; not accepted in a batch filter
+FORBIDDEN_FILTER_OPERATORS = {"$where", "$function", "$accumulator", "$expr"}
+
+# Bulk writes still running after their client disconnected
+background_writes: set[asyncio.Task] = set()
+
+
+class BatchClassificationRequest(BaseModel):
+    uids: Optional[list[int]] = None
+    filter: Optional[Dict[str, Any]] = None
+    force: bool = False
+    concurrency: int = Field(default=4, ge=1, le=32)
+
+CLASSIFICATION_PROJECTION = {
+    "file_name": 1,
+    "extracted_details": 1,
+    "classification": 1,
+    "classification_decision": 1,
+    "gl_classification": 1,
+    "classification_fingerprint": 1,
+    "_id": 0
+}
+
+
+def build_classification_content(document_id: int, document: dict, cached: bool) -> dict:
+    content = {
+        "status": "success",
+        "document_id": document_id,
+        "classification": document.get("classification"),
+        "classification_decision": document.get("classification_decision"),
+        "file_name": document.get("file_name"),
+        "extracted_details": document.get("extracted_details"),
+        "cached": cached
+    }
+    if document.get("classification") == 'ap_invoice':
+        content["gl_classification"] = document.get("gl_classification")
+    return content
+
+
 @router.get("/classification/{document_id}")
-async def classify_document(document_id: int):
+async def classify_document(document_id: int, force: bool = False):
+    attach_document(document_id)
     try:
+        session = await asyncio.to_thread(DocumentSession.load, document_id, CLASSIFICATION_PROJECTION)
+        document = session.document
 
-        document_name = collection.find_one({"uid": document_id},{"file_name":1, "extracted_details": 1, "_id": 0 })
-        classification_result = classifier_client.process_classification(document_id)
-        classifier_client.match_vendor_name(document_id)
-        collection.update_one({"uid": document_id}, {"$set":  {"classification": classification_result }})
-        
-        if classification_result == 'ap_invoice':
+        # Reuse the stored result when the extracted details have not changed since it was computed
+        cached = not force and document.get("classification_fingerprint") == fingerprint_details(document.get("extracted_details"))
+        CACHE_LOOKUPS.labels("classification", "hit" if cached else "miss").inc()
+        if cached:
             return JSONResponse(
                 status_code=200,
+                content=build_classification_content(document_id, document, cached=True)
+            )
+
+        with charge_to(document_id):
+            classification_result = await asyncio.to_thread(classifier_client.process_classification, session)
+            await asyncio.to_thread(classifier_client.match_vendor_name, session)
+
+        # Vendor matching rewrites the vendor name, so the fingerprint is taken from the final details
+        session.set("classification", classification_result)
+        if classification_result in CLASSIFICATION_LABELS:
+            session.set("classification_fingerprint", fingerprint_details(session.get("extracted_details")))
+        else:
+            session.unset("classification_fingerprint")
+        await asyncio.to_thread(session.flush)
+
+        return JSONResponse(
+            status_code=200,
+            content=build_classification_content(document_id, document, cached=False)
+        )
+    except DocumentNotFound as e:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+    except DocumentConflict as e:
+        return JSONResponse(
+            status_code=409,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+
+
+@router.post("/classification/batch", summary="Classify many documents", description="Classify the documents given by a list of UIDs or a Mongo query filter, at most CLASSIFICATION_BATCH_MAX_DOCUMENTS of them ($where, $function, $accumulator and $expr are not accepted in the filter). Results stream back as newline-delimited JSON as each document completes and are written to the database in one bulk write.")
+async def classify_documents_batch(request: BatchClassificationRequest):
+    if not request.uids and request.filter is None:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": "Provide either 'uids' or 'filter'."
+            }
+        )
+
+    limit = settings.CLASSIFICATION_BATCH_MAX_DOCUMENTS
+    if request.uids:
+        if len(request.uids) > limit:
+            return JSONResponse(
+                status_code=400,
                 content={
-                    "status": "success",
-                    "document_id": document_id,
-                    "classification": classification_result,
-                    "gl_classification": classifier_client.gl_account_classifier(document_id),
-                    "file_name": document_name["file_name"],
-                    "extracted_details": document_name["extracted_details"]
+                    "status": "error",
+                    "message": f"At most {limit} uids can be classified in one batch."
                 }
             )
-            
-        else:
+        query = {"uid": {"$in": request.uids}}
+    else:
+        forbidden = filter_operators(request.filter) & FORBIDDEN_FILTER_OPERATORS
+        if forbidden:
             return JSONResponse(
-                status_code=200,
+                status_code=400,
                 content={
-                    "status": "success",
-                    "classification": classification_result,
-                    "document_id": document_id,
-                    "file_name": document_name["file_name"],
-                    "extracted_details": document_name["extracted_details"]
+                    "status": "error",
+                    "message": f"Operators not allowed in 'filter': {', '.join(sorted(forbidden))}."
                 }
             )
+        # Only uploaded documents have a uid; the default prompt stored alongside them does not
+        query = {"$and": [{"uid": {"$exists": True}}, request.filter]}
+
+    projection = {**CLASSIFICATION_PROJECTION, "uid": 1}
+    try:
+        # One extra document tells a filter that selects too many apart from one that fits
+        documents = await asyncio.to_thread(lambda: list(collection.find(query, projection).limit(limit + 1)))
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -47,4 +168,180 @@ async def classify_document(document_id: int):
                 "status": "error",
                 "message": str(e)
             }
-        )    
\ No newline at end of file
+        )
+    if len(documents) > limit:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": f"The filter selects more than {limit} documents; narrow it or send the work in several batches."
+            }
+        )
+
+    return StreamingResponse(
+        stream_batch_classification(documents, request),
+        media_type="application/x-ndjson"
+    )
+
+
+def filter_operators(value) -> set:
+    """Every $-operator used anywhere in a query filter."""
+    if isinstance(value, dict):
+        found = {key for key in value if isinstance(key, str) and key.startswith("$")}
+        for item in value.values():
+            found |= filter_operators(item)
+        return found
+    if isinstance(value, list):
+        return set().union(*(filter_operators(item) for item in value))
+    return set()
+
+
+def write_in_background(operations: list):
+    """Runs a bulk write in a worker thread as a task of its own, so cancelling the request does not stop it."""
+    def log_failure(task: asyncio.Task):
+        background_writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Could not store {len(operations)} batch classification results: {task.exception()}")
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # Generator closed outside the event loop; there is no loop to hold up
+        collection.bulk_write(operations, ordered=False)
+        return
+    task = loop.create_task(asyncio.to_thread(collection.bulk_write, operations, ordered=False))
+    background_writes.add(task)
+    task.add_done_callback(log_failure)
+
+
+async def stream_batch_classification(documents: list, request: BatchClassificationRequest):
+    operations = []
+    written = False
+    semaphore = asyncio.Semaphore(request.concurrency)
+
+    def outcome_line(outcome: dict) -> str:
+        return json.dumps(outcome, default=str) + "\n"
+
+    try:
+        if request.uids:
+            found = {document["uid"] for document in documents}
+            for uid in request.uids:
+                if uid not in found:
+                    yield outcome_line({"status": "error", "document_id": uid, "message": "Document not found."})
+
+        pending = {}
+        decisions = {}
+        ambiguous = {}
+        for document in documents:
+            uid = document["uid"]
+            details = document.get("extracted_details")
+            if isinstance(details, str):
+                try:
+                    details = json.loads(details)
+                except json.JSONDecodeError as e:
+                    yield outcome_line({"status": "error", "document_id": uid, "message": f"Invalid JSON format in extracted details ({e})"})
+                    continue
+            if not details or not isinstance(details, dict):
+                yield outcome_line({"status": "error", "document_id": uid, "message": "No extracted details found for this document."})
+                continue
+
+            cached = not request.force and document.get("classification_fingerprint") == fingerprint_details(document.get("extracted_details"))
+            CACHE_LOOKUPS.labels("classification", "hit" if cached else "miss").inc()
+            if cached:
+                content = build_classification_content(uid, document, cached=True)
+                content.pop("extracted_details")
+                yield outcome_line(content)
+                continue
+
+            pending[uid] = details
+            try:
+                decision = classify_by_rules(details)
+            except Exception as e:
+                logger.error(f"Error during rule-based classification for document ID {uid}: {e}")
+                decision = None
+            if decision and decision.confidence >= settings.CLASSIFICATION_RULES_MIN_CONFIDENCE:
+                decisions[uid] = decision
+            else:
+                ambiguous[uid] = details
+
+        if not pending:
+            return
+
+        # Documents the rules could not decide are grouped into batched model calls
+        chunks = [list(ambiguous)[i:i + MODEL_BATCH_SIZE] for i in range(0, len(ambiguous), MODEL_BATCH_SIZE)]
+
+        async def classify_chunk(chunk):
+            async with semaphore:
+                return await asyncio.to_thread(classifier_client.classify_invoices_with_model, {uid: ambiguous[uid] for uid in chunk})
+
+        for chunk, results in zip(chunks, await asyncio.gather(*(classify_chunk(chunk) for chunk in chunks))):
+            for uid in chunk:
+                decisions[uid] = results.get(uid) or ClassificationDecision(label="Classification failed: no label returned", decided_by="llm")
+
+        vendor_names = await asyncio.to_thread(load_vendor_names)
+
+        async def finish_document(uid: int, details: dict, decision: ClassificationDecision) -> dict:
+            async with semaphore:
+                vendor_name = details.get("vendor_details", {}).get("name")
+                steps = [asyncio.to_thread(classifier_client.find_best_vendor_match, vendor_name, vendor_names)]
+                if decision.label == 'ap_invoice':
+                    steps.append(asyncio.to_thread(classifier_client.classify_gl_items, details))
+                results = await asyncio.gather(*steps, return_exceptions=True)
+
+            update = {"$set": {"classification": decision.label, "classification_decision": decision.model_dump()}, "$unset": {}}
+            outcome = {
+                "status": "success",
+                "document_id": uid,
+                "classification": decision.label,
+                "classification_decision": decision.model_dump(),
+                "cached": False
+            }
+
+            final_details = details
+            vendor_match = results[0]
+            if isinstance(vendor_match, Exception):
+                logger.error(f"Vendor name matching failed for document ID {uid}: {vendor_match}")
+            elif vendor_match:
+                final_details = copy.deepcopy(details)
+                final_details.setdefault("vendor_details", {})["name"] = vendor_match[0]
+                update["$set"]["extracted_details.vendor_details.name"] = vendor_match[0]
+                outcome["vendor_name"] = vendor_match[0]
+
+            if decision.label == 'ap_invoice':
+                gl_classified = results[1]
+                if isinstance(gl_classified, Exception):
+                    logger.error(f"G/L classification failed for document ID {uid}: {gl_classified}")
+                    gl_classified = f"An internal error occurred: {str(gl_classified)}"
+                update["$set"]["gl_classification"] = gl_classified
+                outcome["gl_classification"] = gl_classified
+            else:
+                update["$unset"]["gl_classification"] = ""
+
+            if decision.label in CLASSIFICATION_LABELS:
+                update["$set"]["classification_fingerprint"] = fingerprint_details(final_details)
+            else:
+                update["$unset"]["classification_fingerprint"] = ""
+
+            if not update["$unset"]:
+                del update["$unset"]
+            # Bump the version so open document sessions see this write as a conflict
+            update["$inc"] = {VERSION_FIELD: 1}
+            operations.append(UpdateOne({"uid": uid}, update))
+            return outcome
+
+        tasks = [asyncio.create_task(finish_document(uid, details, decisions[uid])) for uid, details in pending.items()]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield outcome_line(await task)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if operations:
+            result = await asyncio.to_thread(collection.bulk_write, operations, ordered=False)
+            written = True
+            yield outcome_line({"status": "complete", "documents": len(operations), "modified": result.modified_count})
+    finally:
+        # Keep the work that finished even if the client disconnected mid-stream
+        if operations and not written:
+            write_in_background(operations)
@@ -0,0 +1,51 @@
+from fastapi import APIRouter, Header
+from fastapi.responses import JSONResponse
+import logging
+from backend.services.tracing import profiler
+
+router = APIRouter(prefix="/debug", tags=["Debugging"])
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def forbidden_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=403,
+        content={
+            "status": "error",
+            "message": "Profiling is disabled or the X-Profile token is wrong."
+        }
+    )
+
+
+@router.post("/profile", summary="Profile upcoming requests", description="Arms the sampling profiler for the next `requests` requests whose path starts with `path_prefix`. Requires the profiling token in the X-Profile header. Each profiled response links its profile in X-Profile-Url.")
+async def arm_profiling(requests: int = 1, path_prefix: str = "", x_profile: str = Header(None)):
+    if not profiler.authorized(x_profile):
+        return forbidden_response()
+    profiler.arm(max(0, requests), path_prefix)
+    logger.info(f"Profiling armed for the next {requests} request(s) under '{path_prefix or '/'}'")
+    return JSONResponse(
+        status_code=200,
+        content={
+            "status": "armed",
+            "requests": profiler.armed,
+            "path_prefix": path_prefix
+        }
+    )
+
+
+@router.get("/profiles/{trace_id}", summary="Get a request profile", description="Sampled stacks of one profiled request: top functions by own and total samples, and collapsed stacks for flame graph tools. Requires the profiling token in the X-Profile header.")
+async def get_profile(trace_id: str, x_profile: str = Header(None)):
+    if not profiler.authorized(x_profile):
+        return forbidden_response()
+    profile = profiler.get(trace_id)
+    if profile is None:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "status": "error",
+                "message": f"No profile kept for trace {trace_id}."
+            }
+        )
+    return JSONResponse(status_code=200, content=profile)
@@ -1,15 +1,19 @@
 from fastapi import Request, UploadFile, Form, APIRouter
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
+import asyncio
 import os
 import shutil
-from backend.services.ocr_processor import OCR_Processor
+from backend.services.ocr_processor import OCR_Processor, parse_response_schema
 from datetime import datetime
-from backend.database import collection
+from backend.database import collection, find_original_upload, next_document_uid, store_original_upload
 import logging
 from bson import ObjectId
 import pandas as pd
 import tempfile
 from backend.core.config import settings
+from backend.services.progress import format_sse, progress_broker
+from backend.services.token_accounting import charge_to
+from backend.services.tracing import attach_document, span
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -28,10 +32,20 @@ def format_datetime(dt):
     return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 
-@router.post("/", summary = "Upload and extract text from files", description="Upload up to 5 PDF files and optionally provide a custom prompt for text extraction. The extracted text and structured content will be returned in the response.")
-async def upload_file(request: Request, file_list: list[UploadFile], prompt: str = Form(None)):
+@router.post("/", summary = "Upload and extract text from files", description="Upload up to 5 PDF files and optionally provide a custom prompt for text extraction, with the JSON Schema its answer must follow in response_schema. The extracted text and structured content will be returned in the response.")
+async def upload_file(request: Request, file_list: list[UploadFile], prompt: str = Form(None), response_schema: str = Form(None)):
     try:
         save_as_excel = False
+        try:
+            schema = parse_response_schema(response_schema)
+        except ValueError as e:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "status": "error",
+                    "message": str(e)
+                }
+            )
         # Limit uploads to maximum 5 files
         if len(file_list) > 5:
             logger.error(f"Upload attempt with {len(file_list)} files, exceeding the limit (5).")
@@ -47,29 +61,43 @@ async def upload_file(request: Request, file_list: list[UploadFile], prompt: str
         document_ids = []
         for file in file_list:
             file_path = os.path.join(UPLOAD_DIR, file.filename)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            with span("upload.write", file_name=file.filename):
+                with open(file_path, "wb") as buffer:
+                    shutil.copyfileobj(file.file, buffer)
             
-            result = ocr_client.process_file(file_path, prompt or "")
-            total_uploads = collection.count_documents({"file_name": {"$exists":True}})
+            uid = next_document_uid()
+            attach_document(uid)
+            with charge_to(uid):
+                result = ocr_client.process_file(file_path, prompt or "", schema)
+
+            # OCR may have read a preflight copy; the upload itself is kept as received
+            original_file_id = None
+            if settings.PDF_KEEP_ORIGINALS:
+                try:
+                    original_file_id = store_original_upload(uid, file_path, file.filename)
+                except Exception as e:
+                    logger.error(f"Could not keep the original upload of document {uid}: {e}")
 
             if prompt:
                 structure = {
                     "file_name": file.filename,
-                    "uid": total_uploads+1,
+                    "uid": uid,
                     "prompt_type": "user_given_prompt",
                     "prompt": prompt,
+                    "response_schema": schema,
                     "raw_text": result.extracted_text,
                     "extracted_details": result.content,
+                    "original_file_id": original_file_id,
                     "uploaded_at": format_datetime(datetime.now())
                 }
             else:
                 structure = {
                     "file_name": file.filename,
-                    "uid": total_uploads+1,
+                    "uid": uid,
                     "prompt_type": "default_prompt",
                     "raw_text": result.extracted_text,
                     "extracted_details": result.content,
+                    "original_file_id": original_file_id,
                     "uploaded_at": format_datetime(datetime.now())
                 }
             inserted_doc = collection.insert_one(structure)
@@ -135,6 +163,84 @@ async def upload_file(request: Request, file_list: list[UploadFile], prompt: str
             }
         )
 
+@router.get("/{uid}/events", summary="Processing progress", description="Server-sent events for a document submitted with POST /pipeline/submit: one event per finished stage (ocr, extract, vendor, classify, items, map, persist, post) with its partial result, then 'done' with the full result or 'error'. Reconnecting with Last-Event-ID resumes after that event.")
+async def stream_progress(uid: int, request: Request):
+    if not progress_broker.has(uid):
+        document = await asyncio.to_thread(collection.find_one, {"uid": uid}, {"_id": 0, "uid": 1, "classification": 1})
+        if not document:
+            return JSONResponse(
+                status_code=404,
+                content={"status": "error", "message": f"No document or running job with ID {uid}."}
+            )
+
+        # Finished before this process started (or long ago); there is nothing left to stream
+        async def finished():
+            yield format_sse({"id": 1, "event": "done", "data": {"document_id": uid, "classification": document.get("classification"), "stored": True}})
+
+        return StreamingResponse(finished(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    try:
+        last_event_id = int(request.headers.get("last-event-id", 0))
+    except ValueError:
+        last_event_id = 0
+
+    async def events():
+        async for message in progress_broker.subscribe(uid, last_event_id):
+            yield format_sse(message)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/{uid}/original", summary="Original upload of a document", description="The PDF exactly as it was uploaded. OCR may have read a smaller preflight copy (downsampled images, no attachments or metadata); the original is kept in GridFS when PDF_KEEP_ORIGINALS is on.")
+async def get_original(uid: int):
+    original = await asyncio.to_thread(find_original_upload, uid)
+    if original is None:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "status": "error",
+                "message": f"No original upload kept for document {uid}."
+            }
+        )
+
+    def chunks():
+        with original:
+            while chunk := original.read(original.chunk_size):
+                yield chunk
+
+    return StreamingResponse(
+        chunks(),
+        media_type=original.content_type or "application/pdf",
+        headers={
+            "Content-Disposition": f'attachment; filename="{original.filename}"',
+            "Content-Length": str(original.length)
+        }
+    )
+
+
+@router.get("/{uid}/timings", summary="Request traces of a document", description="Span trees of the most recent requests that processed this document (upload, OCR, model calls, JSON parsing, Mongo, fuzzy matching, SAP), oldest first. Each carries the trace id that was returned in the X-Trace-Id response header.")
+async def get_timings(uid: int):
+    document = await asyncio.to_thread(collection.find_one, {"uid": uid}, {"_id": 0, "uid": 1, "timings": 1})
+    if not document:
+        return JSONResponse(
+            status_code=404,
+            content={
+                "status": "error",
+                "message": f"Document with ID {uid} not found."
+            }
+        )
+    return JSONResponse(
+        status_code=200,
+        content={
+            "status": "success",
+            "document_id": uid,
+            "timings": document.get("timings", [])
+        }
+    )
+
 @router.get("/text-extraction/pdf")
 async def get_all_extractions(file:str = None):
     try:
@@ -1,12 +1,15 @@
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import JSONResponse
-from backend.database import collection
 import logging
-import pandas as pd
+import asyncio
 import json
-import google.generativeai as genai
-from backend.core.config import settings
 from backend.services.mapping import Mapper
+from backend.services.field_mapper import SAPFieldMapper
+from backend.services.llm_gateway import llm_gateway
+from backend.services.sap_async import master_data_cache
+from backend.services.document_session import DocumentConflict, DocumentNotFound, DocumentSession
+from backend.services.token_accounting import charge_to
+from backend.services.tracing import attach_document
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/mapping", tags=["Field Mapping"])
@@ -25,109 +28,82 @@ class SAPFields(BaseModel):
     DocumentLines: list[DocumentLine]
 
 try:
-    sap_required_fields_df = pd.read_csv('backend/assets/sap invoice required field details.csv')
-    cleaned_df = sap_required_fields_df.dropna(how='all')
+    field_mapper = SAPFieldMapper.from_files(
+        'backend/assets/sap invoice required field details.csv',
+        'backend/assets/sap_mapping_rules.yml'
+    )
     logger.info("Successfully loaded CSV mapping table.")
-except FileNotFoundError:
-    logger.error("FATAL: 'sap invoice required field details.csv' not found.")
-    cleaned_df = None
-
-try:
-    if not settings.GOOGLE_API_KEY:
-        raise ValueError("GOOGLE_API_KEY is not set in the environment.")
-    genai.configure(api_key=settings.GOOGLE_API_KEY)
-    gemini_model = genai.GenerativeModel('gemini-2.5-flash-lite')
-    logger.info("Successfully configured Gemini client with model 'gemini-2.0-flash'.")
-except Exception as e:
-    logger.error(f"FATAL: Failed to configure Gemini client: {e}")
-    gemini_model = None
+except FileNotFoundError as e:
+    logger.error(f"FATAL: SAP mapping table or rules not found: {e}")
+    field_mapper = None
 
 item_mapper = Mapper()
 
-@router.get("/get-mappings/{document_uid}", summary="Get field mappings", description="Retrieve field mappings for a given document type.")
-async def get_field_mappings(document_uid: int):
-    if cleaned_df is None:
-        raise HTTPException(status_code=503, detail="Mapping service is unavailable: CSV file not loaded.")
-    if gemini_model is None:
-        raise HTTPException(status_code=503, detail="Mapping service is unavailable: AI client not configured.")
-    try:
-        item_mapper.find_similar_vendor(document_uid)
-
-        item_mapper.map_items_to_codes(document_uid)
+def fill_missing_fields(incoming_json: dict, missing_fields: list) -> dict:
+    """Asks the model only for the header fields the mapping rules could not fill."""
+    header_json = {key: value for key, value in incoming_json.items() if key != "line_items"}
+    prompt = f"""
+        You are a data mapping assistant.
 
-        document_json = collection.find_one({"uid": document_uid}, {"_id": 0, "extracted_details": 1})
-        if not document_json:
-            raise HTTPException(status_code=404, detail=f"Document with UID {document_uid} not found.")
+        The following SAP purchase invoice fields could not be found in the invoice JSON by the mapping rules:
+        {", ".join(missing_fields)}
 
-        incoming_json = document_json.get("extracted_details", {})
-        if not incoming_json:
-            raise HTTPException(status_code=404, detail="No 'extracted_details' found in the document.")
+        ### Incoming JSON
+        {json.dumps(header_json)}
 
-        logger.info(f"Fetched document for UID {document_uid}.")
+        ### Rules
+        1. Find a value for each listed SAP field in the input JSON (case-insensitive, search recursively).
+        2. Dates must be formatted as YYYY-MM-DD.
+        3. If a field cannot be found, set it to an empty string. Do not guess.
+        4. Return a single flat JSON object whose keys are exactly the listed SAP fields.
+        """
+    logger.info(f"Generating content with Gemini for unmapped fields: {missing_fields}")
+    try:
+        filled = llm_gateway.generate(prompt, stage="field_mapping", json_output=True, temperature=0.1).parsed
+    except Exception as e:
+        logger.error(f"Model fallback for unmapped fields failed: {e}")
+        return {}
+    if not isinstance(filled, dict):
+        return {}
+    return {field: str(filled[field]).strip() for field in missing_fields if filled.get(field)}
 
-        prompt = f"""
-        You are a data mapping assistant.
+@router.get("/get-mappings/{document_uid}", summary="Get field mappings", description="Retrieve field mappings for a given document type.")
+async def get_field_mappings(document_uid: int):
+    attach_document(document_uid)
+    if field_mapper is None:
+        raise HTTPException(status_code=503, detail="Mapping service is unavailable: CSV file not loaded.")
+    try:
+        session = await asyncio.to_thread(DocumentSession.load, document_uid, {"extracted_details": 1})
+    except DocumentNotFound:
+        raise HTTPException(status_code=404, detail=f"Document with UID {document_uid} not found.")
 
-        Your task:
-        Map fields from the following JSON invoice to SAP field names using the provided CSV mapping table.
+    incoming_json = session.get("extracted_details", {})
+    if not incoming_json:
+        raise HTTPException(status_code=404, detail="No 'extracted_details' found in the document.")
 
-        ### Incoming JSON
-        {json.dumps(incoming_json, indent=2)}
+    try:
+        # Shares the pipeline's master data cache, so SAP is only asked again once it goes stale
+        vendors_df = await master_data_cache.refresh()
+        if vendors_df is not None and item_mapper.vendor_names_with_codes is not vendors_df:
+            item_mapper.vendor_names_with_codes = vendors_df
 
-        ### Mapping CSV
-        Document name,Table name,sap field name
-        {cleaned_df.to_string(index=False)}
+        # Matching and item creation block on Gemini, so they run off the event loop
+        with charge_to(document_uid):
+            await asyncio.to_thread(item_mapper.find_similar_vendor, session)
 
-        ### Rules
-        1. Match each CSV "Document name" to the corresponding "sap field name" in the input JSON (case-insensitive, search recursively).
-        2. "DocumentLines" should be an array constructed from all items in the line_items.
-        3. For each item in line_items:
-           - If "ItemCode" exists in the line item, use it directly
-           - If "ItemCode" doesn't exist but "product" or "description" exists, map it using the ItemCode field
-        4. Ignore any mention of table names — they are not needed.
-        5. Use the "sap field name" from the CSV as the output key.
-        6. If "vat_percentage" exists and is "13", set "TaxCode" to "VAT13".
-           - Otherwise, set "TaxCode" to "VAT13".
-        7. If "mode_of_payment" exists in incoming json then refer to it as "transaction type"
-        8. If any mapped field is missing in the JSON, include it with an empty string.
-        9. Return the result as a single flat JSON object.
-        10. Do NOT include markdown, code fences (```), comments, or any text outside of the final JSON object.
-
-        ### Output format (STRICT JSON)
-        Return output as plain JSON like this:
-        {{
-        "CardName": "...",
-        "CardCode": "...",
-        "NumAtCard": "...",
-        "DocumentLines": [
-        {{
-            "ItemCode": "EL00347",
-            "Description": "AUXILLARY CONTACT BLOCK 3 RT 2015 HA",
-            "Quantity": "100",
-            "TaxCode": "VAT13",
-            "UnitPrice": "50",
-        }}
-    ]
-        }}
-        Important: Return ONLY the standard JSON schema object without any markdown formatting or code blocks. No explanations, no headings, no extra text.
+            await asyncio.to_thread(item_mapper.map_items_to_codes, session)
 
-        """
-        logger.info("Generating content with Gemini...")
-        response = gemini_model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(
-                response_mime_type="application/json",
-                temperature=0.1
-            )
-        )
+        await asyncio.to_thread(session.flush)
 
-        if not response.text or not response.text.strip():
-            logger.error("Gemini API returned an empty response.")
-            raise HTTPException(status_code=500, detail="AI model returned an empty response.")
+        logger.info(f"Fetched document for UID {document_uid}.")
 
-        logger.info("Successfully received response from Gemini.")
-        mapped_result = json.loads(response.text)
-        
+        mapped_result, missing_fields = field_mapper.map(incoming_json)
+        llm_fields = []
+        if missing_fields:
+            with charge_to(document_uid):
+                filled = await asyncio.to_thread(fill_missing_fields, incoming_json, missing_fields)
+            mapped_result.update(filled)
+            llm_fields = list(filled)
 
         return JSONResponse(
             status_code=200,
@@ -135,13 +111,13 @@ async def get_field_mappings(document_uid: int):
                 "status": "success",
                 "document_uid": document_uid,
                 "original_extracted_data": incoming_json,
-                "mapped_result": mapped_result
+                "mapped_result": mapped_result,
+                "llm_mapped_fields": llm_fields
             }
         )
 
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON Parsing Error: {e}. Raw AI Response: '{response.text}'")
-        raise HTTPException(status_code=500, detail=f"Failed to parse AI response. Raw text: {response.text}")
+    except DocumentConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
@@ -0,0 +1,149 @@
+from fastapi import APIRouter, UploadFile, Form
+from fastapi.responses import JSONResponse
+import asyncio
+import os
+import shutil
+import logging
+import uuid
+from typing import Optional
+from backend.api.routers.extraction_router import ocr_client, UPLOAD_DIR
+from backend.api.routers.classification_router import classifier_client
+from backend.api.routers.mapping_router import item_mapper, field_mapper, fill_missing_fields
+from backend.api.middleware import store_trace
+from backend.database import next_document_uid
+from backend.services.ocr_processor import parse_response_schema
+from backend.services.pipeline import InvoicePipeline, PipelineError, StageTimings
+from backend.services.progress import progress_broker
+from backend.services.tracing import current_trace, end_trace, start_trace
+
+router = APIRouter(prefix="/pipeline", tags=["Pipeline"])
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+pipeline = InvoicePipeline(ocr_client, classifier_client, item_mapper, field_mapper, fill_missing_fields)
+
+# Submitted runs are referenced here until they finish so they are not garbage collected
+background_runs: set[asyncio.Task] = set()
+
+
+def save_upload(file: UploadFile) -> str:
+    # A unique name keeps concurrent uploads of the same file apart
+    file_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4().hex}_{os.path.basename(file.filename)}")
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    return file_path
+
+
+def unsupported_file_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=400,
+        content={
+            "status": "error",
+            "message": "Unsupported file type. Only PDF files are supported."
+        }
+    )
+
+
+def invalid_schema_response(error: ValueError) -> JSONResponse:
+    return JSONResponse(
+        status_code=400,
+        content={
+            "status": "error",
+            "message": str(error)
+        }
+    )
+
+
+async def run_in_background(file_path: str, file_name: str, prompt: str, post: bool, uid: int, trace_id: str, response_schema: Optional[dict] = None):
+    # The submitting request's trace ends with its 202, so the run gets its own under the same id
+    trace, token = start_trace(trace_id, "pipeline background run")
+    try:
+        await pipeline.run(file_path, file_name, prompt, post, uid=uid, response_schema=response_schema)
+    except Exception as e:
+        # The failure is published to the document's event stream
+        logger.error(f"Background pipeline failed for document {uid}: {e}")
+    finally:
+        end_trace(trace, token)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        await store_trace(trace)
+
+
+@router.post("/submit", status_code=202, summary="Start processing one file", description="Starts the same flow as POST /pipeline in the background and returns the document id at once. Follow progress at GET /extract/{document_id}/events; posting is off unless post=true.")
+async def submit_pipeline(file: UploadFile, prompt: str = Form(None), post: bool = Form(False), response_schema: str = Form(None)):
+    if not file.filename.lower().endswith(".pdf"):
+        return unsupported_file_response()
+    try:
+        schema = parse_response_schema(response_schema)
+    except ValueError as e:
+        return invalid_schema_response(e)
+    try:
+        file_path = await asyncio.to_thread(save_upload, file)
+        uid = await asyncio.to_thread(next_document_uid)
+    except Exception as e:
+        logger.exception(f"Could not accept {file.filename}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+
+    # Opened before responding so a client that subscribes right away finds the stream
+    progress_broker.open(uid)
+    trace = current_trace()
+    task = asyncio.create_task(run_in_background(file_path, file.filename, prompt, post, uid, trace.trace_id if trace else uuid.uuid4().hex, schema))
+    background_runs.add(task)
+    task.add_done_callback(background_runs.discard)
+    return JSONResponse(
+        status_code=202,
+        content={
+            "status": "accepted",
+            "document_id": uid,
+            "events_url": f"/extract/{uid}/events"
+        }
+    )
+
+
+@router.post("", summary="Extract, classify, map and post one file", description="Runs the whole flow for one PDF in a single request: OCR and extraction, then vendor resolution, classification with G/L suggestion and item matching concurrently, then SAP field mapping. The document is stored once; set post=false to stop before queueing the purchase invoice for SAP. Stage timings are returned with the result.")
+async def run_pipeline(file: UploadFile, prompt: str = Form(None), post: bool = Form(True), response_schema: str = Form(None)):
+    if not file.filename.lower().endswith(".pdf"):
+        return unsupported_file_response()
+    try:
+        schema = parse_response_schema(response_schema)
+    except ValueError as e:
+        return invalid_schema_response(e)
+
+    timings = StageTimings()
+    file_path = None
+    try:
+        with timings.stage("upload"):
+            file_path = await asyncio.to_thread(save_upload, file)
+        result = await pipeline.run(file_path, file.filename, prompt, post, timings, response_schema=schema)
+        return JSONResponse(status_code=200, content=result)
+    except PipelineError as e:
+        logger.error(f"Pipeline stopped at stage '{e.stage}' for {file.filename}: {e}")
+        return JSONResponse(
+            status_code=e.status_code,
+            content={
+                "status": "error",
+                "stage": e.stage,
+                "message": str(e),
+                "timings": timings.report()
+            }
+        )
+    except Exception as e:
+        logger.exception(f"Pipeline failed for {file.filename}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": str(e),
+                "timings": timings.report()
+            }
+        )
+    finally:
+        if file_path and os.path.exists(file_path):
+            os.remove(file_path)
@@ -1,10 +1,13 @@
 from fastapi import APIRouter, HTTPException
-from backend.services.sap_api import SAPClient
-from pydantic import BaseModel
+from fastapi.responses import JSONResponse
+from backend.services.sap_async import async_sap_client as sap_client
+from backend.services.sap_outbox import sap_outbox_drainer as outbox
+from pydantic import BaseModel, Field
+from typing import Optional
+import asyncio
 import logging
 
 router = APIRouter(prefix="/sap", tags=["SAP API"])
-sap_client = SAPClient()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,31 +16,86 @@ class DocumentLine(BaseModel):
     ItemCode: str
     UoMEntry: int
     TaxCode: str
+    Quantity: Optional[float] = None
+    UnitPrice: Optional[float] = None
 
 class SAPPurchaseInvoice(BaseModel):
     CardCode: str
-    # DocDate: str
+    # Vendor reference number; with the total it identifies the invoice so it is posted only once
+    NumAtCard: Optional[str] = None
+    DocDate: Optional[str] = None
+    DocTotal: Optional[float] = None
     DocumentLines: list[DocumentLine]
 
-@router.post("/PurchaseInvoices", summary="Post Purchase Invoice to SAP", description="Post a purchase invoice to SAP Business One system.")
+class NewItemSpec(BaseModel):
+    ItemName: str
+    Series: int
+    UoMGroupEntry: int
+
+class BatchDocumentLine(BaseModel):
+    ItemCode: Optional[str] = None
+    UoMEntry: Optional[int] = None
+    TaxCode: str
+    # Created in SAP before the invoice is posted when ItemCode is empty
+    NewItem: Optional[NewItemSpec] = None
+
+class BatchPurchaseInvoice(BaseModel):
+    CardCode: str
+    DocumentLines: list[BatchDocumentLine]
+
+class BatchPurchaseInvoicesRequest(BaseModel):
+    invoices: list[BatchPurchaseInvoice] = Field(min_length=1)
+
+@router.get("/sessions", summary="SAP session health", description="Health of each pooled SAP Service Layer session.")
+async def get_session_health():
+    return {"status": "success", "sessions": sap_client.health()}
+
+@router.post("/PurchaseInvoices", summary="Queue Purchase Invoice for SAP", description="Queue a purchase invoice for posting to SAP Business One. The invoice is stored in the outbox and posted in the background; poll /sap/outbox/{posting_id} for the outcome. Resubmitting the same invoice returns the existing posting.")
 async def post_purchase_invoice(invoice: SAPPurchaseInvoice):
     try:
         logger.info(f"Received data: {invoice}")
         payload = invoice.model_dump(exclude_none=True)
 
-        result = sap_client.post_purchase_invoice(payload)
-        if result:
-            if result.get("error"):
-                raise HTTPException(
-                    status_code=result.get("status_code", 400), 
-                    detail=f"SAP Error: {result.get('detail', 'Unknown error')}"
-                )
-            logger.info("DocEntry: %s", result.get("DocEntry"))
-            return {"status": "success", "DocEntry": result.get("DocEntry"), "data": result}
-        else:
-            raise HTTPException(status_code=400, detail="Failed to post purchase invoice to SAP.")
-    except HTTPException:
-        raise
+        entry, created = await asyncio.to_thread(outbox.enqueue, payload)
+        return JSONResponse(
+            status_code=202 if created else 200,
+            content={
+                "status": entry["status"],
+                "posting_id": entry["posting_id"],
+                "duplicate": not created,
+                "DocEntry": entry.get("doc_entry")
+            }
+        )
+    except Exception as e:
+        logger.exception("Error queueing purchase invoice")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/outbox/{posting_id}", summary="Purchase invoice posting status", description="Status of a purchase invoice queued for SAP: pending, posting, posted, failed or needs_review.")
+async def get_posting(posting_id: str):
+    entry = await asyncio.to_thread(outbox.get, posting_id)
+    if not entry:
+        raise HTTPException(status_code=404, detail="Posting not found")
+    return entry
+
+@router.get("/outbox", summary="List queued purchase invoices", description="Most recent outbox entries, optionally filtered by status.")
+async def list_postings(status: Optional[str] = None, limit: int = 100):
+    entries = await asyncio.to_thread(outbox.recent, status, min(max(limit, 1), 1000))
+    return {"status": "success", "count": len(entries), "postings": entries}
+
+@router.post("/PurchaseInvoices/batch", summary="Post many Purchase Invoices to SAP", description="Post purchase invoices to SAP Business One with Service Layer $batch requests. Items referenced by NewItem are created first. Each invoice is its own changeset, so one failure does not roll back the others.")
+async def post_purchase_invoices_batch(request: BatchPurchaseInvoicesRequest):
+    try:
+        logger.info(f"Received batch of {len(request.invoices)} purchase invoice(s)")
+        payloads = [invoice.model_dump(exclude_none=True) for invoice in request.invoices]
+
+        results = await sap_client.post_purchase_invoices_batch(payloads)
+        posted = sum(1 for result in results if result["status"] == "success")
+        return {
+            "status": "success" if posted == len(results) else "partial" if posted else "error",
+            "posted": posted,
+            "failed": len(results) - posted,
+            "results": results
+        }
     except Exception as e:
-        logger.exception("Error posting purchase invoice")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        logger.exception("Error posting purchase invoice batch")
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,66 @@
+from fastapi import APIRouter, Query
+from fastapi.responses import JSONResponse
+import asyncio
+import logging
+from backend.services.token_accounting import daily_usage, document_usage, top_prompts
+
+router = APIRouter(prefix="/usage", tags=["Token Usage"])
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@router.get("/documents/{document_uid}", summary="Token usage of a document", description="Every model call charged to the document, with prompt and completion tokens, latency and totals per model and stage.")
+async def get_document_usage(document_uid: int):
+    try:
+        usage = await asyncio.to_thread(document_usage, document_uid)
+        if not usage["calls"]:
+            return JSONResponse(
+                status_code=404,
+                content={
+                    "status": "error",
+                    "message": f"No model calls recorded for document {document_uid}."
+                }
+            )
+        return JSONResponse(status_code=200, content=usage)
+    except Exception as e:
+        logger.error(f"Error reading token usage of document {document_uid}: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+
+
+@router.get("/daily", summary="Daily token usage", description="Calls, tokens and latency per day, model and stage for the last `days` days.")
+async def get_daily_usage(days: int = Query(7, ge=1, le=366)):
+    try:
+        rows = await asyncio.to_thread(daily_usage, days)
+        return JSONResponse(status_code=200, content={"days": days, "usage": rows})
+    except Exception as e:
+        logger.error(f"Error reading daily token usage: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+
+
+@router.get("/top-prompts", summary="Most expensive prompts", description="Prompts that spent the most tokens over the last `days` days, grouped by prompt text, with a preview of each.")
+async def get_top_prompts(limit: int = Query(10, ge=1, le=100), days: int = Query(7, ge=1, le=366)):
+    try:
+        prompts = await asyncio.to_thread(top_prompts, limit, days)
+        return JSONResponse(status_code=200, content={"days": days, "prompts": prompts})
+    except Exception as e:
+        logger.error(f"Error reading the most expensive prompts: {e}")
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
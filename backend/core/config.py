@@ -2,7 +2,7 @@ from pydantic_settings import BaseSettings, SettingsConfigDict
 import os
 
 class Settings(BaseSettings):
-    MONGODB_URI: str = ""
+    MONGODB_URI: str = ""  # "mongomock://" runs against an in-memory Mongo
     MISTRAL_API_KEY: str = ""
     GOOGLE_API_KEY: str = ""
     HF_API_KEY: str = ""
@@ -10,6 +10,77 @@ class Settings(BaseSettings):
     COMPANY_DB: str = ""
     USERNAME: str = ""
     PASSWORD: str = ""
+    OUTGOING_PAYMENT_THRESHOLD: float = 2000
+    CLASSIFICATION_RULES_MIN_CONFIDENCE: float = 0.8
+    # Most documents one POST /classification/batch may select, by uids or by filter
+    CLASSIFICATION_BATCH_MAX_DOCUMENTS: int = 1000
+    # Provider quotas used by the shared rate limiters
+    GEMINI_REQUESTS_PER_MINUTE: float = 15
+    GEMINI_BURST: int = 5
+    GEMINI_MAX_CONCURRENCY: int = 4
+    SAP_REQUESTS_PER_SECOND: float = 10
+    SAP_BURST: int = 10
+    SAP_MAX_CONCURRENCY: int = 4
+    SAP_BATCH_SIZE: int = 50  # changesets per $batch request
+    SAP_SESSION_POOL_SIZE: int = 4
+    # Business partners and item groups are fetched from SAP again at most this often
+    SAP_MASTER_DATA_TTL_SECONDS: float = 300
+    SAP_TIMEOUT_SECONDS: float = 60
+    SAP_OUTBOX_MAX_ATTEMPTS: int = 8
+    SAP_OUTBOX_BACKOFF_BASE_SECONDS: float = 5
+    SAP_OUTBOX_BACKOFF_MAX_SECONDS: float = 300
+    SAP_OUTBOX_POLL_SECONDS: float = 2
+    SAP_OUTBOX_LEASE_SECONDS: float = 120
+    MISTRAL_REQUESTS_PER_SECOND: float = 5
+    MISTRAL_BURST: int = 5
+    MISTRAL_MAX_CONCURRENCY: int = 4
+    HF_REQUESTS_PER_SECOND: float = 5
+    HF_BURST: int = 5
+    HF_MAX_CONCURRENCY: int = 4
+    # LLM gateway
+    LLM_BACKEND: str = "gemini"  # "gemini" or "fake"
+    LLM_DEFAULT_MODEL: str = "gemini-2.5-flash-lite"
+    LLM_TIMEOUT_SECONDS: float = 60
+    OCR_TIMEOUT_SECONDS: float = 180
+    LLM_MAX_RETRIES: int = 3
+    LLM_BACKOFF_BASE_SECONDS: float = 1
+    LLM_BACKOFF_MAX_SECONDS: float = 30
+    FAKE_LLM_LATENCY_MS: float = 0
+    FAKE_LLM_ERROR_RATE: float = 0
+    OCR_BACKEND: str = "mistral"  # "mistral" or "fake"
+    FAKE_OCR_LATENCY_MS: float = 0
+    FAKE_OCR_ERROR_RATE: float = 0
+    # PDFs longer than OCR_CHUNK_PAGES are split into chunks of that many pages, OCR'd
+    # concurrently (0 = never split); a failed chunk is retried on its own
+    OCR_CHUNK_PAGES: int = 10
+    OCR_CHUNK_CONCURRENCY: int = 4
+    OCR_CHUNK_ATTEMPTS: int = 2
+    # Preflight shrinks PDFs before OCR: images downsampled to PDF_PREFLIGHT_DPI and recompressed,
+    # attachments and metadata removed. Smaller files are sent as they are
+    PDF_PREFLIGHT: bool = True
+    PDF_PREFLIGHT_MIN_BYTES: int = 1_000_000
+    PDF_PREFLIGHT_DPI: int = 200
+    PDF_PREFLIGHT_JPEG_QUALITY: int = 75
+    PDF_KEEP_ORIGINALS: bool = True  # original uploads kept in GridFS
+    # PDFs up to OCR_INLINE_MAX_BYTES go to Mistral OCR inline as a base64 data URL (0 = always
+    # upload); larger ones are uploaded first, and deleted from Mistral after OCR
+    OCR_INLINE_MAX_BYTES: int = 1_000_000
+    OCR_DELETE_UPLOADS: bool = True
+    # Candidates sent to the model when creating items for unknown line items
+    SHORTLIST_ACCOUNT_CODES_K: int = 25
+    SHORTLIST_ITEM_GROUPS_K: int = 6
+    SHORTLIST_UOM_GROUPS_K: int = 5
+    # Worker processes for PDF handling and fuzzy matching: -1 = one per available core,
+    # 0 = no pool, the work runs in the calling thread
+    CPU_POOL_WORKERS: int = -1
+    # Tokens one document may spend on model calls across all requests (0 = unlimited).
+    # "degrade" shortens prompts that support it before rejecting; "reject" never shortens
+    LLM_DOCUMENT_TOKEN_BUDGET: int = 0
+    LLM_BUDGET_POLICY: str = "degrade"
+    # Tracing and on-demand profiling; profiling is off while PROFILING_TOKEN is empty
+    TRACE_TIMINGS_KEPT: int = 20  # request traces stored per document
+    PROFILING_TOKEN: str = ""
+    PROFILING_INTERVAL_MS: float = 5
 
     model_config = SettingsConfigDict(
         env_file=".env",
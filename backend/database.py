@@ -1,19 +1,77 @@
 import os
+import gridfs
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from .core.config import settings
+from .services.metrics import mongo_command_metrics
 
 load_dotenv()
 
 mongodb_uri = settings.MONGODB_URI
 
-client = MongoClient(mongodb_uri)
+if mongodb_uri.startswith("mongomock://"):
+    # In-memory stand-in for tests and benchmarks
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    client = mongomock.MongoClient()
+else:
+    client = MongoClient(mongodb_uri, event_listeners=[mongo_command_metrics])
 db = client["ocr_prompts"]
 collection = db["prompts"]
     
 if "prompts" not in db.list_collection_names():
     db.create_collection("prompts")
 
+# Purchase invoices waiting to be posted to SAP, drained by backend.services.sap_outbox
+sap_outbox = db["sap_outbox"]
+sap_outbox.create_index("idempotency_key", unique=True)
+sap_outbox.create_index("posting_id", unique=True)
+sap_outbox.create_index([("status", 1), ("next_attempt_at", 1)])
+
+# Token usage per model call, and summed per day, model and stage (backend.services.token_accounting)
+llm_usage = db["llm_usage"]
+llm_usage.create_index("uid")
+llm_usage.create_index([("day", 1), ("total_tokens", -1)])
+llm_usage_daily = db["llm_usage_daily"]
+
+# Uploads as received, before preflight shrinks the copy sent to OCR
+original_uploads = gridfs.GridFS(db, collection="original_uploads")
+
+# Sequence for document uids, so a uid can be handed out before the document is stored
+counters = db["counters"]
+
+def next_document_uid() -> int:
+    if counters.find_one({"_id": "document_uid"}) is None:
+        # Continue after the highest uid already in use
+        latest = collection.find_one({"uid": {"$exists": True}}, {"uid": 1}, sort=[("uid", -1)])
+        try:
+            counters.insert_one({"_id": "document_uid", "value": latest["uid"] if latest else 0})
+        except DuplicateKeyError:
+            pass
+    counter = counters.find_one_and_update({"_id": "document_uid"}, {"$inc": {"value": 1}}, return_document=ReturnDocument.AFTER)
+    return counter["value"]
+
+def store_document_timings(uids, timings: dict):
+    # Keeps the most recent request traces of each document under "timings"
+    collection.update_many(
+        {"uid": {"$in": list(uids)}},
+        {"$push": {"timings": {"$each": [timings], "$slice": -settings.TRACE_TIMINGS_KEPT}}}
+    )
+
+def store_original_upload(uid: int, file_path: str, file_name: str) -> str:
+    with open(file_path, "rb") as f:
+        file_id = original_uploads.put(
+            f, filename=file_name, content_type="application/pdf",
+            metadata={"uid": uid, "size": os.path.getsize(file_path)}
+        )
+    return str(file_id)
+
+def find_original_upload(uid: int):
+    """The newest original upload of a document, or None."""
+    return original_uploads.find_one({"metadata.uid": uid}, sort=[("uploadDate", -1)])
+
 def add_default_prompt(prompt):
     if collection.count_documents({"default_type": "pdf"}) == 0:
         collection.insert_one({"default_type": "pdf", "default_prompt": prompt})
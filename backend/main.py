@@ -1,7 +1,13 @@
+import os
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from .api.routers import classification_router, extraction_router, prompt_router, mapping_router, sap_invoice_router
+from .api.routers import classification_router, extraction_router, prompt_router, mapping_router, sap_invoice_router, pipeline_router, debug_router, usage_router
+from .api.middleware import TracingMiddleware
+from .services.sap_async import async_sap_client
+from .services.sap_outbox import sap_outbox_drainer
+from .services.metrics import render_metrics
+from .services.cpu_pool import cpu_pool
 recent_filename = None
 
 app = FastAPI()
@@ -12,18 +18,38 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Trace-Id", "X-Profile-Url"],
 )
+app.add_middleware(TracingMiddleware)
 
 @app.get("/", response_class=HTMLResponse)
 async def get_home(request: Request):
     return HTMLResponse("""
     <h1>Welcome to the OCR Extraction and Classification API</h1>
     """)
+
+@app.get("/upload", response_class=HTMLResponse)
+async def get_upload_page():
+    # Upload form that follows processing through /extract/{id}/events
+    return FileResponse(os.path.join(os.path.dirname(__file__), "templates", "index.html"))
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    # Prometheus scrape endpoint: stage and dependency latencies, retries, cache hits, in-flight requests
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
     
 app.include_router(extraction_router.router)
 app.include_router(classification_router.router)
 app.include_router(prompt_router.router)
 app.include_router(mapping_router.router)
 app.include_router(sap_invoice_router.router)
+app.include_router(pipeline_router.router)
+app.include_router(debug_router.router)
+app.include_router(usage_router.router)
 
-
+app.add_event_handler("startup", cpu_pool.start)
+app.add_event_handler("startup", sap_outbox_drainer.start)
+app.add_event_handler("shutdown", sap_outbox_drainer.stop)
+app.add_event_handler("shutdown", async_sap_client.aclose)
+app.add_event_handler("shutdown", cpu_pool.stop)
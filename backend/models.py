@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Dict, Union, Any
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Dict, Union, Any, List
 
 
 class OCRResponse(BaseModel):
@@ -7,3 +7,61 @@ class OCRResponse(BaseModel):
     message: str
     content: Dict[str, Any]
     extracted_text: str
+
+
+class ExtractionPart(BaseModel):
+    # Missing fields are "" and amounts stay text, as in the documents stored so far
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+
+
+class VendorDetails(ExtractionPart):
+    name: str = ""
+    address: str = ""
+    contact_number: str = ""
+    email: str = ""
+    website: str = ""
+    pan_number: str = Field("", description="PAN / VAT number of the company")
+
+
+class CustomerDetails(ExtractionPart):
+    name: str = ""
+    address: str = ""
+    contact_number: str = ""
+    pan_number: str = Field("", description="PAN / VAT number of the company")
+
+
+class InvoiceDetails(ExtractionPart):
+    bill_number: str = ""
+    bill_date: str = Field("", description="YYYY-MM-DD")
+    nepali_miti: str = Field("", description="The date in the Nepali calendar, if available")
+    mode_of_payment: str = ""
+    finance_manager: str = ""
+    authorized_signatory: str = ""
+    lc_no: str = Field("", description="Letter of credit number")
+
+
+class PaymentDetails(ExtractionPart):
+    net_amount: str = Field("", description="Total before discount and VAT; can also be the taxable total")
+    discount_amount: str = Field("", description="An amount, not a percentage")
+    taxable_amount: str = Field("", description="An amount, not a percentage")
+    vat_percentage: str = Field("", description="A percentage")
+    vat_amount: str = Field("", description="An amount: the VAT percentage of the net amount")
+    grand_total: str = Field("", description="The final amount after VAT and discount; equals the total in words")
+    grand_total_in_words: str = ""
+
+
+class LineItem(ExtractionPart):
+    hs_code: str = ""
+    products: str = Field("", description="The product or service billed on this line")
+    quantity: str = ""
+    rate: str = ""
+    amount: str = ""
+
+
+class InvoiceExtraction(ExtractionPart):
+    """Structured output of the default extraction prompt, enforced by the model's response schema."""
+    vendor_details: VendorDetails = Field(default_factory=VendorDetails)
+    customer_details: CustomerDetails = Field(default_factory=CustomerDetails)
+    invoice_details: InvoiceDetails = Field(default_factory=InvoiceDetails)
+    payment_details: PaymentDetails = Field(default_factory=PaymentDetails)
+    line_items: List[LineItem] = Field(default_factory=list)
@@ -1,13 +1,14 @@
 from ..core.config import settings
-import os
 import json
+import hashlib
 from dotenv import load_dotenv
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_google_genai import ChatGoogleGenerativeAI
 from ..database import collection
-from typing import Dict, Optional
-import re
-import requests
+from typing import Dict, Literal, Optional
+from pydantic import BaseModel
+from .invoice_rules import ClassificationDecision, classify_by_rules
+from .llm_gateway import llm_gateway
+from .document_session import DocumentSession
+from .metrics import observe_stage
 import pandas as pd
 import logging
 
@@ -18,14 +19,159 @@ logger = logging.getLogger(__name__)
 
 total_uploads = collection.count_documents({"file_name": {"$exists":True}})
 
+GL_MAPPING = json.loads("""
+{
+    "Advertisement Expenses": [
+        "Sales-KTV ( 5 sec Headline break all news Sarbottam steelTVC cost of KrV dated Magh 1-30 2081 ) (As per RO)",
+        "Toward the Cost of Facebook Page Management",
+        "Advertisement tax and service",
+        "Radio Advertising",
+        "Volume Branding"
+    ],
+    "CARGO FEE": [
+        "Consignment Note",
+        "DHL Express or any cargo company",
+        "Cargo and Courier"
+    ],
+    "Cleaning Expenses": [
+        "Harpic Dettol Lizol Exo Odonil (bhatbhateni)"
+    ],
+    "Electricity Expenses": [
+        "related to energy companies (electricit charges of a certain month in line item)"
+    ],
+    "FURNITURE & FIXTURE": [
+        "items related with furniture decor interiors"
+    ],
+    "INSURANCE": [
+        "related to insurance companyt and vehicle insurance"
+    ],
+    "IT & ACCESSORIES": [
+        "Laptop, Keyboard, Mouse any accessory supply"
+    ],
+    "IT Expenses": [
+        "Fortinet Fortigate 80F Unified Threat Protection",
+        "Sales Order ERP Web Software development",
+        "SAP Business One (bizhub)"
+    ],
+    "PLANT & MACHENERY": [
+        "related to equipment used in a business to carry out operation"
+    ],
+    "PRINTING AND STATIONARY": [
+        "related to books and stationary suppliers",
+        "Crayons Corp Pvt. Ltd. (company Name)"
+    ],
+    "Rep Maint Exp-Pool A ": [
+        "related to building, structure and similar works of permanent nature",
+        "Auto or Repairing Workshop"
+    ],
+    "Repair and Maintainance Admin -Pool B": [
+        "Electronics related repair and maintenance",
+        "computers, data processing equipments, furiture, fixture and office equpments"
+    ],
+    "Telephones Expenses": [
+        "SMS and call related invoice"
+    ],
+    "Travelling Expenses-Directors": [
+        "related to hotel room expenses ",
+        "Hotel names on vendor names",
+        "(customer name: Atul Neupane)"
+    ],
+    "Travelling Expenses-Staffs": [
+        "related to hotel room expenses ",
+        "Hotel names on vendor names",
+        "(customer name: Sabina, Mahesh)"
+    ],
+    "Travelling Expenses-Others": [
+        "related to hotel room expenses",
+        "Hotel names on vendor names",
+        "(customer name: Sarbottam)"
+    ],
+    "Rep Maint Exp-Pool C": [
+        "automobile, bus and minibus"
+    ],
+    "Repair and Maintainance Admin -Pool D": [
+        "Construction and earth moving equipments, unabsorbed pollution control cost and any tangible assets not included in above blocks"
+    ],
+    "Rep Maint Exp-Pool E": [
+        "Intangible assets (patents, copyrights, trade marks, software etc (cost+life down to which are not included in block D assets)"
+    ],
+    "SCRAP": [
+        "Related to iron scraps or metal scraps",
+        "Iron Scrap or Sponge Iron"
+    ]
+}
+""")
+
+
+CLASSIFICATION_LABELS = ("ap_invoice", "ap_invoice_with_lc", "outgoing_payment")
+
+
+# Written into extracted_details by the Mapper after classification; they do not change the label
+MAPPER_VENDOR_FIELDS = ("code",)
+MAPPER_LINE_ITEM_FIELDS = ("ItemCode", "UoMCode", "AccountCode")
+
+
+def without_mapper_fields(extracted_details: dict) -> dict:
+    """The extracted details as the classifier saw them, without the SAP codes mapping adds later."""
+    details = dict(extracted_details)
+    if isinstance(details.get("vendor_details"), dict):
+        details["vendor_details"] = {
+            key: value for key, value in details["vendor_details"].items() if key not in MAPPER_VENDOR_FIELDS
+        }
+    if isinstance(details.get("line_items"), list):
+        details["line_items"] = [
+            {key: value for key, value in item.items() if key not in MAPPER_LINE_ITEM_FIELDS} if isinstance(item, dict) else item
+            for item in details["line_items"]
+        ]
+    return details
+
+
+def fingerprint_details(extracted_details) -> str:
+    """
+    Returns a stable hash of the extracted details a classification was computed from.
+    Fields the Mapper writes later are left out, so mapping a document keeps its cached label.
+    """
+    if isinstance(extracted_details, str):
+        try:
+            extracted_details = json.loads(extracted_details)
+        except json.JSONDecodeError:
+            return hashlib.sha256(extracted_details.encode("utf-8")).hexdigest()
+    if isinstance(extracted_details, dict):
+        extracted_details = without_mapper_fields(extracted_details)
+    payload = json.dumps(extracted_details, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class GLSuggestion(BaseModel):
+    index: int
+    gl_account: str
+
+class GLSuggestions(BaseModel):
+    suggestions: list[GLSuggestion]
+
+
+class DocumentLabel(BaseModel):
+    index: int
+    label: Literal["ap_invoice", "ap_invoice_with_lc"]
+
+class DocumentLabels(BaseModel):
+    labels: list[DocumentLabel]
+
+
+def load_vendor_names() -> list:
+    df = pd.read_csv("backend/assets/vendor_list.csv")
+    logger.info("Loaded vendor names from CSV.")
+    return df["CardName"].dropna().astype(str).tolist()
+
+
 class Classifier:
     def __init__(self):
         api_key = settings.GOOGLE_API_KEY
         if not api_key:
             logger.error("GOOGLE_API_KEY not found in environment variables")
             raise ValueError("GOOGLE_API_KEY not found in environment variables")
-        self.client = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite")
-        logger.info("Gemini model initialized.")
+        self.llm = llm_gateway
+        logger.info("Classifier initialized with the LLM gateway.")
     
     def parse_invoice_json(self, raw_json_string: str) -> Optional[Dict]:
         """Parses a raw string to extract and load a JSON object."""
@@ -45,31 +191,23 @@ class Classifier:
             logger.error("Could not find a valid JSON object in the string.")
             return None
     
-    def classify_invoice(self, invoice_json: dict, model) -> str:
+    @observe_stage("classifier")
+    def classify_invoice(self, invoice_json: dict) -> ClassificationDecision:
         """
-        Classifies an invoice based on its content using a Gemini model.
-        Also checks for a specific net_amount condition.
+        Classifies an invoice with the local rules first and only sends documents
+        the rules cannot decide confidently to the Gemini model.
         """
         try:
-            total_amount = invoice_json.get("payment_details", {}).get("grand_total")
-
-            if total_amount is not None:
-                try:
-                    cleaned_amount_str = re.sub(r'[^0-9.]', '', str(total_amount))
-                    total_amount_float = float(cleaned_amount_str)
-
-                    if total_amount_float < 2000:
-                        logger.info("Identified as outgoing_payment based on grand_total < 2000")
-                        return "outgoing_payment"
-                except (ValueError, TypeError) as num_err:
-                        logger.error(f"Could not convert grand_total to number: {total_amount} - {num_err}")
-                        # Continue to model classification if number conversion fails
+            decision = classify_by_rules(invoice_json)
+            if decision.confidence >= settings.CLASSIFICATION_RULES_MIN_CONFIDENCE:
+                logger.info(f"Identified as {decision.label} by rule '{decision.rule}' with confidence {decision.confidence}")
+                return decision
+            logger.info(f"Rules undecided ({decision.rule}, confidence {decision.confidence}), falling back to model classification")
         except Exception as e:
-            # Catch any unexpected errors during the initial check
-            logger.error(f"Error during grand_total check: {e}")
-        # If the net_amount condition is not met, use the model for classification
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a document classifier for SAP systems. Based on the invoice JSON data, classify the document into one of the following types:
+            # Catch any unexpected errors during the rule checks
+            logger.error(f"Error during rule-based classification: {e}")
+        # If the rules are not confident enough, use the model for classification
+        system = """You are a document classifier for SAP systems. Based on the invoice JSON data, classify the document into one of the following types:
     - ap_invoice
     - ap_invoice_with_lc
 
@@ -78,34 +216,62 @@ class Classifier:
     - 'ap_invoice_with_lc' includes reference to LC (Letter of Credit) in payment mode, particulars, or vendor behavior (if invoice_details.lc_no is preset it is ap_invoice_with_lc)
 
     Respond with only one of the labels: ap_invoice or ap_invoice_with_lc.
-    """),
-            ("user", "Here is the invoice data:\n{invoice_json}")
-        ])
-
-        chain = prompt | model
+    """
 
         try:
-            response = chain.invoke({
-                "invoice_json": json.dumps(invoice_json, indent=2)
-            })
-            return response.content.strip()
+            response = self.llm.generate(
+                f"Here is the invoice data:\n{json.dumps(invoice_json, indent=2)}",
+                stage="classification",
+                system=system
+            )
+            return ClassificationDecision(label=response.text.strip(), decided_by="llm")
         except Exception as e:
             logger.error(f"Classification failed: {type(e).__name__} - {e}")
-            return f"Classification failed: {type(e).__name__} - {e}"
+            return ClassificationDecision(label=f"Classification failed: {type(e).__name__} - {e}", decided_by="llm")
 
-    def process_classification(self, document_id: int):
-        """Fetches document by ID and processes classification based on extracted details."""
-        logger.info("Attempting to process classification for document ID: {document_id}")
-        try:
-            # Fetch the document from MongoDB using the uid
-            document = collection.find_one({"uid": document_id}, {"extracted_details": 1, "_id": 0})
+    @observe_stage("classifier")
+    def classify_invoices_with_model(self, invoices: Dict[int, dict]) -> Dict[int, ClassificationDecision]:
+        """
+        Classifies several invoices the rules could not decide in a single schema-constrained
+        model call. Keys of the input are returned with their decision; failed keys are omitted.
+        """
+        system = """You are a document classifier for SAP systems. You will receive a numbered list of invoice JSON documents. Classify every document into one of the following types:
+    - ap_invoice
+    - ap_invoice_with_lc
+
+    Your classification should depend on the nature of the document:
+    - 'ap_invoice' is a standard vendor invoice
+    - 'ap_invoice_with_lc' includes reference to LC (Letter of Credit) in payment mode, particulars, or vendor behavior (if invoice_details.lc_no is preset it is ap_invoice_with_lc)
 
-            if not document:
-                logger.error(f"Document with ID {document_id} not found in database.")
-                return "Document not found."
+    Return exactly one label per document, using the document's index.
+    """
+        invoices_text = "\n".join(f"{index}: {json.dumps(invoice)}" for index, invoice in invoices.items())
 
-            # Directly access the extracted_details field from the document dictionary
-            extracted_details = document.get("extracted_details")
+        try:
+            response = self.llm.generate(
+                f"Here are the invoices (index: invoice data):\n{invoices_text}",
+                stage="classification_batch",
+                system=system,
+                schema=DocumentLabels
+            ).parsed
+        except Exception as e:
+            logger.error(f"Batched classification failed for {len(invoices)} documents: {type(e).__name__} - {e}")
+            return {}
+
+        return {
+            result.index: ClassificationDecision(label=result.label, decided_by="llm")
+            for result in response.labels
+            if result.index in invoices
+        }
+
+    @observe_stage("classifier")
+    def process_classification(self, session: DocumentSession):
+        """Classifies the session's document based on its extracted details."""
+        document_id = session.uid
+        logger.info(f"Attempting to process classification for document ID: {document_id}")
+        try:
+            # Directly access the extracted_details field from the loaded document
+            extracted_details = session.get("extracted_details")
 
             if not extracted_details:
                 logger.error(f"No 'extracted_details' field found for document ID: {document_id}")
@@ -129,18 +295,18 @@ class Classifier:
                 logger.info(f"'extracted_details' for document ID {document_id} is not in a valid dictionary format after processing.")
                 return "Extracted details are not in a valid dictionary format for classification."
 
-            # Get the Gemini model
-            model = self.client
-
             # Classify the invoice
-            classification_result = self.classify_invoice(invoice_data_dict, model)
+            decision = self.classify_invoice(invoice_data_dict)
+            classification_result = decision.label
+            session.set("classification_decision", decision.model_dump())
 
             if classification_result == 'ap_invoice':
-                gl_classified = self.gl_account_classifier(document_id)
-                collection.update_one({"uid": document_id}, {"$set":  {"gl_classification": gl_classified}})
+                gl_classified = self.gl_account_classifier(session)
+                session.set("gl_classification", gl_classified)
 
             else: 
                 logger.info("Not a ap_invoice")
+                session.unset("gl_classification")
 
             return classification_result
 
@@ -148,182 +314,59 @@ class Classifier:
             logger.error(f"An unexpected error occurred during classification for document ID {document_id}: {e}")
             return f"An internal error occurred: {str(e)}"
 
-    def match_vendor_name(self, document_id: int):
+    @observe_stage("classifier")
+    def match_vendor_name(self, session: DocumentSession):
+        document_id = session.uid
         try:
-            API_URL = "https://router.huggingface.co/hf-inference/models/sentence-transformers/all-MiniLM-L6-v2/pipeline/sentence-similarity"
-            access_token = os.getenv("HF_API_KEY")
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-            }
-            df = pd.read_csv("backend/assets/vendor_list.csv")
-            logger.info("Loaded vendor names from CSV.")
-            vendor_names = df.values.tolist()
-
-            def query(payload):
-                response = requests.post(API_URL, headers=headers, json=payload)
-                return response.json()
-            
-            document = collection.find_one({"uid": document_id}, {"extracted_details": 1, "_id": 0})
-            vendor_name = document.get("extracted_details", {}).get("vendor_details", {}).get("name")
-            vendor_name_list = [list[0] for list in vendor_names]
-
-            output = query({
-                "inputs": {
-                    "source_sentence": vendor_name,
-                    "sentences": vendor_name_list
-                }
-            })
-
-            if output and isinstance(output, list):
-                scores = output[0] if isinstance(output[0], list) else output
-                
-                if not isinstance(scores, list):
-                    logger.error(f"Unexpected scores format: {type(scores)}")
-                    return 
-
-                highest_score = max(scores)
-                best_index = scores.index(highest_score)
-                
-                best_match = vendor_name_list[best_index]
-                            
-                logger.info(f"Best match found while classifying: {best_match}")
-                logger.info(f"Similarity score: {highest_score:.2%}")
-                logger.info(f"Index in list: {best_index}")
-
-                collection.update_one(
-                    {"uid": document_id},
-                    {"$set": {"extracted_details.vendor_details.name": best_match}}
-                )
-                logger.info(f"Vendor name updated in database for document ID {document_id} to {best_match}.")
-            else:
-                logger.error(f"Invalid API response format: {type(output)}")
-                logger.error(f"Response content: {output}")
+            vendor_name = session.get("extracted_details.vendor_details.name")
+
+            match = self.find_best_vendor_match(vendor_name, load_vendor_names())
+            if match:
+                best_match, highest_score = match
+                session.set("extracted_details.vendor_details.name", best_match)
+                logger.info(f"Vendor name updated for document ID {document_id} to {best_match}.")
 
         except Exception as e:
             logger.error(f"An unexpected error occurred during vendor name matching for document ID {document_id}: {e}")
             return f"An internal error occurred: {str(e)}"
 
-    def gl_account_classifier(self, document_id:id):
-        document = collection.find_one({"uid": document_id}, {"extracted_details": 1, "_id": 0})
-        raw_vendor_extracted_details = document.get("extracted_details", {})
-        vendor_extracted_details = json.dumps(raw_vendor_extracted_details)
-        
-        invoice_json_data = vendor_extracted_details
-        gl_mapping_json_data = """
-            {
-            "Advertisement Expenses": [
-                "Sales-KTV ( 5 sec Headline break all news Sarbottam steelTVC cost of KrV dated Magh 1-30 2081 ) (As per RO)",
-                "Toward the Cost of Facebook Page Management",
-                "Advertisement tax and service",
-                "Radio Advertising",
-                "Volume Branding"
-            ],
-            "CARGO FEE": [
-                "Consignment Note",
-                "DHL Express or any cargo company",
-                "Cargo and Courier"
-            ],
-            "Cleaning Expenses": [
-                "Harpic Dettol Lizol Exo Odonil (bhatbhateni)"
-            ],
-            "Electricity Expenses": [
-                "related to energy companies (electricit charges of a certain month in line item)"
-            ],
-            "FURNITURE & FIXTURE": [
-                "items related with furniture decor interiors"
-            ],
-            "INSURANCE": [
-                "related to insurance companyt and vehicle insurance"
-            ],
-            "IT & ACCESSORIES": [
-                "Laptop, Keyboard, Mouse any accessory supply"
-            ],
-            "IT Expenses": [
-                "Fortinet Fortigate 80F Unified Threat Protection",
-                "Sales Order ERP Web Software development",
-                "SAP Business One (bizhub)"
-            ],
-            "PLANT & MACHENERY": [
-                "related to equipment used in a business to carry out operation"
-            ],
-            "PRINTING AND STATIONARY": [
-                "related to books and stationary suppliers",
-                "Crayons Corp Pvt. Ltd. (company Name)"
-            ],
-            "Rep Maint Exp-Pool A ": [
-                "related to building, structure and similar works of permanent nature",
-                "Auto or Repairing Workshop"
-            ],
-            "Repair and Maintainance Admin -Pool B": [
-                "Electronics related repair and maintenance",
-                "computers, data processing equipments, furiture, fixture and office equpments"
-            ],
-            "Telephones Expenses": [
-                "SMS and call related invoice"
-            ],
-            "Travelling Expenses-Directors": [
-                "related to hotel room expenses ",
-                "Hotel names on vendor names",
-                "(customer name: Atul Neupane)"
-            ],
-            "Travelling Expenses-Staffs": [
-                "related to hotel room expenses ",
-                "Hotel names on vendor names",
-                "(customer name: Sabina, Mahesh)"
-            ],
-            "Travelling Expenses-Others": [
-                "related to hotel room expenses",
-                "Hotel names on vendor names",
-                "(customer name: Sarbottam)"
-            ],
-            "Rep Maint Exp-Pool C": [
-                "automobile, bus and minibus"
-            ],
-            "Repair and Maintainance Admin -Pool D": [
-                "Construction and earth moving equipments, unabsorbed pollution control cost and any tangible assets not included in above blocks"
-            ],
-            "Rep Maint Exp-Pool E": [
-                "Intangible assets (patents, copyrights, trade marks, software etc (cost+life down to which are not included in block D assets)"
-            ],
-            "SCRAP": [
-            "Related to iron scraps or metal scraps",
-            "Iron Scrap or Sponge Iron"
-            ]
-            }
-        """
-        invoice_data = json.loads(invoice_json_data)
-        line_items = invoice_data["line_items"]
-        vendor_name = invoice_data["vendor_details"]["name"]
-        invoice_description = f"Invoice from vendor {vendor_name}"
+    def find_best_vendor_match(self, vendor_name: str, vendor_name_list: list) -> Optional[tuple]:
+        """Returns the (vendor name, similarity score) of the closest vendor in the list, or None."""
+        output = self.llm.sentence_similarity(vendor_name, vendor_name_list)
 
-        gl_mapping = json.loads(gl_mapping_json_data)
+        if output and isinstance(output, list):
+            scores = output[0] if isinstance(output[0], list) else output
 
-        # setup LangChain model
-        model = self.client
+            if not isinstance(scores, list):
+                logger.error(f"Unexpected scores format: {type(scores)}")
+                return None
 
-        # define system + user prompt
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are an AI assistant that helps classify invoice line items for SAP G/L accounts.
-            You will be provided with invoice details, a line item description, and a mapping of example descriptions to G/L accounts.
-            Prioritize suggesting a G/L account from the provided mapping if the line item description is similar to any of the examples.
-            If no similar example is found in the mapping, analyze the 'products' description, vendor name, and overall invoice description to suggest a relevant G/L account based on common accounting practices.
-            Refer to the provided mapping of example descriptions to G/L accounts when making your suggestions.
-            """),
+            highest_score = max(scores)
+            best_index = scores.index(highest_score)
 
-            ("user", """Invoice Details:
-            Vendor Name: {vendor_name}
-            Invoice Description: {invoice_description}
-            Line Item Products: {products}
+            best_match = vendor_name_list[best_index]
 
-            G/L Account Mapping:
-            {gl_mapping_text}
+            logger.info(f"Best match found while classifying: {best_match}")
+            logger.info(f"Similarity score: {highest_score:.2%}")
+            logger.info(f"Index in list: {best_index}")
+            return best_match, highest_score
 
-            Classify this line item and suggest a G/L account from the mapping if applicable, otherwise suggest the most relevant G/L account.
-            """)
-        ])
+        logger.error(f"Invalid API response format: {type(output)}")
+        logger.error(f"Response content: {output}")
+        return None
 
-        # for Langchain chain
-        chain = prompt | model
+    def gl_account_classifier(self, session: DocumentSession):
+        invoice_data = session.get("extracted_details", {})
+        if isinstance(invoice_data, str):
+            invoice_data = json.loads(invoice_data)
+        return self.classify_gl_items(invoice_data)
+
+    @observe_stage("classifier")
+    def classify_gl_items(self, invoice_data: dict) -> list:
+        """Suggests a G/L account for every line item of the extracted invoice details."""
+        line_items = invoice_data.get("line_items") or []
+        vendor_name = invoice_data.get("vendor_details", {}).get("name", "")
+        invoice_description = f"Invoice from vendor {vendor_name}"
 
         # to find G/L account from mapping
         def get_gl_from_mapping(products, mapping):
@@ -334,52 +377,83 @@ class Classifier:
             return None
 
         classified_items = []
-        for item in line_items:
+        unmatched = {}
+        for index, item in enumerate(line_items):
+            item = dict(item)
             products = item.get("products")
 
             if products:
                 # direct mapping first
-                suggested_gl_account_raw = get_gl_from_mapping(products, gl_mapping)
+                suggested_gl_account_raw = get_gl_from_mapping(products, GL_MAPPING)
 
                 if suggested_gl_account_raw:
                     #  a match is found in the mapping, use it
                     item["suggested_gl_account"] = suggested_gl_account_raw
                     item["classification_source"] = "mapping"
-                    classified_items.append(item)
                 else:
-                    # no match in mapping, Langchain for suggestion
-                    try:
-                        response = chain.invoke({
-                            "products": products,
-                            "vendor_name": vendor_name,
-                            "invoice_description": invoice_description,
-                            "gl_mapping_text": json.dumps(gl_mapping, indent=2)
-                        })
-                        suggested_gl_account_model = response.content.strip()
-                        # Further process the string to extract the actual GL account name from the model's response
-                        extracted_name = suggested_gl_account_model
-                        if "**" in extracted_name:
-                            extracted_name = extracted_name.split("**")[-2].strip() # Get the text between the last two **
-                        else:
-                            # Fallback if the format changes
-                            extracted_name = extracted_name.split(".")[-1].strip()
-
-                        item["suggested_gl_account"] = extracted_name
-                        classified_items.append(item)
-
-                    except Exception as e:
-                        # to catch any exception during invoke and print details
-                        logger.error(f"Error during Langchain invocation for products: {products}")
-                        logger.error(f"Error type: {type(e).__name__}")
-                        logger.error(f"Error message: {e}")
-                        item["suggested_gl_account"] = f"Classification failed: {type(e).__name__}"
-                        item["classification_source"] = "error"
-                        classified_items.append(item)
+                    # no match in mapping, collected for a single batched model call
+                    unmatched[index] = products
             else:
                 item["suggested_gl_account"] = "OTHER"
                 item["classification_source"] = "no products"
-                classified_items.append(item)
-        return classified_items[0]['suggested_gl_account']
+            classified_items.append(item)
+
+        if unmatched:
+            suggestions = self.suggest_gl_accounts(unmatched, vendor_name, invoice_description)
+            for index in unmatched:
+                item = classified_items[index]
+                if index in suggestions:
+                    item["suggested_gl_account"] = suggestions[index]
+                    item["classification_source"] = "model"
+                else:
+                    item["suggested_gl_account"] = "Classification failed: no suggestion returned"
+                    item["classification_source"] = "error"
+
+        return classified_items
+
+    @observe_stage("classifier")
+    def suggest_gl_accounts(self, products_by_index: Dict[int, str], vendor_name: str, invoice_description: str) -> Dict[int, str]:
+        """
+        Suggests G/L accounts for all unmatched line items of an invoice in a single
+        schema-constrained model call. Returns a mapping of line item index to G/L account.
+        """
+        system = """You are an AI assistant that helps classify invoice line items for SAP G/L accounts.
+            You will be provided with invoice details, a numbered list of line item descriptions, and a mapping of example descriptions to G/L accounts.
+            Prioritize suggesting a G/L account from the provided mapping if the line item description is similar to any of the examples.
+            If no similar example is found in the mapping, analyze the 'products' description, vendor name, and overall invoice description to suggest a relevant G/L account based on common accounting practices.
+            Return exactly one suggestion per line item, using the line item's index.
+            """
+        line_items_text = "\n".join(f"{index}: {products}" for index, products in products_by_index.items())
+
+        prompt = f"""Invoice Details:
+            Vendor Name: {vendor_name}
+            Invoice Description: {invoice_description}
+
+            Line Items (index: products):
+            {line_items_text}
+
+            G/L Account Mapping:
+            {json.dumps(GL_MAPPING)}
+
+            Classify every line item and suggest a G/L account from the mapping if applicable, otherwise suggest the most relevant G/L account.
+            """
+
+        try:
+            response = self.llm.generate(prompt, stage="gl_classification", system=system, schema=GLSuggestions).parsed
+        except Exception as e:
+            logger.error(f"Error during batched G/L classification for {len(products_by_index)} line items: {type(e).__name__} - {e}")
+            return {}
+
+        # No parseable answer from the model; the lines are left for the caller to mark as failed
+        if response is None:
+            logger.error(f"No structured G/L suggestions returned for {len(products_by_index)} line items.")
+            return {}
+
+        suggestions = {}
+        for suggestion in response.suggestions:
+            if suggestion.index in products_by_index and suggestion.gl_account.strip():
+                suggestions[suggestion.index] = suggestion.gl_account.strip()
+        return suggestions
 
 
 # # Get API key from environment variables
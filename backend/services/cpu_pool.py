@@ -0,0 +1,221 @@
+"""
+Process pool for CPU-bound work: PyMuPDF page handling and rapidfuzz scoring over catalogs.
+
+Work run in the event loop or in to_thread workers holds the GIL, so a pod gets one core
+out of it however many it has. The pool runs one worker process per available core; CPU
+work is submitted from the event loop (run) or from threads (call) and the caller waits
+without holding the GIL.
+
+Catalogs (vendor names, item names) are published as versioned snapshots. Workers load a
+snapshot once and reuse it, so a lookup sends only its queries across the process
+boundary. Snapshots published before the pool starts are preloaded by every worker.
+"""
+import asyncio
+import atexit
+import hashlib
+import logging
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+from ..core.config import settings
+from . import cpu_tasks
+from .tracing import span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Older snapshots of a catalog are removed; in-flight tasks may still read the previous one
+SNAPSHOTS_KEPT = 2
+
+
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    name: str
+    version: str
+    path: str
+    size: int
+
+
+@dataclass
+class TaskRecord:
+    task: str
+    queued_seconds: float
+    run_seconds: float
+    outcome: str
+
+
+def available_cores() -> int:
+    """Cores this process may use: its CPU affinity, capped by a cgroup CPU quota (container limits)."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()[:2]
+            if limit != "max":
+                quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+    if quota:
+        cores = min(cores, max(1, int(quota)))
+    return max(1, cores)
+
+
+class CPUPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._snapshot_dir = tempfile.mkdtemp(prefix="cpu-pool-")
+        atexit.register(shutil.rmtree, self._snapshot_dir, True)
+        self._snapshots: dict[str, list[CatalogSnapshot]] = {}
+        self.workers = 0
+        self.submitted = 0
+        self.completed = 0
+        self.listeners: list[Callable[[TaskRecord], None]] = []
+
+    @property
+    def enabled(self) -> bool:
+        return settings.CPU_POOL_WORKERS != 0
+
+    def start(self):
+        """Starts the workers and waits until each has preloaded the published catalogs."""
+        if not self.enabled:
+            logger.info("CPU pool disabled (CPU_POOL_WORKERS=0); CPU work runs in the calling thread.")
+            return
+        with self._lock:
+            executor = self._ensure_executor()
+        # Submitting one task per worker makes the executor spawn all of them now
+        pids = {future.result() for future in [executor.submit(cpu_tasks.ready) for _ in range(self.workers)]}
+        logger.info(f"CPU pool ready with {len(pids)} worker processes.")
+
+    def stop(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _ensure_executor(self) -> ProcessPoolExecutor:
+        """Lock must be held."""
+        if self._executor is None:
+            self.workers = settings.CPU_POOL_WORKERS if settings.CPU_POOL_WORKERS > 0 else available_cores()
+            snapshots = [versions[-1] for versions in self._snapshots.values()]
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                # Forking a process that runs threads (event loop, Mongo monitors) can deadlock the child
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=cpu_tasks.init_worker,
+                initargs=(snapshots,)
+            )
+        return self._executor
+
+    def publish(self, name: str, choices: list[str]) -> CatalogSnapshot:
+        """Makes a catalog available to the workers; an unchanged catalog keeps its version."""
+        digest = hashlib.blake2b(digest_size=8)
+        for choice in choices:
+            digest.update(choice.encode("utf-8", "surrogatepass"))
+            digest.update(b"\0")
+        version = digest.hexdigest()
+        with self._lock:
+            versions = self._snapshots.setdefault(name, [])
+            if versions and versions[-1].version == version:
+                return versions[-1]
+            path = os.path.join(self._snapshot_dir, f"{name}-{version}.pickle")
+            with open(path, "wb") as f:
+                pickle.dump(choices, f, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot = CatalogSnapshot(name, version, path, len(choices))
+            versions.append(snapshot)
+            for stale in versions[:-SNAPSHOTS_KEPT]:
+                os.remove(stale.path)
+            del versions[:-SNAPSHOTS_KEPT]
+        logger.info(f"Published catalog '{name}' version {version} with {len(choices)} entries.")
+        return snapshot
+
+    def _submit(self, fn: Callable, args: tuple):
+        with self._lock:
+            executor = self._ensure_executor()
+            self.submitted += 1
+        try:
+            return executor.submit(cpu_tasks.timed, fn, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); replace the pool once
+            logger.error("CPU pool is broken; starting new workers.")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+                executor = self._ensure_executor()
+            return executor.submit(cpu_tasks.timed, fn, *args)
+
+    def _finished(self, task: str, submitted_at: float, timing: Optional[tuple], current_span) -> None:
+        with self._lock:
+            self.completed += 1
+        if timing is not None:
+            started, finished = timing
+            record = TaskRecord(task, max(0.0, started - submitted_at), finished - started, "success")
+        else:
+            record = TaskRecord(task, 0.0, time.monotonic() - submitted_at, "error")
+        if current_span is not None:
+            current_span.attributes["queued_ms"] = round(record.queued_seconds * 1000, 3)
+        for listener in self.listeners:
+            listener(record)
+
+    def call(self, task: str, fn: Callable, *args) -> Any:
+        """Runs fn(*args) in a worker and waits for it; for callers on worker threads."""
+        if not self.enabled:
+            return fn(*args)
+        with span(f"cpu_pool.{task}") as current:
+            submitted_at = time.monotonic()
+            try:
+                future = self._submit(fn, args)
+                result, started, finished = future.result()
+            except BaseException:
+                self._finished(task, submitted_at, None, current)
+                raise
+            self._finished(task, submitted_at, (started, finished), current)
+            return result
+
+    async def run(self, task: str, fn: Callable, *args) -> Any:
+        """Runs fn(*args) in a worker; for callers on the event loop."""
+        if not self.enabled:
+            return await asyncio.to_thread(fn, *args)
+        with span(f"cpu_pool.{task}") as current:
+            submitted_at = time.monotonic()
+            try:
+                future = self._submit(fn, args)
+                result, started, finished = await asyncio.wrap_future(future)
+            except BaseException:
+                self._finished(task, submitted_at, None, current)
+                raise
+            self._finished(task, submitted_at, (started, finished), current)
+            return result
+
+    def match(self, snapshot: CatalogSnapshot, queries: list[str], scorer: str = "ratio") -> list:
+        """Best (choice, score, index) of the catalog for every query, scored in one task."""
+        return self.call(f"match_{snapshot.name}", cpu_tasks.match_batch, snapshot, queries, scorer)
+
+    def stats(self) -> dict:
+        with self._lock:
+            in_flight = self.submitted - self.completed
+            # The executor does not say which tasks a worker has picked up; all beyond the workers wait
+            running = min(in_flight, self.workers)
+            return {"workers": self.workers, "running": running, "queued": in_flight - running}
+
+
+cpu_pool = CPUPool()
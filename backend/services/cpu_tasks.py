@@ -0,0 +1,107 @@
+"""
+Functions run inside the CPU pool's worker processes (see cpu_pool.py).
+
+Workers are started with the "spawn" method, so this module is all they import: keep it
+free of database clients, settings and the web app. Catalog snapshots are loaded once per
+worker and kept until a newer version of the same catalog arrives with a task.
+"""
+import os
+import pickle
+import time
+import fitz
+from rapidfuzz import fuzz, process
+
+SCORERS = {
+    "ratio": fuzz.ratio,
+    "WRatio": fuzz.WRatio,
+    "token_set_ratio": fuzz.token_set_ratio,
+}
+
+# name -> (version, choices), per worker process
+_catalogs: dict[str, tuple[str, list[str]]] = {}
+
+
+def init_worker(snapshots: list):
+    """Pool initializer: loads the catalogs published before the pool started."""
+    for snapshot in snapshots:
+        _catalog(snapshot)
+
+
+def _catalog(snapshot) -> list[str]:
+    cached = _catalogs.get(snapshot.name)
+    if cached is not None and cached[0] == snapshot.version:
+        return cached[1]
+    with open(snapshot.path, "rb") as f:
+        choices = pickle.load(f)
+    _catalogs[snapshot.name] = (snapshot.version, choices)
+    return choices
+
+
+def timed(fn, *args):
+    """Runs a task and returns it with its start and end on the monotonic clock, which is shared by all processes on Linux."""
+    started = time.monotonic()
+    result = fn(*args)
+    return result, started, time.monotonic()
+
+
+def ready() -> int:
+    return os.getpid()
+
+
+def match_batch(snapshot, queries: list[str], scorer: str) -> list:
+    """Best (choice, score, index) in the catalog for every query, or None for an empty query or catalog."""
+    choices = _catalog(snapshot)
+    score = SCORERS[scorer]
+    results = []
+    for query in queries:
+        best = process.extractOne(query, choices, scorer=score) if query and choices else None
+        results.append(tuple(best) if best else None)
+    return results
+
+
+def pdf_page_count(file_path: str) -> int:
+    with fitz.open(file_path) as document:
+        return document.page_count
+
+
+def split_pdf(file_path: str, chunk_pages: int, out_dir: str) -> list[tuple[str, int, int]]:
+    """Writes consecutive ranges of `chunk_pages` pages to separate PDFs; returns (path, first page, last page), 1-based."""
+    chunks = []
+    with fitz.open(file_path) as document:
+        for start in range(0, document.page_count, chunk_pages):
+            end = min(start + chunk_pages, document.page_count) - 1
+            path = os.path.join(out_dir, f"pages-{start + 1:04d}-{end + 1:04d}.pdf")
+            with fitz.open() as chunk:
+                chunk.insert_pdf(document, from_page=start, to_page=end)
+                # Drops the objects of the pages left behind, so each chunk carries only its own
+                chunk.save(path, garbage=3, deflate=True)
+            chunks.append((path, start + 1, end + 1))
+    return chunks
+
+
+def preflight_pdf(file_path: str, out_path: str, dpi: int, quality: int) -> dict:
+    """
+    Writes a smaller copy for OCR: page images above ~1.25x `dpi` are downsampled to `dpi` and
+    recompressed, attachments, metadata and thumbnails are removed and fonts are subset.
+    Text layers (including the invisible text of searchable scans) are kept.
+    """
+    with fitz.open(file_path) as document:
+        if document.needs_pass:
+            return {"applied": False, "reason": "encrypted"}
+        images = sum(len(page.get_images()) for page in document)
+        document.scrub(
+            attached_files=True, embedded_files=True, metadata=True, xml_metadata=True, thumbnails=True, javascript=True,
+            # Left alone: anything that changes what a page shows
+            clean_pages=False, hidden_text=False, redactions=False, remove_links=False, reset_fields=False, reset_responses=False
+        )
+        if images:
+            document.rewrite_images(dpi_threshold=dpi * 5 // 4, dpi_target=dpi, quality=quality)
+        document.subset_fonts()
+        document.save(out_path, garbage=4, deflate=True, deflate_images=True, deflate_fonts=True, use_objstms=1)
+        return {"applied": True, "pages": document.page_count, "images": images}
+
+
+def pdf_text_pages(file_path: str) -> list[str]:
+    """The text layer of every page."""
+    with fitz.open(file_path) as document:
+        return [page.get_text() for page in document]
@@ -0,0 +1,176 @@
+import copy
+import logging
+from typing import Any, Optional
+from backend.database import collection
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VERSION_FIELD = "version"
+_MISSING = object()
+
+
+class DocumentNotFound(Exception):
+    pass
+
+
+class DocumentConflict(Exception):
+    """Raised on flush when another writer changed the document after it was loaded."""
+
+
+class DocumentPathError(ValueError):
+    """Raised when a dotted path goes through a value that is neither a document nor a list."""
+
+
+class DocumentSession:
+    """
+    Unit of work for one document during one request. The document is read once, services
+    read and change it in memory with dotted paths (list indexes allowed, as in Mongo), and
+    flush() writes every changed path in a single update_one. The write only applies if the
+    document's version is still the one that was loaded, and bumps it.
+    """
+
+    def __init__(self, uid: int, document: dict, store=collection):
+        self.uid = uid
+        self.document = document
+        self.version = document.get(VERSION_FIELD)
+        self.store = store
+        self._set_paths: list[str] = []
+        self._unset_paths: list[str] = []
+
+    @classmethod
+    def load(cls, uid: int, projection: Optional[dict] = None, store=collection) -> "DocumentSession":
+        if projection is not None:
+            projection = {**projection, VERSION_FIELD: 1, "_id": 0}
+        document = store.find_one({"uid": uid}, projection if projection is not None else {"_id": 0})
+        if not document:
+            raise DocumentNotFound(f"Document with ID {uid} not found.")
+        return cls(uid, document, store)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._set_paths or self._unset_paths)
+
+    def get(self, path: str, default: Any = None) -> Any:
+        value = self.document
+        for key in path.split("."):
+            value = self._child(value, key)
+            if value is _MISSING:
+                return default
+        return value
+
+    def set(self, path: str, value: Any):
+        parent, key = self._parent(path, create=True)
+        if isinstance(parent, list):
+            index = self._index(path, key)
+            # Like Mongo, setting past the end of an array pads it with nulls
+            parent.extend([None] * (index + 1 - len(parent)))
+            parent[index] = value
+        else:
+            parent[key] = value
+        self._mark(path, self._set_paths)
+
+    def unset(self, path: str):
+        parent, key = self._parent(path, create=False)
+        if isinstance(parent, dict):
+            parent.pop(key, None)
+        self._mark(path, self._unset_paths)
+
+    def snapshot(self, path: str, default: Any = None) -> Any:
+        """Returns a copy of a value, for handing to code that must not change the session."""
+        return copy.deepcopy(self.get(path, default))
+
+    def fork(self) -> "DocumentSession":
+        """
+        Returns a session over a copy of the document, so independent stages can change
+        it from different threads. Their changes are brought back with merge().
+        """
+        fork = DocumentSession(self.uid, copy.deepcopy(self.document), self.store)
+        fork.version = self.version
+        return fork
+
+    def merge(self, other: "DocumentSession"):
+        """Applies the changed paths of a forked session to this one."""
+        for path in other._unset_paths:
+            self.unset(path)
+        for path in other._set_paths:
+            self.set(path, other.get(path))
+
+    def insert(self):
+        """Writes a document that is not stored yet, as one insert_one."""
+        self.version = 1
+        self.document[VERSION_FIELD] = self.version
+        self.store.insert_one({**self.document, "uid": self.uid})
+        logger.info(f"Inserted document ID {self.uid}.")
+        self._set_paths, self._unset_paths = [], []
+
+    def flush(self) -> bool:
+        """Writes the changed paths. Returns False when there was nothing to write."""
+        if not self.dirty:
+            return False
+
+        update = {"$inc": {VERSION_FIELD: 1}}
+        if self._set_paths:
+            update["$set"] = {path: self.get(path) for path in self._set_paths}
+        if self._unset_paths:
+            update["$unset"] = {path: "" for path in self._unset_paths}
+
+        version_filter = self.version if self.version is not None else {"$exists": False}
+        result = self.store.update_one({"uid": self.uid, VERSION_FIELD: version_filter}, update)
+        if result.matched_count == 0:
+            raise DocumentConflict(f"Document with ID {self.uid} was modified by another request.")
+
+        logger.info(f"Flushed {len(self._set_paths) + len(self._unset_paths)} path(s) for document ID {self.uid}.")
+        self.version = (self.version or 0) + 1
+        self.document[VERSION_FIELD] = self.version
+        self._set_paths, self._unset_paths = [], []
+        return True
+
+    def _child(self, value, key):
+        if isinstance(value, dict):
+            return value.get(key, _MISSING)
+        if isinstance(value, list) and key.isdigit() and int(key) < len(value):
+            return value[int(key)]
+        return _MISSING
+
+    def _index(self, path: str, key: str) -> int:
+        if not key.isdigit():
+            raise DocumentPathError(f"Cannot set '{path}': '{key}' is not an index into an array.")
+        return int(key)
+
+    def _parent(self, path: str, create: bool):
+        *parents, key = path.split(".")
+        value = self.document
+        for depth, part in enumerate(parents):
+            if create and not isinstance(value, (dict, list)):
+                prefix = ".".join(parents[:depth])
+                raise DocumentPathError(f"Cannot set '{path}': '{prefix}' is a {type(value).__name__}, not a document or an array.")
+            child = self._child(value, part)
+            if child is _MISSING or child is None:
+                if not create:
+                    return None, key
+                # The new subdocument is written as a whole: Mongo cannot create fields inside a null
+                child = {}
+                if isinstance(value, list):
+                    index = self._index(path, part)
+                    value.extend([None] * (index + 1 - len(value)))
+                    value[index] = child
+                else:
+                    value[part] = child
+                self._mark(".".join(parents[:depth + 1]), self._set_paths)
+            value = child
+        if create and not isinstance(value, (dict, list)):
+            raise DocumentPathError(f"Cannot set '{path}': '{'.'.join(parents)}' is a {type(value).__name__}, not a document or an array.")
+        return value, key
+
+    def _mark(self, path: str, paths: list):
+        # Mongo rejects an update that touches a path and its parent, so only the outermost path is kept
+        for existing in (self._set_paths, self._unset_paths):
+            existing[:] = [p for p in existing if p != path and not p.startswith(path + ".")]
+        ancestor = next((p for p in self._set_paths + self._unset_paths if path.startswith(p + ".")), None)
+        if ancestor is None:
+            paths.append(path)
+        elif ancestor in self._unset_paths and paths is self._set_paths:
+            # Setting inside a removed subtree writes the rebuilt subtree instead
+            self._unset_paths.remove(ancestor)
+            self._set_paths.append(ancestor)
@@ -0,0 +1,131 @@
+import logging
+from datetime import datetime
+from typing import Any, Callable, Optional
+import pandas as pd
+import yaml
+from .invoice_rules import parse_amount
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y")
+
+
+def to_str(value) -> str:
+    return str(value).strip()
+
+
+def to_number(value) -> Optional[float]:
+    return parse_amount(value)
+
+
+def to_int(value) -> Optional[int]:
+    number = parse_amount(value)
+    return int(number) if number is not None else None
+
+
+def to_date(value) -> Optional[str]:
+    """Normalizes a date to YYYY-MM-DD, the format SAP Service Layer expects."""
+    text = str(value).strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+CONVERTERS = {
+    "str": to_str,
+    "number": to_number,
+    "int": to_int,
+    "date": to_date,
+}
+
+
+def compile_path(path: Optional[str]) -> Callable[[Any], Any]:
+    """Compiles a dotted path such as 'vendor_details.name' into a getter."""
+    if not path:
+        return lambda data: None
+    keys = path.split(".")
+
+    def getter(data):
+        for key in keys:
+            if not isinstance(data, dict):
+                return None
+            data = data.get(key)
+        return data
+
+    return getter
+
+
+class CompiledField:
+    def __init__(self, name: str, rule: dict):
+        self.name = name
+        self.get = compile_path(rule.get("path"))
+        self.convert = CONVERTERS[rule.get("type", "str")]
+        self.default = rule.get("value")
+        self.llm_fallback = bool(rule.get("llm_fallback"))
+
+    def resolve(self, data) -> Any:
+        value = self.get(data)
+        if value is not None and str(value).strip() != "":
+            converted = self.convert(value)
+            if converted is not None:
+                return converted
+        if self.default is not None:
+            return self.default
+        return ""
+
+
+class SAPFieldMapper:
+    """
+    Maps extracted invoice details to SAP purchase invoice fields using the required-fields
+    CSV and a small rules file, without calling the model.
+    """
+
+    def __init__(self, required_fields_df: pd.DataFrame, rules: dict):
+        line_tables = {table.strip().upper() for table in rules.get("line_tables", [])}
+        header_rules = rules.get("header", {}) or {}
+        line_rules = (rules.get("lines", {}) or {}).get("fields", {}) or {}
+        self.line_source = compile_path((rules.get("lines", {}) or {}).get("source", "line_items"))
+
+        header_names, line_names = [], []
+        for _, row in required_fields_df.iterrows():
+            table, sap_field = row.iloc[1], row.iloc[2]
+            if pd.isna(sap_field) or pd.isna(table) or str(sap_field).strip() == "sap field name":
+                continue
+            target = line_names if str(table).strip().upper() in line_tables else header_names
+            target.append(str(sap_field).strip())
+
+        # Fields from the rules file that the CSV does not list are still mapped
+        header_names += [name for name in header_rules if name not in header_names]
+        line_names += [name for name in line_rules if name not in line_names]
+
+        self.header_fields = [CompiledField(name, header_rules.get(name, {})) for name in header_names]
+        self.line_fields = [CompiledField(name, line_rules.get(name, {})) for name in line_names]
+        logger.info(f"Compiled SAP field mapper with {len(self.header_fields)} header and {len(self.line_fields)} line fields.")
+
+    @classmethod
+    def from_files(cls, csv_path: str, rules_path: str) -> "SAPFieldMapper":
+        required_fields_df = pd.read_csv(csv_path).dropna(how='all')
+        with open(rules_path) as f:
+            rules = yaml.safe_load(f)
+        return cls(required_fields_df, rules)
+
+    def map(self, extracted_details: dict) -> tuple[dict, list]:
+        """
+        Returns the mapped SAP payload and the header fields that are still empty
+        and marked for model fallback.
+        """
+        mapped = {field.name: field.resolve(extracted_details) for field in self.header_fields}
+
+        line_items = self.line_source(extracted_details) or []
+        mapped["DocumentLines"] = [
+            {field.name: field.resolve(item) for field in self.line_fields}
+            for item in line_items
+            if isinstance(item, dict)
+        ]
+
+        missing = [field.name for field in self.header_fields if field.llm_fallback and mapped[field.name] == ""]
+        return mapped, missing
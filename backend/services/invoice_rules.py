@@ -0,0 +1,83 @@
+import re
+import logging
+from typing import Optional
+from pydantic import BaseModel
+from ..core.config import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+LC_PATTERN = re.compile(r"\bL\s*/?\s*C\b|\bletter\s+of\s+credit\b", re.IGNORECASE)
+IMPORT_PATTERN = re.compile(r"\bimport(ed)?\b|\bcustoms?\b|\bbill\s+of\s+lading\b|\bproforma\b|\bswift\b", re.IGNORECASE)
+AMOUNT_PATTERN = re.compile(r"\d[\d,]*(?:\.\d+)?")
+EMPTY_VALUES = {"", "-", "na", "n/a", "nil", "none", "null", "not available"}
+
+
+class ClassificationDecision(BaseModel):
+    label: str
+    confidence: Optional[float] = None
+    decided_by: str
+    rule: Optional[str] = None
+
+
+def parse_amount(value) -> Optional[float]:
+    """Converts an extracted amount such as 'Rs. 1,23,000.00' to a float."""
+    if value is None:
+        return None
+    # Take the first number so currency prefixes such as 'Rs.' don't leak a decimal point
+    match = AMOUNT_PATTERN.search(str(value))
+    if not match:
+        return None
+    return float(match.group(0).replace(",", ""))
+
+
+def has_value(value) -> bool:
+    return value is not None and str(value).strip().lower() not in EMPTY_VALUES
+
+
+def iter_strings(value):
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from iter_strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_strings(item)
+    elif isinstance(value, str):
+        yield value
+
+
+def classify_by_rules(invoice_json: dict) -> ClassificationDecision:
+    """
+    Classifies an invoice with local rules. Returns a decision with decided_by="rules"
+    and a confidence; callers send the document to the model when the confidence is
+    below settings.CLASSIFICATION_RULES_MIN_CONFIDENCE.
+    """
+    invoice_details = invoice_json.get("invoice_details") or {}
+    payment_details = invoice_json.get("payment_details") or {}
+    line_items = invoice_json.get("line_items") or []
+
+    grand_total = parse_amount(payment_details.get("grand_total"))
+    if grand_total is not None and grand_total < settings.OUTGOING_PAYMENT_THRESHOLD:
+        return ClassificationDecision(label="outgoing_payment", confidence=0.95, decided_by="rules", rule="grand_total_below_threshold")
+
+    if has_value(invoice_details.get("lc_no")):
+        return ClassificationDecision(label="ap_invoice_with_lc", confidence=0.99, decided_by="rules", rule="lc_no_present")
+
+    mode_of_payment = str(invoice_details.get("mode_of_payment") or "")
+    if LC_PATTERN.search(mode_of_payment):
+        return ClassificationDecision(label="ap_invoice_with_lc", confidence=0.9, decided_by="rules", rule="lc_in_mode_of_payment")
+
+    for item in line_items:
+        if isinstance(item, dict) and LC_PATTERN.search(str(item.get("products") or "")):
+            return ClassificationDecision(label="ap_invoice_with_lc", confidence=0.85, decided_by="rules", rule="lc_in_line_items")
+
+    # Weaker hints anywhere else in the document leave the decision to the model
+    document_text = " ".join(iter_strings(invoice_json))
+    if LC_PATTERN.search(document_text):
+        return ClassificationDecision(label="ap_invoice_with_lc", confidence=0.5, decided_by="rules", rule="lc_mentioned_elsewhere")
+    if IMPORT_PATTERN.search(document_text):
+        return ClassificationDecision(label="ap_invoice", confidence=0.5, decided_by="rules", rule="import_keywords")
+    if grand_total is None:
+        return ClassificationDecision(label="ap_invoice", confidence=0.6, decided_by="rules", rule="grand_total_unreadable")
+
+    return ClassificationDecision(label="ap_invoice", confidence=0.85, decided_by="rules", rule="no_lc_reference")
@@ -0,0 +1,344 @@
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Optional
+import httpx
+import orjson
+import requests
+from pydantic import BaseModel, TypeAdapter
+from ..core.config import settings
+from .rate_limiter import get_limiter
+from .tracing import span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+HF_SIMILARITY_URL = "https://router.huggingface.co/hf-inference/models/sentence-transformers/all-MiniLM-L6-v2/pipeline/sentence-similarity"
+
+
+class LLMResult(BaseModel):
+    text: str
+    parsed: Any = None
+    model: str
+    stage: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency_ms: float = 0
+    degraded: bool = False
+
+
+class CallRecord(BaseModel):
+    provider: str
+    stage: str
+    status: str
+    latency_ms: float
+    attempts: int
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+def status_code_of(error: Exception) -> Optional[int]:
+    """Reads the HTTP status from google-genai, Mistral, httpx and requests errors."""
+    for attr in ("code", "status_code"):
+        code = getattr(error, attr, None)
+        if isinstance(code, int):
+            return code
+    response = getattr(error, "response", None)
+    code = getattr(response, "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError, requests.Timeout, requests.ConnectionError, TimeoutError, ConnectionError)):
+        return True
+    return status_code_of(error) in RETRYABLE_STATUS_CODES
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class GeminiBackend:
+    """Single shared google-genai client, so HTTP connections are reused across calls."""
+
+    def __init__(self):
+        from google import genai
+        from google.genai import types
+        if not settings.GOOGLE_API_KEY:
+            raise ValueError("GOOGLE_API_KEY not found in environment variables")
+        self.client = genai.Client(
+            api_key=settings.GOOGLE_API_KEY,
+            http_options=types.HttpOptions(timeout=int(settings.LLM_TIMEOUT_SECONDS * 1000))
+        )
+
+    def generate(self, model: str, prompt: str, config: dict) -> tuple[str, int, int]:
+        response = self.client.models.generate_content(model=model, contents=prompt, config=config)
+        usage = response.usage_metadata
+        prompt_tokens = (usage.prompt_token_count or 0) if usage else 0
+        completion_tokens = (usage.candidates_token_count or 0) if usage else 0
+        return response.text or "", prompt_tokens, completion_tokens
+
+
+class FakeLLMBackend:
+    """
+    Local stand-in for tests and benchmarks. Returns canned responses registered per stage,
+    or a minimal JSON document matching the requested schema, after a configurable delay.
+    """
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.responses: dict[str, Any] = {}
+
+    def register(self, stage: str, response: Any):
+        """Registers a response for a stage: a string, a JSON-serializable object, or a callable taking the prompt."""
+        self.responses[stage] = response
+
+    def generate(self, model: str, prompt: str, config: dict, stage: str = "") -> tuple[str, int, int]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            raise httpx.HTTPStatusError(
+                "Fake LLM error",
+                request=httpx.Request("POST", "http://fake-llm"),
+                response=httpx.Response(503)
+            )
+
+        response = self.responses.get(stage)
+        if callable(response):
+            response = response(prompt)
+        if response is None:
+            schema = config.get("response_schema")
+            if schema is not None:
+                response = example_for_schema(TypeAdapter(schema).json_schema())
+            else:
+                response = example_for_schema(config["response_json_schema"]) if "response_json_schema" in config else "{}"
+        text = response if isinstance(response, str) else json.dumps(response)
+        return text, estimate_tokens(prompt), estimate_tokens(text)
+
+    def sentence_similarity(self, source: str, sentences: list[str]) -> list[float]:
+        """Stands in for the Hugging Face similarity model with rapidfuzz scores in [0, 1]."""
+        from rapidfuzz import fuzz, process, utils
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            raise httpx.HTTPStatusError(
+                "Fake similarity error",
+                request=httpx.Request("POST", "http://fake-llm"),
+                response=httpx.Response(503)
+            )
+        scores = process.cdist([source or ""], sentences, scorer=fuzz.WRatio, processor=utils.default_process)[0]
+        return [float(score) / 100 for score in scores]
+
+
+def example_for_schema(schema: dict, defs: Optional[dict] = None) -> Any:
+    """Builds the smallest value that validates against a pydantic JSON schema."""
+    defs = defs if defs is not None else schema.get("$defs", {})
+    if "$ref" in schema:
+        return example_for_schema(defs[schema["$ref"].split("/")[-1]], defs)
+    if "enum" in schema:
+        return schema["enum"][0]
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return example_for_schema(schema[key][0], defs)
+    schema_type = schema.get("type", "object")
+    if schema_type == "object":
+        return {name: example_for_schema(field, defs) for name, field in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        return [example_for_schema(schema.get("items", {}), defs)]
+    return {"string": "", "integer": 0, "number": 0, "boolean": False, "null": None}.get(schema_type, "")
+
+
+class LLMMetrics:
+    """Per provider/model and stage aggregates of every call made through the gateway."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: dict[tuple[str, str], dict] = {}
+        self.listeners: list[Callable[[CallRecord], None]] = []
+
+    def record(self, record: CallRecord):
+        with self._lock:
+            stats = self._stats.setdefault((record.provider, record.stage), {
+                "calls": 0, "errors": 0, "retries": 0, "latency_ms_total": 0.0, "latency_ms_max": 0.0,
+                "prompt_tokens": 0, "completion_tokens": 0
+            })
+            stats["calls"] += 1
+            stats["errors"] += record.status != "success"
+            stats["retries"] += record.attempts - 1
+            stats["latency_ms_total"] += record.latency_ms
+            stats["latency_ms_max"] = max(stats["latency_ms_max"], record.latency_ms)
+            stats["prompt_tokens"] += record.prompt_tokens
+            stats["completion_tokens"] += record.completion_tokens
+        for listener in self.listeners:
+            try:
+                listener(record)
+            except Exception as e:
+                logger.error(f"LLM metrics listener failed: {e}")
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            return [
+                {"provider": provider, "stage": stage, **stats,
+                 "latency_ms_avg": stats["latency_ms_total"] / stats["calls"] if stats["calls"] else 0}
+                for (provider, stage), stats in self._stats.items()
+            ]
+
+
+class LLMGateway:
+    """
+    The one way the service talks to model providers. Applies the shared per-model
+    limiter, timeouts, retries with backoff on 429/5xx, and records latency and tokens.
+    """
+
+    def __init__(self, backend_name: str = "gemini"):
+        self.backend_name = backend_name
+        self._backend = None
+        self._backend_lock = threading.Lock()
+        self.metrics = LLMMetrics()
+        # Token budgets and usage records; installed by backend.services.token_accounting
+        self.accounting = None
+
+    @property
+    def backend(self):
+        # Created on first use so importing the service does not require credentials
+        if self._backend is None:
+            with self._backend_lock:
+                if self._backend is None:
+                    if self.backend_name == "fake":
+                        self._backend = FakeLLMBackend(settings.FAKE_LLM_LATENCY_MS, settings.FAKE_LLM_ERROR_RATE)
+                    else:
+                        self._backend = GeminiBackend()
+                    logger.info(f"LLM gateway using '{self.backend_name}' backend.")
+        return self._backend
+
+    def call(self, provider: str, stage: str, fn: Callable[[], Any], usage: Optional[Callable[[Any], tuple[int, int]]] = None) -> Any:
+        """
+        Runs one provider request under the provider's limiter with retries and metrics.
+        `usage` may extract (prompt_tokens, completion_tokens) from the result.
+        """
+        with span(f"{provider}.{stage}") as current:
+            result, attempts = self._call(provider, stage, fn, usage)
+            if current is not None:
+                current.attributes["attempts"] = attempts
+            return result
+
+    def _call(self, provider: str, stage: str, fn: Callable[[], Any], usage: Optional[Callable[[Any], tuple[int, int]]]) -> tuple[Any, int]:
+        limiter = get_limiter(provider)
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                with limiter.limit():
+                    result = fn()
+            except Exception as e:
+                if attempt > settings.LLM_MAX_RETRIES or not is_retryable(e):
+                    latency_ms = (time.perf_counter() - started) * 1000
+                    self.metrics.record(CallRecord(provider=provider, stage=stage, status="error", latency_ms=latency_ms, attempts=attempt))
+                    logger.error(f"{provider} call for '{stage}' failed after {attempt} attempt(s): {type(e).__name__} - {e}")
+                    raise
+                delay = min(settings.LLM_BACKOFF_MAX_SECONDS, settings.LLM_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.0)
+                if status_code_of(e) == 429:
+                    # Slow every caller of this provider down, not just this one
+                    limiter.penalize(delay)
+                logger.warning(f"{provider} call for '{stage}' failed ({type(e).__name__}: {e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            latency_ms = (time.perf_counter() - started) * 1000
+            prompt_tokens, completion_tokens = usage(result) if usage else (0, 0)
+            self.metrics.record(CallRecord(
+                provider=provider, stage=stage, status="success", latency_ms=latency_ms, attempts=attempt,
+                prompt_tokens=prompt_tokens, completion_tokens=completion_tokens
+            ))
+            return result, attempt
+
+    def generate(self, prompt: str, *, stage: str, model: Optional[str] = None, system: Optional[str] = None,
+                 schema: Any = None, json_output: bool = False, temperature: Optional[float] = None,
+                 degrade: Optional[Callable[[int], str]] = None) -> LLMResult:
+        """
+        Generates a completion. With `schema` the provider's structured output mode is used and
+        the validated object is returned in `parsed`; a dict `schema` is taken as a JSON Schema
+        and the parsed JSON is returned as is. With `json_output` the raw JSON text is parsed.
+        `degrade` may shorten the prompt to a number of tokens when it would exceed the document's
+        token budget; without it such a prompt is rejected before it is sent.
+        """
+        model = model or settings.LLM_DEFAULT_MODEL
+        accounting = self.accounting
+        degraded = False
+        if accounting is not None:
+            prompt, estimated, degraded = accounting.admit(model, stage, prompt, system, degrade)
+        config = {}
+        if system:
+            config["system_instruction"] = system
+        if temperature is not None:
+            config["temperature"] = temperature
+        if isinstance(schema, dict):
+            config["response_mime_type"] = "application/json"
+            config["response_json_schema"] = schema
+        elif schema is not None:
+            config["response_mime_type"] = "application/json"
+            config["response_schema"] = schema
+        elif json_output:
+            config["response_mime_type"] = "application/json"
+
+        backend = self.backend
+        if isinstance(backend, FakeLLMBackend):
+            fn = lambda: backend.generate(model, prompt, config, stage=stage)
+        else:
+            fn = lambda: backend.generate(model, prompt, config)
+
+        started = time.perf_counter()
+        try:
+            text, prompt_tokens, completion_tokens = self.call(model, stage, fn, usage=lambda result: (result[1], result[2]))
+        except Exception:
+            if accounting is not None:
+                accounting.record(model, stage, prompt, estimated, 0, 0, (time.perf_counter() - started) * 1000, "error", degraded)
+            raise
+        latency_ms = (time.perf_counter() - started) * 1000
+        if accounting is not None:
+            accounting.record(model, stage, prompt, estimated, prompt_tokens, completion_tokens, latency_ms, "success", degraded)
+
+        parsed = None
+        if isinstance(schema, dict) or (schema is None and json_output):
+            parsed = orjson.loads(text)
+        elif schema is not None:
+            # Parsed and validated in one pass by pydantic-core
+            parsed = TypeAdapter(schema).validate_json(text)
+
+        return LLMResult(
+            text=text, parsed=parsed, model=model, stage=stage,
+            prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, latency_ms=latency_ms, degraded=degraded
+        )
+
+
+    def sentence_similarity(self, source: str, sentences: list[str], stage: str = "vendor_match") -> Any:
+        """Scores `sentences` against `source` with the Hugging Face sentence-similarity model."""
+        if self.backend_name == "fake":
+            backend = self.backend
+            return self.call("huggingface", stage, lambda: backend.sentence_similarity(source, sentences))
+
+        headers = {"Authorization": f"Bearer {settings.HF_API_KEY}"}
+
+        def query():
+            response = hf_session.post(
+                HF_SIMILARITY_URL,
+                headers=headers,
+                json={"inputs": {"source_sentence": source, "sentences": sentences}},
+                timeout=settings.LLM_TIMEOUT_SECONDS
+            )
+            response.raise_for_status()
+            return response.json()
+
+        return self.call("huggingface", stage, query)
+
+
+llm_gateway = LLMGateway(settings.LLM_BACKEND)
+
+# Pooled HTTP session for the Hugging Face inference API
+hf_session = requests.Session()
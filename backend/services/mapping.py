@@ -1,16 +1,17 @@
 import json
 import pandas as pd
 from pandas.errors import EmptyDataError
-from backend.database import collection
 from fastapi import HTTPException
 import logging
 from pydantic import BaseModel
-from rapidfuzz import fuzz, process
 from ..core.config import settings
-from google import genai
-import re
 from backend.services.sap_api import SAPClient
-import time
+from backend.services.llm_gateway import llm_gateway
+from backend.services.retrieval import ShortlistIndex
+from backend.services.document_session import DocumentSession
+from backend.services.cpu_pool import cpu_pool
+from backend.services.metrics import FUZZY_MATCH_FALLBACKS, SAP_ITEMS_CREATED, observe_stage
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,9 +27,30 @@ class AccountCode(BaseModel):
     
 
 class Mapper:
+    # Assigning either catalog publishes its lowercased names to the CPU pool workers
+    @property
+    def vendor_names_with_codes(self):
+        return self._vendor_names_with_codes
+
+    @vendor_names_with_codes.setter
+    def vendor_names_with_codes(self, vendors_df):
+        self._vendor_names_with_codes = vendors_df
+        self.vendor_catalog = None if vendors_df is None else cpu_pool.publish(
+            "vendors", vendors_df["CardName"].str.lower().dropna().tolist()
+        )
+
+    @property
+    def item_names_list(self):
+        return self._item_names_list
+
+    @item_names_list.setter
+    def item_names_list(self, names):
+        self._item_names_list = names
+        self.item_catalog = None if names is None else cpu_pool.publish("items", names)
+
     def __init__(self):
         self.sap_client = SAPClient()
-        self.gemini_client = genai.Client(api_key=settings.GOOGLE_API_KEY)
+        self.llm = llm_gateway
         self.sap_client.save_items_to_csv()
         self.sap_client.save_item_groups_to_csv()
         self.sap_client.save_business_partners()
@@ -52,18 +74,22 @@ class Mapper:
         try:
             item_groups_df = pd.read_csv('backend/assets/item_groups.csv')
             self.item_groups_string = item_groups_df.to_dict(orient='records')
+            self.item_groups_index = ShortlistIndex(self.item_groups_string, "Series", "GroupName")
             logger.info("Successfully loaded item_groups.csv for product group mapping.")
         except (FileNotFoundError, EmptyDataError):
             logger.error("Warning: 'item_groups.csv' not found or empty. Item group mapping will be disabled.")
             self.item_groups_string = None
+            self.item_groups_index = None
 
         try:
             uom_groups_df = pd.read_csv('backend/assets/uom_groups.csv')
             self.uom_groups_string = uom_groups_df.to_dict(orient='records')
+            self.build_uom_groups_index()
             logger.info("Successfully loaded uom_groups.csv for UoM group mapping.")
         except (FileNotFoundError, EmptyDataError):
             logger.error("Warning: 'uom_groups.csv' not found or empty. UoM group mapping will be disabled.")
             self.uom_groups_string = None
+            self.uom_groups_index = None
 
         try:
             with open('backend/assets/costing_codes.json') as f:
@@ -74,34 +100,44 @@ class Mapper:
         try:
             account_codes_df = pd.read_csv('backend/assets/account_codes.csv')
             self.account_codes_string = account_codes_df.to_dict(orient='records')
+            # Accounts SAP marks as "(Do Not Use)" are never offered as candidates
+            active_accounts = [record for record in self.account_codes_string if not str(record.get("Name")).lower().startswith("(do not use)")]
+            self.account_codes_index = ShortlistIndex(active_accounts, "AccountCode", "Name")
             logger.info("Successfully loaded account_codes.csv for account code mapping.")
         except (FileNotFoundError, EmptyDataError):
             logger.error("Warning: 'account_codes.csv' not found or empty. Account code mapping will be disabled.")
             self.account_codes_string = None
+            self.account_codes_index = None
+
+    def build_uom_groups_index(self):
+        """
+        Indexes UoM groups by their code and by the names of existing items in each group,
+        so a new item shortlists the groups that similar items already use.
+        """
+        item_names_by_group = {}
+        if self.item_list_df is not None:
+            for group_entry, names in self.item_list_df.dropna(subset=["ItemName"]).groupby("UoMGroupEntry")["ItemName"]:
+                item_names_by_group[int(group_entry)] = names.tolist()
+        self.uom_groups_index = ShortlistIndex(self.uom_groups_string, "UoMGroupEntry", "Code", item_names_by_group)
+
 
+    def generate_content(self, stage: str, model: str, contents: str, config: dict):
+        return self.llm.generate(contents, stage=stage, model=model, schema=config.get('response_schema'))
 
-    def find_similar_vendor(self, document_uid: int, threshold: int = 80):
+    @observe_stage("mapper")
+    def find_similar_vendor(self, session: DocumentSession, threshold: int = 80):
+        document_uid = session.uid
         try:
-            self.sap_client.save_business_partners()
-            
-            document_json = collection.find_one({"uid": document_uid}, {"_id": 0, "extracted_details": 1})
-            if not document_json:
-                raise HTTPException(status_code=404, detail=f"Document with UID {document_uid} not found.")
-            incoming_json_for_code = document_json.get("extracted_details", {})
+            incoming_json_for_code = session.get("extracted_details", {})
             if not incoming_json_for_code:
                 raise HTTPException(status_code=404, detail="No 'extracted_details' found in the document.")
 
             incoming_vendor_name = incoming_json_for_code['vendor_details']['name']
 
-            vendor_names_list = self.vendor_names_with_codes["CardName"].str.lower().dropna().tolist()
             # vendor_names = [name[0] for name in vendor_names_list]
             logger.info("Starting vendor name matching process.")
 
-            best_match = process.extractOne(
-                incoming_vendor_name.lower(), 
-                vendor_names_list, 
-                scorer=fuzz.ratio
-            )
+            best_match = cpu_pool.match(self.vendor_catalog, [incoming_vendor_name.lower()])[0]
             logger.info(best_match)
             
             if best_match and best_match[1] >= threshold:
@@ -111,32 +147,24 @@ class Mapper:
                 vendor_row = self.vendor_names_with_codes[self.vendor_names_with_codes["CardName"].str.lower() == matched_vendor_name]
                 if not vendor_row.empty:
                     vendor_code = vendor_row.iloc[0]['CardCode']
-                    collection.update_one(
-                        {"uid": document_uid},
-                        {"$set": {"extracted_details.vendor_details.code": vendor_code}}
-                    )
+                    session.set("extracted_details.vendor_details.code", vendor_code)
                     logger.info(f"Updated vendor code for document UID {document_uid} to '{vendor_code}' "
                             f"(matched '{incoming_vendor_name}' to '{matched_vendor_name}' with {similarity_score}% similarity).")
             else:
+                FUZZY_MATCH_FALLBACKS.labels("vendor").inc()
                 logger.warning(f"No similar vendor name found for '{incoming_vendor_name}' with sufficient similarity.")
         except Exception as e:
 
             logger.error(f"Error in find_similar_vendor: {e}")
 
-    def map_items_to_codes(self, document_uid: int):
-        self.sap_client.save_item_groups_to_csv()
-
+    @observe_stage("mapper")
+    def map_items_to_codes(self, session: DocumentSession):
         if self.item_list_df is None:
             logger.warning("Item list CSV not loaded. Skipping item code mapping.")
             return
         
         try:
-            document_json = collection.find_one({"uid": document_uid}, {"_id": 0, "extracted_details": 1})
-            if not document_json:
-                logger.error(f"Document with UID {document_uid} not found.")
-                return
-            
-            incoming_json = document_json.get("extracted_details", {})
+            incoming_json = session.get("extracted_details", {})
             if not incoming_json:
                 logger.error("No 'extracted_details' found in the document.")
                 return
@@ -146,68 +174,113 @@ class Mapper:
                 logger.warning("No line_items found in document.")
                 return
             
+            updates = {}
+            unknown_items = {}
+            unmapped = []
             for id, item in enumerate(line_items):
-                item_code = item.get('ItemCode')
                 item_desc = item.get('products')
                 if not item_desc:
                     logger.warning(f"No product description found for line item {id}")
                     continue
+                if not item.get('ItemCode'):
+                    unmapped.append((id, item_desc))
 
-                if not item_code:
-                    best_match = process.extractOne(
-                        item_desc.lower(), 
-                        self.item_names_list, 
-                        scorer=fuzz.ratio
-                    )
-                    logger.info(f"Best item match: {best_match}")
-
-                    if best_match and best_match[1] >= 80:
-                        matched_item_name = best_match[0]
-                        similarity_score = best_match[1]
-
-                        item_row = self.item_list_df[self.item_list_df["ItemName"].str.lower() == matched_item_name]
-                        if not item_row.empty:
-                            item_code = item_row.iloc[0]['ItemCode']
-                            uom_entry = int(item_row.iloc[0]['InventoryUoMEntry']) # Convert numpy.int64 to python int
-                            
-                            collection.update_one(
-                                {"uid": document_uid},
-                                {"$set": {f"extracted_details.line_items.{id}.ItemCode": item_code, f"extracted_details.line_items.{id}.UoMCode": uom_entry}}
-                            )
-                            logger.info(f"Mapped line item {id}: '{item_desc}' to ItemCode '{item_code}' "
-                                    f"(matched to '{matched_item_name}' with {similarity_score}% similarity).")
-                    else:
-                        logger.warning(f"No matching ItemCode found for line item {id}: '{item_desc}'")
-                        time.sleep(5) # Add a delay before creating a new item
-                        new_item_codes = self.create_new_items(item_desc)
-                        time.sleep(5) # Add a delay between API calls
-                        account_code_data = self.map_account_codes(item_desc)
-                        if new_item_codes and account_code_data:
-                            collection.update_one(
-                                {"uid": document_uid},
-                                {"$set": {f"extracted_details.line_items.{id}.ItemCode": new_item_codes['ItemCode'], f"extracted_details.line_items.{id}.UoMCode": new_item_codes['InventoryUoMEntry'], f"extracted_details.line_items.{id}.AccountCode": account_code_data['AccountCode']}}
-                            )
-                            logger.info(f"Created and mapped new item for line item {id}: '{item_desc}' with ItemCode '{new_item_codes['ItemCode']}'")
-                        else:
-                            logger.error(f"Failed to create or map account code for new item: '{item_desc}'")
-
-                time.sleep(1) # Add a 1-second delay to avoid hitting rate limits
+            # All lines of the document are scored in one pool task
+            best_matches = cpu_pool.match(self.item_catalog, [item_desc.lower() for _, item_desc in unmapped]) if unmapped else []
+            for (id, item_desc), best_match in zip(unmapped, best_matches):
+                logger.info(f"Best item match: {best_match}")
+
+                if best_match and best_match[1] >= 80:
+                    matched_item_name = best_match[0]
+                    similarity_score = best_match[1]
+
+                    item_row = self.item_list_df[self.item_list_df["ItemName"].str.lower() == matched_item_name]
+                    if not item_row.empty:
+                        item_code = item_row.iloc[0]['ItemCode']
+                        uom_entry = int(item_row.iloc[0]['InventoryUoMEntry']) # Convert numpy.int64 to python int
+                        
+                        updates[f"extracted_details.line_items.{id}.ItemCode"] = item_code
+                        updates[f"extracted_details.line_items.{id}.UoMCode"] = uom_entry
+                        logger.info(f"Mapped line item {id}: '{item_desc}' to ItemCode '{item_code}' "
+                                f"(matched to '{matched_item_name}' with {similarity_score}% similarity).")
+                else:
+                    FUZZY_MATCH_FALLBACKS.labels("item").inc()
+                    logger.warning(f"No matching ItemCode found for line item {id}: '{item_desc}'")
+                    # Lines with the same description share one new item
+                    unknown_items.setdefault(item_desc.lower(), (item_desc, []))[1].append(id)
+
+            if unknown_items:
+                updates.update(self.create_unknown_items(unknown_items))
+
+            for path, value in updates.items():
+                session.set(path, value)
 
         except Exception as e:
             logger.error(f"Error in map_items_to_codes: {e}")
+
+    @observe_stage("mapper")
+    def create_unknown_items(self, unknown_items: dict) -> dict:
+        """
+        Creates SAP items and maps account codes for unknown line items concurrently.
+        Pacing is left to the shared Gemini and SAP rate limiters.
+        """
+        updates = {}
+        with ThreadPoolExecutor(max_workers=settings.GEMINI_MAX_CONCURRENCY) as executor:
+            futures = {
+                key: (executor.submit(self.create_new_items, item_desc), executor.submit(self.map_account_codes, item_desc))
+                for key, (item_desc, _) in unknown_items.items()
+            }
+
+        # Any item SAP created must reach the in-memory list, even if its account code failed,
+        # or the next document with this description creates it again
+        created = False
+        for key, (new_item_future, account_code_future) in futures.items():
+            item_desc, ids = unknown_items[key]
+            new_item_codes = new_item_future.result()
+            account_code_data = account_code_future.result()
+            if new_item_codes:
+                SAP_ITEMS_CREATED.inc()
+                created = True
+            if new_item_codes and account_code_data:
+                for id in ids:
+                    updates[f"extracted_details.line_items.{id}.ItemCode"] = new_item_codes['ItemCode']
+                    updates[f"extracted_details.line_items.{id}.UoMCode"] = new_item_codes['InventoryUoMEntry']
+                    updates[f"extracted_details.line_items.{id}.AccountCode"] = account_code_data['AccountCode']
+                    logger.info(f"Created and mapped new item for line item {id}: '{item_desc}' with ItemCode '{new_item_codes['ItemCode']}'")
+            else:
+                logger.error(f"Failed to create or map account code for new item: '{item_desc}'")
+
+        if created:
+            self.reload_item_list()
+        return updates
+
+    @observe_stage("mapper")
+    def reload_item_list(self):
+        """Refreshes the item list from SAP once after new items were created."""
+        try:
+            self.item_list_df = self.sap_client.save_items_to_csv()
+            self.item_names_list = self.item_list_df["ItemName"].str.lower().dropna().to_list()
+            if self.uom_groups_string is not None:
+                self.build_uom_groups_index()
+        except Exception as e:
+            logger.error(f"Error refreshing item list after item creation: {e}")
             
+    @observe_stage("mapper")
     def create_new_items(self, item_description: str):
         try:
             logger.info(f"No item found. Creating new item for description: {item_description}")
-            response = self.gemini_client.models.generate_content(
+            item_groups = self.item_groups_index.search(item_description, settings.SHORTLIST_ITEM_GROUPS_K)
+            uom_groups = self.uom_groups_index.search(item_description, settings.SHORTLIST_UOM_GROUPS_K)
+            response = self.generate_content(
+                stage="item_creation",
                 model='gemini-2.5-flash-lite',
                 contents=f"""
                     You are given:
                     1. An item description: "{item_description}"
                     2. A reference list for item groups (used to determine Series):
-                    {self.item_groups_string}
+                    {item_groups}
                     3. A reference list for UoM groups (used to determine UoMGroupEntry from key: Code):
-                    {self.uom_groups_string}
+                    {uom_groups}
 
                     Your task:
                     1. Carefully analyze the item description and infer which category or group (from the item groups list) it most likely belongs to.
@@ -227,7 +300,14 @@ class Mapper:
                 }
             )
             new_item : list[Item] = response.parsed
+            allowed_series = self.item_groups_index.codes(item_groups)
+            allowed_uom_groups = self.uom_groups_index.codes(uom_groups)
             for item in new_item:
+                # Codes outside the shortlist were not offered to the model, so they are not trusted
+                if str(item.Series) not in allowed_series or str(item.UoMGroupEntry) not in allowed_uom_groups:
+                    logger.warning(f"Rejected new item for '{item_description}': Series {item.Series} or "
+                                   f"UoMGroupEntry {item.UoMGroupEntry} is not in the shortlist.")
+                    return None
                 item_data = {
                     "ItemName": item.ItemName,
                     "Series": item.Series,
@@ -240,9 +320,11 @@ class Mapper:
             logger.error(f"Error creating new item: {e}")
             return None
 
+    @observe_stage("mapper")
     def map_costing_code(self, item_name: str):
         try:
-            response = self.gemini_client.models.generate_content(
+            response = self.generate_content(
+                stage="costing_code",
                 model='gemini-2.5-flash-lite',
                 contents=f"""I have a list of cost_center_code, const_center_name, account_code, account_name: {json.dumps(self.costing_code)}. Please map the item name '{item_name}' to the appropriate cost_center_code and account code from the provided cost_center_name and account_name. Make references close as much as you can. Generate a JSON object with the item name and the corresponding cost_center_code and account_code. Give me in a plain json object without any markdown format. Do not hallucinate.
                 Example:
@@ -267,13 +349,16 @@ class Mapper:
         except Exception as e:
             logger.error(f"Error mapping costing code for item {item_name}: {e}")
             
+    @observe_stage("mapper")
     def map_account_codes(self, item_name:str):
         try:
-            response = self.gemini_client.models.generate_content(
+            account_codes = self.account_codes_index.search(item_name, settings.SHORTLIST_ACCOUNT_CODES_K)
+            response = self.generate_content(
+                stage="account_code",
                 model="gemini-2.5-flash-lite",
                 contents=f"""
                     You are given a list of account records containing 'AccountCode' and 'Name' fields:
-                    {self.account_codes_string}
+                    {account_codes}
 
                     Your task:
                     1. Analyze the provided list and identify which account category best matches the given item: "{item_name}".
@@ -290,7 +375,11 @@ class Mapper:
             mapped_data = response.text
             
             if mapped_data:
-                return json.loads(mapped_data)
+                account_code_data = json.loads(mapped_data)
+                if str(account_code_data.get("AccountCode")) not in self.account_codes_index.codes(account_codes):
+                    logger.warning(f"Rejected AccountCode {account_code_data.get('AccountCode')} for '{item_name}': not in the shortlist.")
+                    return None
+                return account_code_data
             return None
         
         except Exception as e:
@@ -0,0 +1,167 @@
+"""
+Prometheus metrics served at /metrics.
+
+Stage histograms cover the steps of OCR_Processor, Classifier and Mapper and the pipeline
+stages; dependency histograms cover every model, OCR, SAP and Mongo request. In-flight
+requests per dependency are read from the shared rate limiters when scraped, so the hot
+path pays for nothing but one histogram observation per call.
+"""
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+from .cpu_pool import TaskRecord, cpu_pool
+from .llm_gateway import CallRecord, llm_gateway
+from .rate_limiter import limiters
+from .tracing import record_span, span
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Model and OCR calls take tens of seconds; the default buckets stop at 10s
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+STAGE_SECONDS = Histogram(
+    "invoice_stage_duration_seconds", "Time spent in one processing step",
+    ["component", "stage"], buckets=LATENCY_BUCKETS
+)
+DEPENDENCY_SECONDS = Histogram(
+    "dependency_request_duration_seconds", "Time per request to an external dependency, retries included",
+    ["dependency", "operation", "outcome"], buckets=LATENCY_BUCKETS
+)
+LLM_RETRIES = Counter("llm_retries_total", "Provider calls repeated after a retryable error", ["provider", "stage"])
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens reported by the model providers", ["provider", "stage", "kind"])
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Lookups of stored results that can be reused", ["cache", "result"])
+FUZZY_MATCH_FALLBACKS = Counter("fuzzy_match_fallbacks_total", "Fuzzy matches below the threshold, handed to the next strategy", ["kind"])
+SAP_ITEMS_CREATED = Counter("sap_items_created_total", "Items created in SAP for unknown line items")
+PDF_PREFLIGHT_BYTES = Counter("pdf_preflight_bytes_total", "Size of PDFs before and after preflight, for files preflight shrank", ["version"])
+CPU_POOL_WAIT_SECONDS = Histogram(
+    "cpu_pool_queue_wait_seconds", "Time a task waited for a free worker process",
+    ["task"], buckets=LATENCY_BUCKETS
+)
+CPU_POOL_RUN_SECONDS = Histogram(
+    "cpu_pool_task_duration_seconds", "Time a worker process spent on a task",
+    ["task", "outcome"], buckets=LATENCY_BUCKETS
+)
+
+
+def observe_stage(component: str, stage: str = None):
+    """Decorator recording the wrapped function's duration under (component, stage), and as a trace span."""
+    def decorator(fn):
+        name = stage or fn.__name__
+        # Resolved once so a call costs a single observation
+        histogram = STAGE_SECONDS.labels(component, name)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with span(f"{component}.{name}"):
+                    return fn(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def sap_operation(method: str, url: str) -> str:
+    """'GET Items', 'POST $batch', 'PATCH PurchaseInvoices': the entity set without keys or query."""
+    path = urlparse(url).path.rstrip("/")
+    return f"{method} {path.rsplit('/', 1)[-1].split('(', 1)[0]}"
+
+
+def outcome_of(status_code: int) -> str:
+    return "success" if status_code < 400 else f"{status_code // 100}xx"
+
+
+@contextmanager
+def observe_sap(method: str, url: str):
+    """Times one SAP Service Layer request; the block sets `result["status_code"]`."""
+    result = {}
+    operation = sap_operation(method, url)
+    started = time.perf_counter()
+    try:
+        with span(f"sap {operation}") as current:
+            yield result
+            if current is not None:
+                current.attributes["status_code"] = result.get("status_code")
+    finally:
+        status_code = result.get("status_code")
+        outcome = outcome_of(status_code) if status_code is not None else "error"
+        DEPENDENCY_SECONDS.labels("sap", operation, outcome).observe(time.perf_counter() - started)
+
+
+def record_llm_call(record: CallRecord):
+    provider = record.provider
+    DEPENDENCY_SECONDS.labels(provider, record.stage, record.status).observe(record.latency_ms / 1000)
+    if record.attempts > 1:
+        LLM_RETRIES.labels(provider, record.stage).inc(record.attempts - 1)
+    if record.prompt_tokens:
+        LLM_TOKENS.labels(provider, record.stage, "prompt").inc(record.prompt_tokens)
+    if record.completion_tokens:
+        LLM_TOKENS.labels(provider, record.stage, "completion").inc(record.completion_tokens)
+
+
+def record_cpu_task(record: TaskRecord):
+    CPU_POOL_WAIT_SECONDS.labels(record.task).observe(record.queued_seconds)
+    CPU_POOL_RUN_SECONDS.labels(record.task, record.outcome).observe(record.run_seconds)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every command the driver sends and counts the ones still waiting for a reply."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def _finished(self, event, outcome: str):
+        with self._lock:
+            self.in_flight -= 1
+        DEPENDENCY_SECONDS.labels("mongo", event.command_name, outcome).observe(event.duration_micros / 1e6)
+        # Sync driver events fire on the calling thread, inside the caller's trace
+        record_span(f"mongo.{event.command_name}", event.duration_micros / 1000, outcome=outcome)
+
+    def started(self, event):
+        with self._lock:
+            self.in_flight += 1
+
+    def succeeded(self, event):
+        self._finished(event, "success")
+
+    def failed(self, event):
+        self._finished(event, "error")
+
+
+mongo_command_metrics = MongoCommandMetrics()
+
+
+class InFlightCollector:
+    """Requests holding a slot of each provider's limiter, outstanding Mongo commands and CPU pool tasks."""
+
+    def collect(self):
+        family = GaugeMetricFamily("dependency_requests_in_flight", "Requests currently in flight per dependency", labels=["dependency"])
+        for name, limiter in list(limiters.items()):
+            family.add_metric([name], limiter.in_flight)
+        family.add_metric(["mongo"], mongo_command_metrics.in_flight)
+        yield family
+
+        stats = cpu_pool.stats()
+        yield GaugeMetricFamily("cpu_pool_workers", "Worker processes of the CPU pool", value=stats["workers"])
+        tasks = GaugeMetricFamily("cpu_pool_tasks", "CPU pool tasks by state", labels=["state"])
+        tasks.add_metric(["running"], stats["running"])
+        tasks.add_metric(["queued"], stats["queued"])
+        yield tasks
+
+
+REGISTRY.register(InFlightCollector())
+llm_gateway.metrics.listeners.append(record_llm_call)
+cpu_pool.listeners.append(record_cpu_task)
+
+
+def render_metrics() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,13 +1,24 @@
+import base64
+import contextvars
 import os
-import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 from mistralai import Mistral
 from dotenv import load_dotenv
-from ..models import OCRResponse
+from pydantic import BaseModel, ValidationError
+from ..models import InvoiceExtraction, OCRResponse
 from ..database import  add_default_prompt
 from ..core.config import settings
 import logging
 # from google import genai 
-from langchain_google_genai import ChatGoogleGenerativeAI
+from .llm_gateway import llm_gateway
+from .metrics import observe_stage
+from . import cpu_tasks
+from .cpu_pool import cpu_pool
+from .pdf_preflight import preflighted
+from .tracing import span
+from .token_accounting import truncate_middle
 
 
 logging.basicConfig(level=logging.INFO)
@@ -32,27 +43,45 @@ load_dotenv()
 
 class OCR_Processor:
     def __init__(self):
-        api_key = settings.MISTRAL_API_KEY
-        if not api_key:
-            logger.critical("MISTRAL_API_KEY is not set or is empty in environment variables")
-            raise ValueError("MISTRAL_API_KEY is not set or is empty in environment variables")
-        self.client = Mistral(api_key=api_key)
+        self.fake_ocr = None
+        if settings.OCR_BACKEND == "fake":
+            from ..testing.fake_ocr import FakeOCR
+            self.fake_ocr = FakeOCR(settings.FAKE_OCR_LATENCY_MS, settings.FAKE_OCR_ERROR_RATE)
+            self.client = None
+        else:
+            api_key = settings.MISTRAL_API_KEY
+            if not api_key:
+                logger.critical("MISTRAL_API_KEY is not set or is empty in environment variables")
+                raise ValueError("MISTRAL_API_KEY is not set or is empty in environment variables")
+            self.client = Mistral(api_key=api_key, timeout_ms=int(settings.OCR_TIMEOUT_SECONDS * 1000))
         self.ocr_model = "mistral-ocr-latest"
         # self.gemini_client = genai.Client(api_key=settings.GEMINI_API_KEY)
-        self.llm = ChatGoogleGenerativeAI(temperature=0, model="gemini-2.5-flash-lite", api_key=settings.GOOGLE_API_KEY, max_tokens=None, timeout=None, max_retries=2)
+        self.llm = llm_gateway
         self.model = "mistral-small-latest"
-        logger.info(f"OCR_Processor initialized with model: {self.ocr_model} {self.llm.model}") 
+        logger.info(f"OCR_Processor initialized with model: {self.ocr_model} {settings.LLM_DEFAULT_MODEL}") 
 
-    def extract_raw_text_from_pdf(self, file_path):
-        """Uploads the PDF and extracts raw text using Mistral."""
-        if not os.path.exists(file_path):
-            logger.warning(f"Filepath not found: {file_path}")
-            raise FileNotFoundError(f"File not found: {file_path}")
-        
-        try:
+    def ocr_pages(self, file_path) -> list[str]:
+        """Runs OCR on one PDF and returns the markdown of each of its pages."""
+        if self.fake_ocr is not None:
+            return self.llm.call("mistral", "ocr_process", lambda: self.fake_ocr.process(file_path))
+
+        if os.path.getsize(file_path) <= settings.OCR_INLINE_MAX_BYTES:
+            # Small documents skip the upload and signed-URL round trips
             with open(file_path, "rb") as f:
-                uploaded_pdf = self.client.files.upload(
+                document_url = "data:application/pdf;base64," + base64.b64encode(f.read()).decode("ascii")
+            ocr_response = self.llm.call("mistral", "ocr_process", lambda: self.client.ocr.process(
+                model = self.ocr_model,
+                document = {
+                    "type": "document_url",
+                    "document_url": document_url
+                },
+                include_image_base64 = True
+            ))
+            return [page.markdown for page in ocr_response.pages]
 
+        def upload():
+            with open(file_path, "rb") as f:
+                return self.client.files.upload(
                     file={
                         "file_name": os.path.basename(file_path),
                         "content": f,
@@ -60,65 +89,121 @@ class OCR_Processor:
                     purpose="ocr"
                 )
 
-            logger.info(f"Successfully uploaded {uploaded_pdf.filename} for OCR processing")
+        uploaded_pdf = self.llm.call("mistral", "ocr_upload", upload)
 
-            signed_url = self.client.files.get_signed_url(file_id=uploaded_pdf.id)
-            
-            ocr_response = self.client.ocr.process(
+        logger.info(f"Successfully uploaded {uploaded_pdf.filename} for OCR processing")
+
+        try:
+            signed_url = self.llm.call("mistral", "ocr_signed_url", lambda: self.client.files.get_signed_url(file_id=uploaded_pdf.id))
+
+            ocr_response = self.llm.call("mistral", "ocr_process", lambda: self.client.ocr.process(
                 model = self.ocr_model,
                 document = {
                     "type": "document_url",
                     "document_url": signed_url.url
                 },
                 include_image_base64 = True
-            )
+            ))
+        finally:
+            if settings.OCR_DELETE_UPLOADS:
+                self.delete_upload(uploaded_pdf.id)
+
+        # messages = [
+        #     {
+        #         "role": "user",
+        #         "content": [
+        #             {
+        #                 "type": "text",
+        #                 "text": "You are an intelligent document parser, and your role is to extract the text from the PDF below as you read naturally. Do not hallucinate."
+        #             },
+        #             {
+        #                 "type": "document_url",
+        #                 "document_url": signed_url.url
+        #             }
+        #         ]
+        #     }
+        # ]
 
-            # messages = [
-            #     {
-            #         "role": "user",
-            #         "content": [
-            #             {
-            #                 "type": "text",
-            #                 "text": "You are an intelligent document parser, and your role is to extract the text from the PDF below as you read naturally. Do not hallucinate."
-            #             },
-            #             {
-            #                 "type": "document_url",
-            #                 "document_url": signed_url.url
-            #             }
-            #         ]
-            #     }
-            # ]
-
-            # chat_response = self.client.chat.complete(
-            #     model= self.model,
-            #     messages=messages
-            # )
-
-            logger.info("Extracted text from PDF using OCR model")
+        # chat_response = self.client.chat.complete(
+        #     model= self.model,
+        #     messages=messages
+        # )
+
+        return [page.markdown for page in ocr_response.pages]
+
+    def delete_upload(self, file_id):
+        """Removes an uploaded PDF from Mistral; a failure is logged, the OCR result is kept."""
+        try:
+            self.llm.call("mistral", "ocr_delete", lambda: self.client.files.delete(file_id=file_id))
+        except Exception as e:
+            logger.warning(f"Could not delete uploaded file {file_id} from Mistral: {e}")
+
+    def ocr_chunk(self, file_path, first_page, last_page) -> list[str]:
+        """OCRs one page range, retrying it alone when it fails after the gateway's own retries."""
+        with span("ocr.chunk", pages=f"{first_page}-{last_page}"):
+            for attempt in range(1, settings.OCR_CHUNK_ATTEMPTS + 1):
+                try:
+                    return self.ocr_pages(file_path)
+                except Exception as e:
+                    if attempt >= settings.OCR_CHUNK_ATTEMPTS:
+                        raise
+                    logger.warning(f"OCR of pages {first_page}-{last_page} failed ({e}); retrying the chunk (attempt {attempt + 1}).")
+
+    @observe_stage("ocr")
+    def extract_raw_text_from_pdf(self, file_path):
+        """
+        Extracts the text of every page with Mistral OCR from the preflight copy of the PDF.
+        PDFs longer than OCR_CHUNK_PAGES are split into page ranges that are OCR'd concurrently
+        and joined back in page order.
+        """
+        if not os.path.exists(file_path):
+            logger.warning(f"Filepath not found: {file_path}")
+            raise FileNotFoundError(f"File not found: {file_path}")
+        
+        try:
+            with preflighted(file_path) as ocr_path:
+                chunk_pages = settings.OCR_CHUNK_PAGES
+                page_count = cpu_pool.call("pdf_page_count", cpu_tasks.pdf_page_count, ocr_path) if chunk_pages > 0 else 0
+                if page_count <= chunk_pages:
+                    pages = self.ocr_pages(ocr_path)
+                else:
+                    with tempfile.TemporaryDirectory(prefix="ocr-chunks-") as chunk_dir:
+                        chunks = cpu_pool.call("pdf_split", cpu_tasks.split_pdf, ocr_path, chunk_pages, chunk_dir)
+                        logger.info(f"Split {page_count} pages into {len(chunks)} chunks for OCR")
+                        with ThreadPoolExecutor(max_workers=max(1, settings.OCR_CHUNK_CONCURRENCY)) as executor:
+                            # Each chunk runs in a copy of this context, so its spans and token budget stay with the request
+                            futures = [executor.submit(contextvars.copy_context().run, self.ocr_chunk, *chunk) for chunk in chunks]
+                            pages = [page for future in futures for page in future.result()]
+
+            logger.info(f"Extracted text from {len(pages)} PDF pages using OCR model")
 
             # return chat_response.choices[0].message.content
-            # print(ocr_response.pages[0].markdown)
-            return ocr_response.pages[0].markdown
+            return "\n\n".join(pages)
 
         except Exception as e:
             logger.error(f"Error during PDF text extraction: {e}")
             raise
 
-    def extract_vendor_details(self, raw_text, user_prompt=""):
+    @observe_stage("ocr")
+    def extract_vendor_details(self, raw_text, user_prompt="", response_schema=None) -> dict:
+        """
+        Returns the structured details of the document. The default prompt is answered in the
+        InvoiceExtraction schema; a user prompt in JSON mode, or in its own `response_schema`.
+        """
         try:
             if user_prompt.strip():
                 logger.info("Using custom user prompt for extraction")
+                schema = response_schema
                 prompt_template = f"""
                 {user_prompt.strip()}
         Text:
         {raw_text}
-
-        Important: Return ONLY the raw JSON object without any markdown formatting or code blocks. NO explanations, no headings, no extra text.
         """
             else:
                 logger.info("Using default prompt for extracting in json format")
+                schema = InvoiceExtraction
                 prompt_template = f"""
-                You are an expert document parser specializing in commercial documents like invoices, bills, etc. Extract the following structured data from the document text and return it as pure JSON without any markdown formatting or code blocks:
+                You are an expert document parser specializing in commercial documents like invoices, bills, etc. Extract the following structured data from the document text:
                         - vendor_details: name, address, phone, email, website, PAN
                         - customer_details: name, address, contact, PAN (usually below vendor_details)
                         - invoice_details: bill_number, bill_date, transaction_date, mode_of_payment, finance_manager, authorized_signatory
@@ -129,91 +214,36 @@ class OCR_Processor:
                                 2. If a field is missing, set its value as "".
                                 3. Use context ('Vendor', 'Supplier', 'Bill To', 'Customer', etc.) to distinguish parties. If unclear, the first business is Vendor,                        the second is Customer.
                                 4. Each line_item must include hs_code and description; qty, rate, and amount are optional.
-                                5. Always return the result strictly in the following JSON structure.
+                                5. Always return the result in the response schema; its field descriptions say what each field holds.
                                 6. PAN numbers are typically boxed or near labels like 'PAN No.', and follow a 9-digit (Nepal) format.
                                 7. For Dates put - between year, month and day like YYYY-MM-DD, if the date exceeds 2080 then convert the following Bikram Sambat (BS) date to the Gregorian (AD) calendar.
-                                8. Return  JSON without any markdown formatting or code blocks.
-
-                                Return the standard structured JSON format shown below:
-                                {{
-                                    "vendor_details": {{
-                                    "name": "",
-                                    "address": "", 
-                                    "contact_number": "", 
-                                    "email": "",
-                                    "website": "",
-                                    "pan_number": "" // This is the pan number/ VAT number of a company
-                                    }},
-                                    "customer_details": {{
-                                        "name": "",
-                                        "address": "",
-                                        "contact_number": "",
-                                        "pan_number": ""// This is the pan number/ VAT number of a company
-                                    }},
-                                    "invoice_details": {{
-                                        "bill_number": "",
-                                        "bill_date": "",
-                                        "nepali_miti": "", // This is the date in nepali calendar if available
-                                        "mode_of_payment": "",
-                                        "finance_manager": "",
-                                        "authorized_signatory": "",
-                                        "lc_no": "" // This is the letter of credit number of the company 
-                                    }},
-                                    "payment_details": {{
-                                        "net_amount": "",  // It can also be taxable total amount or this is the before taxes discount and vat
-                                        "discount_amount": "" , // this should be in amount not percentage
-                                        "taxable_amount": "" , // this should be in amount not percentage and it is after taxes
-                                        "vat_percentage": "", // this should be in percentage
-                                        "vat_amount": "", // this should be in amount not percentage it is only the vat percentage of the net amount
-                                        "grand_total": "",  // This is the last amount after all calculations such as after adding vat_amount taxable_amount and decreasing discount_amount and the amount should be equal to total amount in words
-                                        "grand_total_in_words": "",
-                                    }},
-                                    "line_items": [
-                                        {{
-                                        "hs_code": "",
-                                        "products": "", // This is the line items of a bill in a tabular for which can be a product or a service
-                                        "quantity": "",
-                                        "rate": "",
-                                        "amount": ""
-                                        }}
-                                    ]
-                                    }}
                                     Text:
                                     {raw_text}
-
-                                    Important: Return ONLY the standard JSON schema object without any markdown formatting or code blocks. No explanations, no headings, no extra text.
                                     """
                 add_default_prompt(prompt_template)
 
-            messages = [
-                {
-                    "role": "user",
-                    "content": prompt_template
-                }
-            ]
-            
-            output = self.llm.invoke(prompt_template)  
-
-            # chat_response = self.gemini_client.models.generate_content(
-            #     model="gemini-2.5-flash",
-            #     contents=prompt_template,
-            #     config = {
-            #         "response_mime_type": "application/json",
-            #     }
-            # )
-            # # output = chat_response.choices[0].message.content
-            # output = chat_response.text
+            def fit_to_budget(tokens):
+                # Over the document's token budget: keep the instructions, shorten the OCR text
+                instructions = len(prompt_template) - len(raw_text)
+                return prompt_template.replace(raw_text, truncate_middle(raw_text, max(0, tokens * 4 - instructions)), 1)
 
+            # The provider's JSON mode returns bare JSON, so there are no fences or prose to strip
+            output = self.llm.generate(
+                prompt_template, stage="extraction", temperature=0,
+                schema=schema, json_output=schema is None, degrade=fit_to_budget
+            )
             logger.info("Extracted vendor details using OCR model")
 
-            # return json.loads(output)
-            return output.content
-            
+            if isinstance(output.parsed, BaseModel):
+                return output.parsed.model_dump()
+            return output.parsed
+
         except Exception as e:
             logger.error(f"Error during vendor details extraction: {e}")
             raise
 
-    def process_file(self, file_path, user_prompt="") -> OCRResponse:
+    @observe_stage("ocr")
+    def process_file(self, file_path, user_prompt="", response_schema=None) -> OCRResponse:
         try:
             # Validate file path
             if not file_path or not file_path.strip():
@@ -246,66 +276,8 @@ class OCR_Processor:
                     extracted_text=""
                 )
             
-            result = self.extract_vendor_details(text, user_prompt)
-            
-            # Validate result before processing
-            if not result or not result.strip():
-                logger.error("Empty result from vendor details extraction")
-                return OCRResponse(
-                    status="error",
-                    message="Model returned empty response for data extraction",
-                    content={},
-                    extracted_text=text
-                )
+            return self.structure_text(text, user_prompt, response_schema)
 
-            if isinstance(result, str):
-                try:
-                    # Clean the result before parsing
-                    cleaned_result = result.strip()
-                    
-                    # Remove markdown formatting if present
-                    if cleaned_result.startswith("```json"):
-                        cleaned_result = cleaned_result[7:]
-                    elif cleaned_result.startswith("```"):
-                        cleaned_result = cleaned_result[3:]
-                    
-                    if cleaned_result.endswith("```"):
-                        cleaned_result = cleaned_result[:-3]
-                    
-                    cleaned_result = cleaned_result.strip()
-                    
-                    # Final check for empty result
-                    if not cleaned_result:
-                        logger.error("Result is empty after cleaning")
-                        return OCRResponse(
-                            status="error",
-                            message="Empty response from model after cleaning",
-                            content={"raw_response": result},
-                            extracted_text=text
-                        )
-                    
-                    result = json.loads(cleaned_result)
-                    logger.info("Successfully parsed JSON response from model")
-                except json.JSONDecodeError as e:
-                    logger.error(f"JSON parsing error: {e}")
-                    logger.error(f"Raw result: {repr(result)}")
-                    return OCRResponse(
-                        status="error",
-                        message=f"Failed to parse JSON from result: {e}",
-                        content={
-                            "raw_response": result,
-                            "cleaned_response": cleaned_result if 'cleaned_result' in locals() else result
-                        },
-                        extracted_text=text
-                    )
-                
-            return OCRResponse(
-                status="success",
-                message="Text extracted and structured successfully",
-                content=result,
-                extracted_text=text
-            )
-            
         except FileNotFoundError as e:
             logger.error(f"File not found: {e}")
             return OCRResponse(
@@ -323,5 +295,54 @@ class OCR_Processor:
                 extracted_text=""
             )
 
+    @observe_stage("ocr")
+    def structure_text(self, text, user_prompt="", response_schema=None) -> OCRResponse:
+        """Turns OCR text into the structured invoice JSON; the second half of process_file."""
+        try:
+            result = self.extract_vendor_details(text, user_prompt, response_schema)
+        except (ValidationError, orjson.JSONDecodeError) as e:
+            logger.error(f"Model response did not match the extraction schema: {e}")
+            return OCRResponse(
+                status="error",
+                message=f"Model response did not match the extraction schema: {e}",
+                content={},
+                extracted_text=text
+            )
+        except Exception as e:
+            logger.error(f"Unexpected error during data extraction: {e}")
+            return OCRResponse(
+                status="error",
+                message=f"Unexpected error during data extraction: {str(e)}",
+                content={},
+                extracted_text=text
+            )
+
+        if not isinstance(result, dict) or not result:
+            logger.error("Model returned no JSON object for data extraction")
+            return OCRResponse(
+                status="error",
+                message="Model returned no JSON object for data extraction",
+                content={"raw_response": result} if result else {},
+                extracted_text=text
+            )
+
+        logger.info("Successfully parsed JSON response from model")
+        return OCRResponse(
+            status="success",
+            message="Text extracted and structured successfully",
+            content=result,
+            extracted_text=text
+        )
 
 
+def parse_response_schema(schema_text):
+    """Reads the JSON Schema a caller declares for a custom prompt; None when none is given."""
+    if not schema_text or not schema_text.strip():
+        return None
+    try:
+        schema = orjson.loads(schema_text)
+    except orjson.JSONDecodeError as e:
+        raise ValueError(f"response_schema is not valid JSON: {e}")
+    if not isinstance(schema, dict):
+        raise ValueError("response_schema must be a JSON Schema object")
+    return schema
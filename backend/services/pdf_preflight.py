@@ -0,0 +1,68 @@
+"""
+Preflight of uploaded PDFs before they are sent to OCR.
+
+Phone scans arrive as 600-dpi page images; OCR reads them as well at 200 dpi. The preflight
+copy is written with PyMuPDF in the CPU pool and only replaces the upload for OCR when it is
+smaller. The original upload is kept unchanged in GridFS (database.store_original_upload).
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from ..core.config import settings
+from . import cpu_tasks
+from .cpu_pool import cpu_pool
+from .metrics import PDF_PREFLIGHT_BYTES
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def run_preflight(file_path: str, out_path: str) -> dict:
+    """Writes the preflight copy of `file_path` to `out_path` and returns what changed."""
+    started = time.perf_counter()
+    result = cpu_pool.call(
+        "pdf_preflight", cpu_tasks.preflight_pdf, file_path, out_path,
+        settings.PDF_PREFLIGHT_DPI, settings.PDF_PREFLIGHT_JPEG_QUALITY
+    )
+    result["original_bytes"] = os.path.getsize(file_path)
+    result["optimized_bytes"] = os.path.getsize(out_path) if result["applied"] else result["original_bytes"]
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+@contextmanager
+def preflighted(file_path: str):
+    """Yields the path to send to OCR: the preflight copy when it is smaller, otherwise the upload itself."""
+    original_bytes = os.path.getsize(file_path)
+    if not settings.PDF_PREFLIGHT or original_bytes < settings.PDF_PREFLIGHT_MIN_BYTES:
+        yield file_path
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="preflight-")
+    try:
+        out_path = os.path.join(work_dir, os.path.basename(file_path))
+        try:
+            result = run_preflight(file_path, out_path)
+        except Exception as e:
+            # A PDF PyMuPDF cannot rewrite is still worth sending as it is
+            logger.warning(f"Preflight failed for {os.path.basename(file_path)}; sending the original: {e}")
+            result = {"applied": False, "reason": str(e)}
+
+        if not result["applied"] or result["optimized_bytes"] >= original_bytes:
+            logger.info(f"Preflight kept {os.path.basename(file_path)} as uploaded ({result.get('reason', 'no saving')}).")
+            yield file_path
+            return
+
+        saved = original_bytes - result["optimized_bytes"]
+        PDF_PREFLIGHT_BYTES.labels("original").inc(original_bytes)
+        PDF_PREFLIGHT_BYTES.labels("optimized").inc(result["optimized_bytes"])
+        logger.info(
+            f"Preflight of {os.path.basename(file_path)}: {original_bytes} -> {result['optimized_bytes']} bytes "
+            f"({saved} saved, {saved / original_bytes:.0%}) in {result['seconds']}s"
+        )
+        yield out_path
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
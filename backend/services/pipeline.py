@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Optional
+from backend.core.config import settings
+from backend.database import next_document_uid, store_original_upload
+from backend.services.classification import CLASSIFICATION_LABELS, Classifier, fingerprint_details
+from backend.services.document_session import DocumentSession
+from backend.services.field_mapper import SAPFieldMapper
+from backend.services.mapping import Mapper
+from backend.services.metrics import STAGE_SECONDS
+from backend.services.ocr_processor import OCR_Processor
+from backend.services.progress import ProgressBroker, progress_broker
+from backend.services.token_accounting import charge_to
+from backend.services.tracing import attach_document, span
+from backend.services.sap_async import master_data_cache
+from backend.services.sap_outbox import SAPOutbox, sap_outbox_drainer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Document types that are posted to SAP as purchase invoices
+POSTABLE_LABELS = ("ap_invoice", "ap_invoice_with_lc")
+
+
+class PipelineError(Exception):
+    def __init__(self, stage: str, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.stage = stage
+        self.status_code = status_code
+
+
+class StageTimings:
+    """Wall-clock milliseconds per stage. Stages that run concurrently overlap in total_ms."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            with span(f"pipeline.{name}"):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = round(elapsed * 1000, 1)
+            STAGE_SECONDS.labels("pipeline", name).observe(elapsed)
+
+    def report(self) -> dict:
+        return {"stages_ms": dict(self.stages), "total_ms": round((time.perf_counter() - self.started) * 1000, 1)}
+
+
+def sap_invoice_payload(mapped_result: dict) -> tuple[Optional[dict], Optional[str]]:
+    """
+    Drops the fields the mapping left empty, which the Service Layer would reject.
+    Returns the payload, or None and the reason it cannot be posted.
+    """
+    def filled(fields: dict) -> dict:
+        return {key: value for key, value in fields.items() if value not in ("", None)}
+
+    payload = filled({key: value for key, value in mapped_result.items() if key != "DocumentLines"})
+    payload["DocumentLines"] = [filled(line) for line in mapped_result.get("DocumentLines", [])]
+    if not payload.get("CardCode"):
+        return None, "No vendor code was matched for this document."
+    if not payload["DocumentLines"]:
+        return None, "The document has no line items."
+    unmapped = [index for index, line in enumerate(payload["DocumentLines"]) if not line.get("ItemCode")]
+    if unmapped:
+        return None, f"Line item(s) {unmapped} have no ItemCode."
+    return payload, None
+
+
+class InvoicePipeline:
+    """
+    Runs upload → extract → classify → map → post for one file in a single request.
+    OCR and the master-data refresh run together; once the details are extracted, vendor
+    resolution, classification with G/L suggestion and item matching run concurrently on
+    forks of one in-memory DocumentSession. The document is inserted once, before posting.
+    Each finished stage is published to the progress broker under the document uid.
+    """
+
+    def __init__(
+        self,
+        ocr: OCR_Processor,
+        classifier: Classifier,
+        mapper: Mapper,
+        field_mapper: Optional[SAPFieldMapper],
+        fill_missing_fields: Callable[[dict, list], dict],
+        outbox: SAPOutbox = sap_outbox_drainer,
+        progress: ProgressBroker = progress_broker
+    ):
+        self.ocr = ocr
+        self.classifier = classifier
+        self.mapper = mapper
+        self.field_mapper = field_mapper
+        self.fill_missing_fields = fill_missing_fields
+        self.outbox = outbox
+        self.progress = progress
+
+    async def refresh_master_data(self):
+        vendors_df = await master_data_cache.refresh()
+        # Republishing an unchanged catalog would still hash every name
+        if vendors_df is not None and self.mapper.vendor_names_with_codes is not vendors_df:
+            self.mapper.vendor_names_with_codes = vendors_df
+
+    def report(self, uid: int, timings: StageTimings, stage: str, data: Optional[dict] = None):
+        self.progress.publish(uid, stage, {"stage_ms": timings.stages.get(stage), **(data or {})})
+
+    async def run_stage(self, uid: int, timings: StageTimings, name: str, session: DocumentSession, steps: list, summary: Callable[[DocumentSession, object], dict]):
+        """Runs blocking steps in order on a fork of the session and returns the fork and the last step's result."""
+        fork = session.fork()
+        result = None
+        with timings.stage(name):
+            for step in steps:
+                result = await asyncio.to_thread(step, fork)
+        self.report(uid, timings, name, summary(fork, result))
+        return fork, result
+
+    async def run(self, file_path: str, file_name: str, prompt: Optional[str] = None, post: bool = True, timings: Optional[StageTimings] = None, uid: Optional[int] = None, response_schema: Optional[dict] = None) -> dict:
+        """
+        Processes one file and returns the result. Progress is published under the document
+        uid, which is allocated here unless the caller already handed one out. A custom prompt
+        may come with the JSON Schema its answer must follow.
+        """
+        timings = timings or StageTimings()
+        if uid is None:
+            uid = await asyncio.to_thread(next_document_uid)
+        attach_document(uid)
+        self.progress.open(uid)
+        self.progress.publish(uid, "started", {"document_id": uid, "file_name": file_name})
+        try:
+            with charge_to(uid):
+                result = await self.process(uid, file_path, file_name, prompt, post, timings, response_schema)
+        except PipelineError as e:
+            self.progress.publish(uid, "error", {"stage": e.stage, "message": str(e), "status_code": e.status_code})
+            raise
+        except Exception as e:
+            self.progress.publish(uid, "error", {"message": str(e), "status_code": 500})
+            raise
+        self.progress.publish(uid, "done", result)
+        return result
+
+    async def process(self, uid: int, file_path: str, file_name: str, prompt: Optional[str], post: bool, timings: StageTimings, response_schema: Optional[dict] = None) -> dict:
+        async def ocr_stage():
+            with timings.stage("ocr"):
+                text = await asyncio.to_thread(self.ocr.extract_raw_text_from_pdf, file_path)
+            self.report(uid, timings, "ocr", {"characters": len(text or "")})
+            return text
+
+        async def master_data_stage():
+            with timings.stage("master_data"):
+                await self.refresh_master_data()
+            self.report(uid, timings, "master_data")
+
+        async def original_stage():
+            # OCR reads a preflight copy; the upload itself is kept as received
+            if not settings.PDF_KEEP_ORIGINALS:
+                return None
+            try:
+                return await asyncio.to_thread(store_original_upload, uid, file_path, file_name)
+            except Exception as e:
+                logger.error(f"Could not keep the original upload of document {uid}: {e}")
+                return None
+
+        try:
+            text, _, original_file_id = await asyncio.gather(ocr_stage(), master_data_stage(), original_stage())
+        except Exception as e:
+            raise PipelineError("ocr", f"OCR failed: {e}", 502)
+        if not text or not text.strip():
+            raise PipelineError("ocr", "No text could be extracted from the PDF", 400)
+
+        with timings.stage("extract"):
+            extraction = await asyncio.to_thread(self.ocr.structure_text, text, prompt or "", response_schema)
+        if extraction.status != "success":
+            raise PipelineError("extract", extraction.message, 400)
+        self.report(uid, timings, "extract", {
+            "header": {key: value for key, value in extraction.content.items() if key != "line_items"},
+            "line_items": len(extraction.content.get("line_items") or [])
+        })
+
+        document = {
+            "file_name": file_name,
+            "prompt_type": "user_given_prompt" if prompt else "default_prompt",
+            "raw_text": extraction.extracted_text,
+            "extracted_details": extraction.content,
+            "uploaded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        if prompt:
+            document["prompt"] = prompt
+        if response_schema:
+            document["response_schema"] = response_schema
+        if original_file_id:
+            document["original_file_id"] = original_file_id
+        session = DocumentSession(uid, document)
+
+        # Each branch writes its own paths: vendor name and code, classification and G/L, line items
+        (vendor, _), (classified, label), (items, _) = await asyncio.gather(
+            self.run_stage(
+                uid, timings, "vendor", session, [self.classifier.match_vendor_name, self.mapper.find_similar_vendor],
+                lambda fork, _: {"vendor_details": fork.get("extracted_details.vendor_details")}
+            ),
+            self.run_stage(
+                uid, timings, "classify", session, [self.classifier.process_classification],
+                lambda fork, label: {"classification": label, "gl_classification": fork.get("gl_classification")}
+            ),
+            self.run_stage(
+                uid, timings, "items", session, [self.mapper.map_items_to_codes],
+                lambda fork, _: {"line_items": fork.get("extracted_details.line_items")}
+            )
+        )
+        for fork in (vendor, classified, items):
+            session.merge(fork)
+
+        session.set("classification", label)
+        if label in CLASSIFICATION_LABELS:
+            session.set("classification_fingerprint", fingerprint_details(session.get("extracted_details")))
+
+        mapped_result, llm_fields = None, []
+        if self.field_mapper is not None:
+            with timings.stage("map"):
+                details = session.snapshot("extracted_details", {})
+                mapped_result, missing_fields = self.field_mapper.map(details)
+                if missing_fields:
+                    filled = await asyncio.to_thread(self.fill_missing_fields, details, missing_fields)
+                    mapped_result.update(filled)
+                    llm_fields = list(filled)
+            self.report(uid, timings, "map", {"mapped_result": mapped_result, "llm_mapped_fields": llm_fields})
+
+        with timings.stage("persist"):
+            await asyncio.to_thread(session.insert)
+        self.report(uid, timings, "persist", {"document_id": uid})
+
+        posting = {"status": "skipped", "reason": "Posting was not requested."}
+        if post:
+            posting = await self.post(timings, session, label, mapped_result)
+        self.report(uid, timings, "post", posting)
+
+        return {
+            "status": "success",
+            "document_id": uid,
+            "file_name": file_name,
+            "classification": label,
+            "classification_decision": session.get("classification_decision"),
+            "gl_classification": session.get("gl_classification"),
+            "extracted_details": session.get("extracted_details"),
+            "mapped_result": mapped_result,
+            "llm_mapped_fields": llm_fields,
+            "posting": posting,
+            "timings": timings.report()
+        }
+
+    async def post(self, timings: StageTimings, session: DocumentSession, label: str, mapped_result: Optional[dict]) -> dict:
+        if label not in POSTABLE_LABELS:
+            return {"status": "skipped", "reason": f"Documents classified as '{label}' are not posted as purchase invoices."}
+        if mapped_result is None:
+            return {"status": "skipped", "reason": "Mapping service is unavailable."}
+        payload, reason = sap_invoice_payload(mapped_result)
+        if payload is None:
+            return {"status": "skipped", "reason": reason}
+        with timings.stage("post"):
+            entry, created = await asyncio.to_thread(self.outbox.enqueue, payload, session.uid)
+        return {"status": entry["status"], "posting_id": entry["posting_id"], "duplicate": not created}
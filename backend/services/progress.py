@@ -0,0 +1,97 @@
+import asyncio
+import json
+import logging
+import time
+from typing import AsyncIterator, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Events that end a document's stream
+TERMINAL_EVENTS = ("done", "error")
+# How long a finished document's events stay available for late subscribers
+RETAIN_SECONDS = 300
+# Comment line sent while a stage is running so proxies keep the connection open
+KEEPALIVE_SECONDS = 15
+
+
+class ProgressChannel:
+    def __init__(self):
+        self.events: list[dict] = []
+        self.subscribers: set[asyncio.Queue] = set()
+        self.started = time.perf_counter()
+
+    @property
+    def finished(self) -> bool:
+        return bool(self.events) and self.events[-1]["event"] in TERMINAL_EVENTS
+
+
+class ProgressBroker:
+    """
+    In-process publish/subscribe of processing events per document uid. Every event is kept
+    until the document finishes (and RETAIN_SECONDS after), so a client that subscribes late
+    or reconnects with Last-Event-ID gets the earlier events replayed first. Publish from
+    the event loop; stages running in threads report through the pipeline's awaits.
+    """
+
+    def __init__(self):
+        self.channels: dict[int, ProgressChannel] = {}
+
+    def open(self, uid: int):
+        self.channels.setdefault(uid, ProgressChannel())
+
+    def has(self, uid: int) -> bool:
+        return uid in self.channels
+
+    def publish(self, uid: int, event: str, data: Optional[dict] = None):
+        channel = self.channels.get(uid)
+        if channel is None or channel.finished:
+            return
+        message = {
+            "id": len(channel.events) + 1,
+            "event": event,
+            "data": {**(data or {}), "elapsed_ms": round((time.perf_counter() - channel.started) * 1000, 1)}
+        }
+        channel.events.append(message)
+        for queue in channel.subscribers:
+            queue.put_nowait(message)
+        if event in TERMINAL_EVENTS:
+            asyncio.get_running_loop().call_later(RETAIN_SECONDS, self.channels.pop, uid, None)
+
+    async def subscribe(self, uid: int, last_event_id: int = 0) -> AsyncIterator[dict]:
+        """Yields the events after last_event_id, then live events until the document finishes."""
+        channel = self.channels.get(uid)
+        if channel is None:
+            return
+        queue = asyncio.Queue()
+        # Replay and registration happen without an await in between, so no event is missed
+        backlog = [message for message in channel.events if message["id"] > last_event_id]
+        channel.subscribers.add(queue)
+        try:
+            for message in backlog:
+                yield message
+                if message["event"] in TERMINAL_EVENTS:
+                    return
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if message["id"] <= last_event_id:
+                    continue
+                yield message
+                if message["event"] in TERMINAL_EVENTS:
+                    return
+        finally:
+            channel.subscribers.discard(queue)
+
+
+def format_sse(message: Optional[dict]) -> str:
+    """Encodes an event as a text/event-stream frame; None becomes a keep-alive comment."""
+    if message is None:
+        return ": keep-alive\n\n"
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {json.dumps(message['data'], default=str)}\n\n"
+
+
+progress_broker = ProgressBroker()
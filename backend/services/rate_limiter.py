@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from ..core.config import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token bucket plus concurrency cap shared by every caller of one provider.
+    Usable from worker threads (limit) and from the event loop (limit_async);
+    callers only wait when the bucket is empty or all slots are taken.
+    """
+
+    def __init__(self, name: str, requests_per_second: float, burst: int, max_concurrency: int):
+        self.name = name
+        self.rate = requests_per_second
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.max_concurrency = max(1, max_concurrency)
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._async_waiters = deque()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def _take_token(self) -> float:
+        """Takes a token and returns 0, or returns the seconds until one is available. Lock must be held."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def _wake_async_waiter(self):
+        """Wakes the next event-loop waiter for a freed slot. Lock must be held."""
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            if not waiter.done():
+                loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+                return
+
+    def acquire(self):
+        with self._lock:
+            while self.in_flight >= self.max_concurrency:
+                self._slot_freed.wait()
+            self.in_flight += 1
+        try:
+            while True:
+                with self._lock:
+                    wait = self._take_token()
+                if not wait:
+                    return
+                time.sleep(wait)
+        except BaseException:
+            self.release()
+            raise
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self.in_flight < self.max_concurrency:
+                    self.in_flight += 1
+                    break
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._lock:
+                    # Pass a wake-up we were given but can no longer use on to the next waiter
+                    if waiter.done() and not waiter.cancelled():
+                        self._wake_async_waiter()
+                raise
+        try:
+            while True:
+                with self._lock:
+                    wait = self._take_token()
+                if not wait:
+                    return
+                await asyncio.sleep(wait)
+        except BaseException:
+            self.release()
+            raise
+
+    def penalize(self, seconds: float):
+        """Empties the bucket for the given time after the provider pushed back (429)."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+            logger.warning(f"Rate limiter '{self.name}' backing off for {seconds:.1f}s")
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._slot_freed.notify()
+            self._wake_async_waiter()
+
+    @contextmanager
+    def limit(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def limit_async(self):
+        await self.acquire_async()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+limiters = {
+    "sap": RateLimiter(
+        "sap",
+        requests_per_second=settings.SAP_REQUESTS_PER_SECOND,
+        burst=settings.SAP_BURST,
+        max_concurrency=settings.SAP_MAX_CONCURRENCY
+    ),
+    "mistral": RateLimiter(
+        "mistral",
+        requests_per_second=settings.MISTRAL_REQUESTS_PER_SECOND,
+        burst=settings.MISTRAL_BURST,
+        max_concurrency=settings.MISTRAL_MAX_CONCURRENCY
+    ),
+    "huggingface": RateLimiter(
+        "huggingface",
+        requests_per_second=settings.HF_REQUESTS_PER_SECOND,
+        burst=settings.HF_BURST,
+        max_concurrency=settings.HF_MAX_CONCURRENCY
+    ),
+}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str) -> RateLimiter:
+    """
+    Returns the shared limiter for a provider. Model quotas are per model, so every model
+    name (any name that is not a fixed provider above) gets its own limiter configured
+    from the GEMINI_* settings.
+    """
+    with _limiters_lock:
+        if provider not in limiters:
+            if not provider.startswith("gemini"):
+                logger.info(f"No quota configured for '{provider}'; using the GEMINI_* limits.")
+            limiters[provider] = RateLimiter(
+                provider,
+                requests_per_second=settings.GEMINI_REQUESTS_PER_MINUTE / 60,
+                burst=settings.GEMINI_BURST,
+                max_concurrency=settings.GEMINI_MAX_CONCURRENCY
+            )
+        return limiters[provider]
@@ -0,0 +1,44 @@
+import logging
+from typing import Iterable, Optional
+from rapidfuzz import fuzz, process, utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class ShortlistIndex:
+    """
+    Lexical top-k retrieval over reference records such as account codes or item groups,
+    so prompts only carry the candidates that are plausible for one item description.
+    Each record can be indexed under extra texts (e.g. names of existing items in a UoM group)
+    in addition to its own name; a record scores as its best matching text.
+    """
+
+    def __init__(self, records: list[dict], code_key: str, name_key: str, extra_texts: Optional[dict] = None):
+        self.code_key = code_key
+        self.records = [record for record in records if str(record.get(name_key) or "").strip()]
+        self.texts, self.owners = [], []
+        for position, record in enumerate(self.records):
+            texts = [str(record[name_key])] + list((extra_texts or {}).get(record[code_key], []))
+            for text in texts:
+                self.texts.append(utils.default_process(str(text)))
+                self.owners.append(position)
+        logger.info(f"Built shortlist index on '{code_key}' with {len(self.records)} records and {len(self.texts)} texts.")
+
+    def search(self, query: str, k: int) -> list[dict]:
+        """Returns up to k records ordered by their best similarity to the query."""
+        query = utils.default_process(query or "")
+        if not query or not self.texts:
+            return self.records[:k]
+
+        best_scores = {}
+        for _, score, text_position in process.extract(query, self.texts, scorer=fuzz.WRatio, processor=None, limit=None):
+            owner = self.owners[text_position]
+            if score > best_scores.get(owner, -1):
+                best_scores[owner] = score
+
+        ranked = sorted(best_scores, key=lambda owner: (-best_scores[owner], owner))
+        return [self.records[owner] for owner in ranked[:k]]
+
+    def codes(self, records: Iterable[dict]) -> set:
+        return {str(record[self.code_key]) for record in records}
@@ -1,16 +1,26 @@
-import requests
 import urllib3
 import pandas as pd
 # from ..core.config import settings
 import logging
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 from backend.core.config import settings 
+from backend.services.rate_limiter import get_limiter
+from backend.services.sap_session_pool import SAPLoginError, SAPSessionPool
+from backend.services.sap_batch import (
+    BatchOperation, BatchResult, build_batch_body, collect_new_items, entity_results,
+    invoice_batch_result, parse_batch_response, prepare_invoice_payloads, sap_error_detail
+)
+from pydantic import BaseModel
+from urllib.parse import urlparse
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+sap_limiter = get_limiter("sap")
+
 
 # Load environment variables from a specific .env file
 # Priority: ENV_FILE env var > project-root/.env (two levels up from this file)
@@ -23,269 +33,234 @@ logger = logging.getLogger(__name__)
 # else:
 #     logger.warning(f".env file not found at {ENV_FILE}; relying on process environment")
 
+class MasterDataSpec(BaseModel):
+    label: str
+    path: str
+    fields: dict  # csv column -> Service Layer property
+    csv_path: str
+    dropna: bool = False
+
+
+MASTER_DATA = {
+    "items": MasterDataSpec(
+        label="items",
+        path="Items/?$select=ItemCode,ItemName,UoMGroupEntry,InventoryUoMEntry",
+        fields={"ItemCode": "ItemCode", "ItemName": "ItemName", "UoMGroupEntry": "UoMGroupEntry", "InventoryUoMEntry": "InventoryUoMEntry"},
+        csv_path="backend/assets/item_list.csv"
+    ),
+    "item_groups": MasterDataSpec(
+        label="item groups",
+        path="ItemGroups?$select=GroupName,Number",
+        fields={"Series": "Number", "GroupName": "GroupName"},
+        csv_path="backend/assets/item_groups.csv"
+    ),
+    "uom_groups": MasterDataSpec(
+        label="UoM groups",
+        path="UnitOfMeasurementGroups?$select=AbsEntry,Code,BaseUoM&$orderby=AbsEntry",
+        fields={"UoMGroupEntry": "AbsEntry", "Code": "Code", "BaseUoM": "BaseUoM"},
+        csv_path="backend/assets/uom_groups.csv"
+    ),
+    "account_codes": MasterDataSpec(
+        label="account codes",
+        path="ChartOfAccounts?$select=Code,Name&$orderby=Name",
+        fields={"AccountCode": "Code", "Name": "Name"},
+        csv_path="backend/assets/account_codes.csv"
+    ),
+    "cost_codes": MasterDataSpec(
+        label="cost codes",
+        path="DistributionRules?$select=FactorCode,FactorDescription&$orderby=FactorCode",
+        fields={"FactorCode": "FactorCode", "FactorDescription": "FactorDescription"},
+        csv_path="backend/assets/cost_codes.csv"
+    ),
+    "business_partners": MasterDataSpec(
+        label="business partners",
+        path="BusinessPartners?$select=CardCode,CardName,CardType&$orderby=CardName",
+        fields={"CardCode": "CardCode", "CardName": "CardName"},
+        csv_path="backend/assets/vendor_list.csv",
+        dropna=True
+    ),
+}
+
+
+def records_from_page(spec: MasterDataSpec, page: dict) -> list[dict]:
+    return [{column: value[source] for column, source in spec.fields.items()} for value in page.get("value", [])]
+
+
+def next_page_url(base_url: str, page: dict):
+    next_link = page.get("odata.nextLink")
+    return f"{base_url}{next_link}" if next_link else None
+
+
+def save_master_data(spec: MasterDataSpec, records: list[dict]) -> pd.DataFrame:
+    df = pd.DataFrame(records, columns=list(spec.fields))
+    if spec.dropna:
+        df.dropna(inplace=True)
+    # Written next to the target and renamed over it, so concurrent readers see the old or the new file, never a partial one
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(spec.csv_path) or ".", prefix=".tmp-", suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            df.to_csv(f, index=False)
+        os.replace(tmp_path, spec.csv_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    logger.info(f"{spec.label.capitalize()} saved as csv")
+    return df
+
+
+def item_result(response):
+    """Reads a POST Items response (requests or httpx) into the created codes, or None."""
+    if response.status_code == 201:
+        logger.info("Successfully posted item to SAP.")
+        return {
+            'ItemCode': response.json()['ItemCode'],
+            'InventoryUoMEntry': response.json().get('InventoryUoMEntry')
+        }
+    logger.error(f"Failed to post item. Status: {response.status_code}, Response: {response.text}")
+    return None
+
+
+def purchase_invoice_result(response) -> dict:
+    """Reads a POST PurchaseInvoices response (requests or httpx) into the created document or an error."""
+    if response.status_code == 201:
+        logger.info("Successfully posted purchase invoice to SAP.")
+        return response.json()
+    error_detail = response.text
+    try:
+        error_detail = sap_error_detail(response.json(), response.text)
+    except ValueError:
+        pass
+    logger.error(f"Failed to post purchase invoice. Status: {response.status_code}, Error: {error_detail}")
+    return {"error": True, "status_code": response.status_code, "detail": error_detail}
+
+
 class SAPClient:
     def __init__(self):
-        self.session = requests.Session()
         self.creds = {
             "CompanyDB": settings.COMPANY_DB,
             "UserName": settings.USERNAME,
             "Password": settings.PASSWORD
         }
         self.base_url = settings.BASE_URL
+        # Sessions log in on first use and again whenever the Service Layer times them out
+        self.pool = SAPSessionPool(self.base_url, self.creds, settings.SAP_SESSION_POOL_SIZE)
 
         try:
-            login_req = self.session.post(f"{self.base_url}Login", json=self.creds, verify=False)
-
-            if login_req.status_code == 200:
-                logger.info("Successfully logged in to SAP.")
-            else:
-                logger.error(f"Login failed with status code: {login_req.status_code}")
-                exit(1)
-        except requests.exceptions.RequestException as e:
-                print(f"Login request failed: {e}")
+            self.pool.login_one()
+            logger.info("Successfully logged in to SAP.")
+        except SAPLoginError as e:
+                logger.error(str(e))
                 exit(1)
 
         self.save_item_groups_to_csv()
+
+    def get(self, url: str):
+        with sap_limiter.limit():
+            return self.pool.request("GET", url)
+
+    def post(self, url: str, json: dict):
+        with sap_limiter.limit():
+            return self.pool.request("POST", url, json=json)
         
-    def save_items_to_csv(self):
-        all_items = []
-        item_url_req = f'{self.base_url}Items/?$select=ItemCode,ItemName,UoMGroupEntry,InventoryUoMEntry'
-        
-        while item_url_req:
+    def fetch_master_data(self, name: str) -> pd.DataFrame:
+        """Pages through one master-data collection and saves it as csv under backend/assets."""
+        spec = MASTER_DATA[name]
+        records = []
+        url = f"{self.base_url}{spec.path}"
+        while url:
             try:
-                logger.info("Fetching items from SAP...")
-                response = self.session.get(item_url_req, verify=False)
-                items = response.json()['value']
-                for item in items:
-                    all_items.append({'ItemCode': item['ItemCode'],
-                                    'ItemName': item['ItemName'],
-                                    'UoMGroupEntry': item['UoMGroupEntry'],
-                                    'InventoryUoMEntry': item['InventoryUoMEntry']
-                                })
-                if 'odata.nextLink' in response.json():
-                    logger.info("Fetching next page of items...")
-                    next_link = response.json()['odata.nextLink']
-                    item_url_req = f'{self.base_url}{next_link}'
-                else:
-                    break
+                logger.info(f"Fetching {spec.label} from SAP...")
+                page = self.get(url).json()
+                records += records_from_page(spec, page)
+                url = next_page_url(self.base_url, page)
+                if url:
+                    logger.info(f"Fetching next page of {spec.label}...")
             except Exception as e:
-                logger.error(f"Error fetching items: {e}")
+                logger.error(f"Error fetching {spec.label}: {e}")
                 raise
-            
-        items_df = pd.DataFrame(all_items)
-        items_df.to_csv("backend/assets/item_list.csv", index=False)
-        logger.info("Items saved as csv")
+        return save_master_data(spec, records)
 
-        return items_df
+    def save_items_to_csv(self):
+        return self.fetch_master_data("items")
 
     def save_item_groups_to_csv(self):
-        item_group_list = []
-        item_group_res = f"{self.base_url}ItemGroups?$select=GroupName,Number"
-
-        while item_group_res:
-            try:
-                response = self.session.get(item_group_res, verify=False)
-                logger.info("Fetching item groups from SAP...")
-                group_values = response.json()['value']
-                for num in group_values:
-                    item_group_list.append({
-                        "Series": num["Number"],
-                        "GroupName": num["GroupName"]
-                    })
-                if 'odata.nextLink' in response.json():
-                    logger.info("Fetching next page of item groups...")
-                    next_link = response.json()['odata.nextLink']
-                    item_group_res = f"{self.base_url}{next_link}"
-                else:
-                    break
-            except Exception as e:
-                logger.error(f"Error fetching item groups: {e}")
-                raise
-        
-        item_group_df = pd.DataFrame(item_group_list)
-        item_group_df.to_csv('backend/assets/item_groups.csv', index=False)
-        logger.info("Item groups saved as csv")
-
-        return item_group_df
+        return self.fetch_master_data("item_groups")
 
     def save_uom_groups_to_csv(self):
-        uom_group_list = []
-        uom_group_url = f"{self.base_url}UnitOfMeasurementGroups?$select=AbsEntry,Code,BaseUoM&$orderby=AbsEntry"
+        return self.fetch_master_data("uom_groups")
 
-        while uom_group_url:
-            try:
-                response = self.session.get(uom_group_url, verify=False)
-                logger.info("Fetching UoM groups from SAP...")
-
-                if 'value' in response.json():
-                    uom_group_values = response.json()['value']
-                    for num in uom_group_values:
-                        uom_group_list.append({
-                            "UoMGroupEntry": num["AbsEntry"],
-                            "Code": num["Code"],
-                        "BaseUoM": num["BaseUoM"]
-                    })
-                    
-                    if 'odata.nextLink' in response.json():
-                        logger.info("Fetching next page of UoM groups...")
-                        next_link = response.json()['odata.nextLink']
-                        uom_group_url = f"{self.base_url}{next_link}"
-                    else:
-                        break
-                else:
-                    break
-                
-            except Exception as e:
-                logger.error(f"Error fetching UoM groups: {e}")
-                raise
-        uom_group_df = pd.DataFrame(uom_group_list)
-        uom_group_df.to_csv('backend/assets/uom_groups.csv', index=False)
-        logger.info("UoM groups saved as csv")
-
-        return uom_group_df
-    
     def save_account_codes(self):
-        account_code_list = []
-        account_code_url = f"{self.base_url}ChartOfAccounts?$select=Code,Name&$orderby=Name"
+        return self.fetch_master_data("account_codes")
 
-        while account_code_url:
-            try:
-                response = self.session.get(account_code_url, verify=False)
-                logger.info("Fetching account codes from SAP...")
-
-                if 'value' in response.json():
-                    account_code_values = response.json()['value']
-                    for num in account_code_values:
-                        account_code_list.append({
-                            "AccountCode": num["Code"],
-                            "Name": num["Name"]
-                        })
-                    
-                    if 'odata.nextLink' in response.json():
-                        logger.info("Fetching next page of account codes...")
-                        next_link = response.json()['odata.nextLink']
-                        account_code_url = f"{self.base_url}{next_link}"
-                    else:
-                        break
-                else:
-                    break
-                
-            except Exception as e:
-                logger.error(f"Error fetching account codes: {e}")
-                raise
-        account_code_df = pd.DataFrame(account_code_list)
-        account_code_df.to_csv('backend/assets/account_codes.csv', index=False)
-        logger.info("Account codes saved as csv")
-
-        return account_code_df
-    
     def save_cost_codes(self):
-        cost_code_list = []
-        cost_code_url = f"{self.base_url}DistributionRules?$select=FactorCode,FactorDescription&$orderby=FactorCode"
-
-        while cost_code_url:
-            try:
-                response = self.session.get(cost_code_url, verify=False)
-                logger.info("Fetching cost codes from SAP...")
-
-                if 'value' in response.json():
-                    cost_code_values = response.json()['value']
-                    for num in cost_code_values:
-                        cost_code_list.append({
-                            "FactorCode": num["FactorCode"],
-                            "FactorDescription": num["FactorDescription"]
-                        })
-
-                    if 'odata.nextLink' in response.json():
-                        logger.info("Fetching next page of cost codes...")
-                        next_link = response.json()['odata.nextLink']
-                        cost_code_url = f"{self.base_url}{next_link}"
-                    else:
-                        break
-                else:
-                    break
-
-            except Exception as e:
-                logger.error(f"Error fetching cost codes: {e}")
-                raise
-        cost_code_df = pd.DataFrame(cost_code_list)
-        cost_code_df.to_csv('backend/assets/cost_codes.csv', index=False)
-        logger.info("Cost codes saved as csv")
+        return self.fetch_master_data("cost_codes")
 
-        return cost_code_df
-    
     def save_business_partners(self):
-        bp_list = []
-        bp_url = f"{self.base_url}BusinessPartners?$select=CardCode,CardName,CardType&$orderby=CardName"
-
-        while bp_url:
-            try:
-                response = self.session.get(bp_url, verify=False)
-                logger.info("Fetching business partners from SAP...")
-
-                if 'value' in response.json():
-                    bp_values = response.json()['value']
-                    for num in bp_values:
-                        bp_list.append({
-                            "CardCode": num["CardCode"],
-                            "CardName": num["CardName"]
-                        })
-
-                    if 'odata.nextLink' in response.json():
-                        logger.info("Fetching next page of business partners...")
-                        next_link = response.json()['odata.nextLink']
-                        bp_url = f"{self.base_url}{next_link}"
-                    else:
-                        break
-                else:
-                    break
-
-            except Exception as e:
-                logger.error(f"Error fetching business partners: {e}")
-                raise
-        bp_df = pd.DataFrame(bp_list)
-        bp_df.dropna(inplace=True)
-        bp_df.to_csv('backend/assets/vendor_list.csv', index=False)
-        logger.info("Business partners saved as csv")
+        return self.fetch_master_data("business_partners")
 
-        return bp_df
-    
     def post_items_to_sap(self, item: dict):
         try:
             logger.info(f"Posting item to SAP: {item}")
-            response = self.session.post(f"{self.base_url}Items", json=item, verify=False)
-            if response.status_code == 201:
-                logger.info("Successfully posted item to SAP.")
-                code_given_by_sap = {
-                    'ItemCode': response.json()['ItemCode'],
-                    'InventoryUoMEntry': response.json().get('InventoryUoMEntry')
-                }
-                return code_given_by_sap
-            else:
-                logger.error(f"Failed to post item. Status: {response.status_code}, Response: {response.text}")
-                return None
+            return item_result(self.post(f"{self.base_url}Items", json=item))
         except Exception as e:
             logger.error(f"Error posting item: {e}")
-        finally:
-            self.save_items_to_csv()
+            return None
 
     def post_purchase_invoice(self, invoice: dict):
         try:
             logger.info(f"Posting purchase invoice to SAP: {invoice}")
-            response = self.session.post(f"{self.base_url}PurchaseInvoices", json=invoice, verify=False)
-            if response.status_code == 201:
-                logger.info("Successfully posted purchase invoice to SAP.")
-                return response.json()
-            else:
-                error_detail = response.text
-                try:
-                    error_json = response.json()
-                    error_detail = error_json.get("error", {}).get("message", {}).get("value", response.text)
-                except:
-                    pass
-                logger.error(f"Failed to post purchase invoice. Status: {response.status_code}, Error: {error_detail}")
-                return {"error": True, "status_code": response.status_code, "detail": error_detail}
+            return purchase_invoice_result(self.post(f"{self.base_url}PurchaseInvoices", json=invoice))
         except Exception as e:
             logger.error(f"Error posting purchase invoice: {e}")
             return {"error": True, "detail": str(e)}
 
+    def execute_batch(self, changesets: list[list[BatchOperation]]) -> list[list[BatchResult]]:
+        """Sends the changesets in one $batch request and returns the results per changeset."""
+        boundary, body = build_batch_body(changesets, urlparse(self.base_url).path)
+        headers = {
+            "Content-Type": f"multipart/mixed;boundary={boundary}",
+            # Keep processing the remaining changesets when one of them fails
+            "Prefer": "odata.continue-on-error"
+        }
+        with sap_limiter.limit():
+            response = self.pool.request("POST", f"{self.base_url}$batch", data=body.encode("utf-8"), headers=headers)
+        if response.status_code not in (200, 202):
+            raise RuntimeError(f"SAP $batch request failed. Status: {response.status_code}, Response: {response.text}")
+        return parse_batch_response(response.headers.get("Content-Type", ""), response.text)
+
+    def post_batch(self, operations: list[BatchOperation]) -> list[dict]:
+        """
+        Posts independent entities, one changeset each, in $batch requests of
+        settings.SAP_BATCH_SIZE. Returns one result per operation, in order.
+        """
+        results = []
+        for start in range(0, len(operations), settings.SAP_BATCH_SIZE):
+            chunk = operations[start:start + settings.SAP_BATCH_SIZE]
+            try:
+                changesets = self.execute_batch([[operation] for operation in chunk])
+            except Exception as e:
+                logger.error(f"Error sending $batch request: {e}")
+                changesets = e
+            results += entity_results(len(chunk), changesets)
+        return results
+
+    def post_purchase_invoices_batch(self, invoices: list[dict]) -> list[dict]:
+        """
+        Posts many purchase invoices with $batch. Lines without an ItemCode may carry a
+        "NewItem" (ItemName, Series, UoMGroupEntry); those items are created first in a
+        single $batch round and their codes filled into the invoices. Returns one result
+        per invoice, in order.
+        """
+        new_items = collect_new_items(invoices)
+        created_items = {}
+        if new_items:
+            logger.info(f"Creating {len(new_items)} item(s) in SAP with $batch.")
+            item_results = self.post_batch([BatchOperation(method="POST", path="Items", body=item) for item in new_items.values()])
+            created_items = dict(zip(new_items, item_results))
+
+        payloads, results = prepare_invoice_payloads(invoices, created_items)
+        logger.info(f"Posting {len(payloads)} purchase invoice(s) to SAP with $batch.")
+        invoice_results = self.post_batch([BatchOperation(method="POST", path="PurchaseInvoices", body=payload) for payload in payloads.values()])
+        for index, result in zip(payloads, invoice_results):
+            results[index] = invoice_batch_result(index, result)
+        return results
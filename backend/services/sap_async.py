@@ -0,0 +1,291 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+from urllib.parse import urlparse
+import httpx
+import pandas as pd
+from backend.core.config import settings
+from backend.services.metrics import observe_sap
+from backend.services.rate_limiter import get_limiter
+from backend.services.sap_api import MASTER_DATA, item_result, next_page_url, purchase_invoice_result, records_from_page, save_master_data
+from backend.services.sap_batch import (
+    BatchOperation, BatchResult, build_batch_body, collect_new_items, entity_results,
+    invoice_batch_result, parse_batch_response, prepare_invoice_payloads
+)
+from backend.services.sap_session_pool import UNHEALTHY_AFTER_FAILURES, SAPLoginError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+sap_limiter = get_limiter("sap")
+
+
+class AsyncSAPSession:
+    """One Service Layer session on the shared AsyncClient; its cookies are sent per request."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.cookie_header: Optional[str] = None
+        self.logins = 0
+        self.requests = 0
+        self.consecutive_failures = 0
+        self.last_error: Optional[str] = None
+        self.last_used: Optional[float] = None
+
+    @property
+    def logged_in(self) -> bool:
+        return self.cookie_header is not None
+
+    @property
+    def healthy(self) -> bool:
+        return self.logged_in and self.consecutive_failures < UNHEALTHY_AFTER_FAILURES
+
+    def health(self) -> dict:
+        return {
+            "session": self.index,
+            "healthy": self.healthy,
+            "logged_in": self.logged_in,
+            "logins": self.logins,
+            "requests": self.requests,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1) if self.last_used else None,
+        }
+
+
+class AsyncSAPClient:
+    """
+    Non-blocking counterpart of SAPClient with the same methods, for use from async routes.
+    One httpx.AsyncClient keeps connections alive; SAP_SESSION_POOL_SIZE Service Layer
+    sessions bound how many requests are in flight, and each logs in on first use and
+    again when the Service Layer answers 401.
+    """
+
+    def __init__(self):
+        self.creds = {
+            "CompanyDB": settings.COMPANY_DB,
+            "UserName": settings.USERNAME,
+            "Password": settings.PASSWORD
+        }
+        self.base_url = settings.BASE_URL
+        size = max(1, settings.SAP_SESSION_POOL_SIZE)
+        self.http = httpx.AsyncClient(
+            verify=False,
+            timeout=settings.SAP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size)
+        )
+        self.sessions = [AsyncSAPSession(index) for index in range(size)]
+        self._idle: Optional[asyncio.Queue] = None
+
+    def _queue(self) -> asyncio.Queue:
+        # Created on first use so the queue belongs to the running event loop
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for session in self.sessions:
+                self._idle.put_nowait(session)
+        return self._idle
+
+    async def login(self, session: AsyncSAPSession):
+        try:
+            with observe_sap("POST", "Login") as observed:
+                response = await self.http.post(f"{self.base_url}Login", json=self.creds)
+                observed["status_code"] = response.status_code
+        except httpx.HTTPError as e:
+            session.cookie_header = None
+            session.last_error = f"Login request failed: {e}"
+            raise SAPLoginError(session.last_error) from e
+        if response.status_code != 200:
+            session.cookie_header = None
+            session.last_error = f"Login failed with status code: {response.status_code}"
+            raise SAPLoginError(session.last_error)
+        session.cookie_header = "; ".join(f"{name}={value}" for name, value in response.cookies.items())
+        # Sessions must not share cookies through the client's jar
+        self.http.cookies.clear()
+        session.logins += 1
+        session.consecutive_failures = 0
+        logger.info(f"Async SAP session {session.index} logged in.")
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        idle = self._queue()
+        session = await idle.get()
+        try:
+            if not session.healthy:
+                await self.login(session)
+            response = await self._send(session, method, url, **kwargs)
+            if response.status_code == 401:
+                logger.warning(f"Async SAP session {session.index} expired; logging in again.")
+                await self.login(session)
+                response = await self._send(session, method, url, **kwargs)
+            return response
+        finally:
+            idle.put_nowait(session)
+
+    async def _send(self, session: AsyncSAPSession, method: str, url: str, headers: Optional[dict] = None, **kwargs) -> httpx.Response:
+        session.requests += 1
+        session.last_used = time.monotonic()
+        try:
+            async with sap_limiter.limit_async():
+                with observe_sap(method, url) as observed:
+                    response = await self.http.request(method, url, headers={**(headers or {}), "Cookie": session.cookie_header}, **kwargs)
+                    observed["status_code"] = response.status_code
+        except httpx.HTTPError as e:
+            session.consecutive_failures += 1
+            session.last_error = str(e)
+            raise
+        if response.status_code >= 500 or response.status_code == 401:
+            session.consecutive_failures += 1
+            session.last_error = f"HTTP {response.status_code}"
+        else:
+            session.consecutive_failures = 0
+        return response
+
+    async def get(self, url: str) -> httpx.Response:
+        return await self.request("GET", url)
+
+    async def post(self, url: str, json: dict) -> httpx.Response:
+        return await self.request("POST", url, json=json)
+
+    def health(self) -> list[dict]:
+        return [session.health() for session in self.sessions]
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def fetch_master_data(self, name: str) -> pd.DataFrame:
+        """Pages through one master-data collection and saves it as csv under backend/assets."""
+        spec = MASTER_DATA[name]
+        records = []
+        url = f"{self.base_url}{spec.path}"
+        while url:
+            try:
+                logger.info(f"Fetching {spec.label} from SAP...")
+                page = (await self.get(url)).json()
+                records += records_from_page(spec, page)
+                url = next_page_url(self.base_url, page)
+            except Exception as e:
+                logger.error(f"Error fetching {spec.label}: {e}")
+                raise
+        return await asyncio.to_thread(save_master_data, spec, records)
+
+    async def save_items_to_csv(self):
+        return await self.fetch_master_data("items")
+
+    async def save_item_groups_to_csv(self):
+        return await self.fetch_master_data("item_groups")
+
+    async def save_uom_groups_to_csv(self):
+        return await self.fetch_master_data("uom_groups")
+
+    async def save_account_codes(self):
+        return await self.fetch_master_data("account_codes")
+
+    async def save_cost_codes(self):
+        return await self.fetch_master_data("cost_codes")
+
+    async def save_business_partners(self):
+        return await self.fetch_master_data("business_partners")
+
+    async def post_items_to_sap(self, item: dict):
+        try:
+            logger.info(f"Posting item to SAP: {item}")
+            return item_result(await self.post(f"{self.base_url}Items", json=item))
+        except Exception as e:
+            logger.error(f"Error posting item: {e}")
+            return None
+
+    async def post_purchase_invoice(self, invoice: dict):
+        try:
+            logger.info(f"Posting purchase invoice to SAP: {invoice}")
+            return purchase_invoice_result(await self.post(f"{self.base_url}PurchaseInvoices", json=invoice))
+        except Exception as e:
+            logger.error(f"Error posting purchase invoice: {e}")
+            return {"error": True, "detail": str(e)}
+
+    async def execute_batch(self, changesets: list[list[BatchOperation]]) -> list[list[BatchResult]]:
+        """Sends the changesets in one $batch request and returns the results per changeset."""
+        boundary, body = build_batch_body(changesets, urlparse(self.base_url).path)
+        headers = {
+            "Content-Type": f"multipart/mixed;boundary={boundary}",
+            "Prefer": "odata.continue-on-error"
+        }
+        response = await self.request("POST", f"{self.base_url}$batch", content=body.encode("utf-8"), headers=headers)
+        if response.status_code not in (200, 202):
+            raise RuntimeError(f"SAP $batch request failed. Status: {response.status_code}, Response: {response.text}")
+        return parse_batch_response(response.headers.get("Content-Type", ""), response.text)
+
+    async def post_batch(self, operations: list[BatchOperation]) -> list[dict]:
+        """Like SAPClient.post_batch, with the $batch requests sent concurrently."""
+        chunks = [operations[start:start + settings.SAP_BATCH_SIZE] for start in range(0, len(operations), settings.SAP_BATCH_SIZE)]
+        replies = await asyncio.gather(
+            *(self.execute_batch([[operation] for operation in chunk]) for chunk in chunks),
+            return_exceptions=True
+        )
+        results = []
+        for chunk, changesets in zip(chunks, replies):
+            if isinstance(changesets, Exception):
+                logger.error(f"Error sending $batch request: {changesets}")
+            results += entity_results(len(chunk), changesets)
+        return results
+
+    async def post_purchase_invoices_batch(self, invoices: list[dict]) -> list[dict]:
+        """See SAPClient.post_purchase_invoices_batch."""
+        new_items = collect_new_items(invoices)
+        created_items = {}
+        if new_items:
+            logger.info(f"Creating {len(new_items)} item(s) in SAP with $batch.")
+            item_results = await self.post_batch([BatchOperation(method="POST", path="Items", body=item) for item in new_items.values()])
+            created_items = dict(zip(new_items, item_results))
+
+        payloads, results = prepare_invoice_payloads(invoices, created_items)
+        logger.info(f"Posting {len(payloads)} purchase invoice(s) to SAP with $batch.")
+        invoice_results = await self.post_batch([BatchOperation(method="POST", path="PurchaseInvoices", body=payload) for payload in payloads.values()])
+        for index, result in zip(payloads, invoice_results):
+            results[index] = invoice_batch_result(index, result)
+        return results
+
+
+async_sap_client = AsyncSAPClient()
+
+
+class MasterDataCache:
+    """
+    Business partners and item groups as last fetched from SAP. A refresh happens at most
+    every SAP_MASTER_DATA_TTL_SECONDS, and concurrent callers wait for the one in progress
+    instead of starting their own. A failed refresh keeps the previous data (or the CSVs)
+    until the next attempt.
+    """
+
+    def __init__(self, client: AsyncSAPClient):
+        self.client = client
+        self.vendors: Optional[pd.DataFrame] = None
+        self.refreshed_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def fresh(self) -> bool:
+        return self.refreshed_at is not None and time.monotonic() - self.refreshed_at < settings.SAP_MASTER_DATA_TTL_SECONDS
+
+    async def refresh(self) -> Optional[pd.DataFrame]:
+        """Returns the vendor list, fetching it and the item groups from SAP when they are stale."""
+        if self.fresh():
+            return self.vendors
+        async with self._lock:
+            if self.fresh():
+                return self.vendors
+            vendors_df, item_groups_df = await asyncio.gather(
+                self.client.save_business_partners(),
+                self.client.save_item_groups_to_csv(),
+                return_exceptions=True
+            )
+            if isinstance(vendors_df, Exception):
+                logger.error(f"Using cached vendor list; refresh from SAP failed: {vendors_df}")
+            else:
+                self.vendors = vendors_df
+            if isinstance(item_groups_df, Exception):
+                logger.error(f"Using cached item groups; refresh from SAP failed: {item_groups_df}")
+            # A failed attempt waits out the TTL too, rather than holding every request on SAP
+            self.refreshed_at = time.monotonic()
+            return self.vendors
+
+
+master_data_cache = MasterDataCache(async_sap_client)
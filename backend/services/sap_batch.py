@@ -0,0 +1,201 @@
+import json
+import logging
+import re
+import uuid
+from typing import Any, Optional
+from pydantic import BaseModel
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+BOUNDARY_PATTERN = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+
+
+class BatchOperation(BaseModel):
+    method: str
+    path: str
+    body: Optional[Any] = None
+
+
+class BatchResult(BaseModel):
+    status_code: int
+    body: Any = None
+    content_id: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 300
+
+
+def sap_error_detail(body: Any, default: str = "Unknown error") -> str:
+    """Reads the message of a Service Layer error payload."""
+    if isinstance(body, dict):
+        message = body.get("error", {}).get("message", {})
+        if isinstance(message, dict):
+            return message.get("value", default)
+        return str(message or default)
+    return str(body) if body else default
+
+
+def build_batch_body(changesets: list[list[BatchOperation]], path_prefix: str) -> tuple[str, str]:
+    """
+    Builds a Service Layer $batch request with one changeset per entry. Operations in a
+    changeset are committed together; a failure rolls back only its own changeset.
+    Returns the batch boundary and the request body.
+    """
+    batch_boundary = f"batch_{uuid.uuid4().hex}"
+    lines = []
+    content_id = 0
+    for changeset in changesets:
+        changeset_boundary = f"changeset_{uuid.uuid4().hex}"
+        lines += [f"--{batch_boundary}", f"Content-Type: multipart/mixed;boundary={changeset_boundary}", ""]
+        for operation in changeset:
+            content_id += 1
+            lines += [
+                f"--{changeset_boundary}",
+                "Content-Type: application/http",
+                "Content-Transfer-Encoding: binary",
+                f"Content-ID: {content_id}",
+                "",
+                f"{operation.method} {path_prefix}{operation.path}",
+                "Content-Type: application/json",
+                "",
+                json.dumps(operation.body) if operation.body is not None else "",
+            ]
+        lines += [f"--{changeset_boundary}--"]
+    lines.append(f"--{batch_boundary}--")
+    return batch_boundary, "\r\n".join(lines) + "\r\n"
+
+
+def boundary_of(content_type: str) -> Optional[str]:
+    match = BOUNDARY_PATTERN.search(content_type or "")
+    return match.group(1) if match else None
+
+
+def split_parts(body: str, boundary: str) -> list[str]:
+    parts = []
+    for chunk in body.split(f"--{boundary}")[1:]:
+        if chunk.startswith("--"):
+            break
+        parts.append(chunk.strip("\r\n"))
+    return parts
+
+
+def split_headers(part: str) -> tuple[dict, str]:
+    head, _, rest = part.replace("\r\n", "\n").partition("\n\n")
+    headers = {}
+    for line in head.split("\n"):
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    return headers, rest
+
+
+def parse_http_part(part: str) -> BatchResult:
+    part_headers, http_message = split_headers(part)
+    status_line, _, rest = http_message.strip("\n").partition("\n")
+    response_headers, body = split_headers(rest) if rest else ({}, "")
+    body = body.strip()
+    try:
+        parsed_body = json.loads(body) if body else None
+    except json.JSONDecodeError:
+        parsed_body = body
+    return BatchResult(
+        status_code=int(status_line.split()[1]),
+        body=parsed_body,
+        content_id=part_headers.get("content-id") or response_headers.get("content-id")
+    )
+
+
+def parse_batch_response(content_type: str, body: str) -> list[list[BatchResult]]:
+    """
+    Parses a $batch response into one list of results per changeset, in request order.
+    A failed changeset comes back as a single error response instead of one per operation.
+    """
+    boundary = boundary_of(content_type)
+    if not boundary:
+        raise ValueError(f"No multipart boundary in $batch response content type: {content_type}")
+
+    changesets = []
+    for part in split_parts(body, boundary):
+        headers, content = split_headers(part)
+        changeset_boundary = boundary_of(headers.get("content-type", ""))
+        if changeset_boundary:
+            changesets.append([parse_http_part(inner) for inner in split_parts(content, changeset_boundary)])
+        else:
+            changesets.append([parse_http_part(part)])
+    return changesets
+
+
+def entity_results(count: int, changesets) -> list[dict]:
+    """
+    Turns the reply to `count` single-operation changesets into one dict per entity:
+    the created entity, or {"error": True, ...}. `changesets` may be the exception
+    raised while sending the request.
+    """
+    if isinstance(changesets, Exception):
+        return [{"error": True, "detail": str(changesets)} for _ in range(count)]
+    results = []
+    for position in range(count):
+        if position >= len(changesets):
+            results.append({"error": True, "detail": "No response returned for this entity in the $batch reply."})
+            continue
+        result = changesets[position][0]
+        if result.ok:
+            results.append(result.body if isinstance(result.body, dict) else {})
+        else:
+            results.append({"error": True, "status_code": result.status_code, "detail": sap_error_detail(result.body)})
+    return results
+
+
+def collect_new_items(invoices: list[dict]) -> dict:
+    """Returns the NewItem specs of lines without an ItemCode, deduplicated by lowercased name."""
+    new_items = {}
+    for invoice in invoices:
+        for line in invoice.get("DocumentLines", []):
+            item = line.get("NewItem")
+            if item and not line.get("ItemCode"):
+                new_items.setdefault(item["ItemName"].strip().lower(), item)
+    return new_items
+
+
+def prepare_invoice_payloads(invoices: list[dict], created_items: dict) -> tuple[dict, list]:
+    """
+    Fills the codes of created items into the invoice lines. Returns the payloads to post
+    by invoice index, and the result list with errors for invoices whose items failed.
+    """
+    results = [None] * len(invoices)
+    payloads = {}
+    for index, invoice in enumerate(invoices):
+        lines, failed_item = [], None
+        for line in invoice.get("DocumentLines", []):
+            line = dict(line)
+            item = line.pop("NewItem", None)
+            if item and not line.get("ItemCode"):
+                created = created_items[item["ItemName"].strip().lower()]
+                if created.get("error"):
+                    failed_item = (item["ItemName"], created)
+                    break
+                line["ItemCode"] = created["ItemCode"]
+                if line.get("UoMEntry") is None and created.get("InventoryUoMEntry") is not None:
+                    line["UoMEntry"] = created["InventoryUoMEntry"]
+            lines.append(line)
+
+        if failed_item:
+            item_name, created = failed_item
+            results[index] = {
+                "index": index,
+                "status": "error",
+                "status_code": created.get("status_code"),
+                "detail": f"Item '{item_name}' could not be created: {created.get('detail')}"
+            }
+        else:
+            payloads[index] = {**invoice, "DocumentLines": lines}
+    return payloads, results
+
+
+def invoice_batch_result(index: int, result: dict) -> dict:
+    if result.get("error"):
+        logger.error(f"Failed to post purchase invoice {index} in batch. Status: {result.get('status_code')}, Error: {result.get('detail')}")
+        return {"index": index, "status": "error", "status_code": result.get("status_code"), "detail": result.get("detail")}
+    return {"index": index, "status": "success", "DocEntry": result.get("DocEntry"), "data": result}
@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+from urllib.parse import quote
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from backend.core.config import settings
+from backend.database import sap_outbox
+from backend.services.sap_async import async_sap_client
+from backend.services.sap_batch import BatchOperation
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+POSTING = "posting"
+POSTED = "posted"
+FAILED = "failed"
+# The outcome of an earlier attempt is unknown and SAP could not be checked, so it is not posted again
+NEEDS_REVIEW = "needs_review"
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+OUTBOX_PROJECTION = {"_id": 0, "claim_id": 0}
+
+
+def invoice_total(invoice: dict) -> Optional[float]:
+    if invoice.get("DocTotal") is not None:
+        return round(float(invoice["DocTotal"]), 2)
+    lines = invoice.get("DocumentLines") or []
+    if lines and all(line.get("Quantity") is not None and line.get("UnitPrice") is not None for line in lines):
+        return round(sum(line["Quantity"] * line["UnitPrice"] for line in lines), 2)
+    return None
+
+
+def idempotency_key(invoice: dict) -> str:
+    """
+    CardCode + NumAtCard + total identifies a vendor invoice. Without a NumAtCard the
+    whole payload is used, so only exact resubmissions are treated as duplicates.
+    """
+    if invoice.get("NumAtCard"):
+        return f"{invoice['CardCode']}|{invoice['NumAtCard']}|{invoice_total(invoice)}"
+    payload = json.dumps(invoice, sort_keys=True, default=str)
+    return f"{invoice['CardCode']}|payload:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+def posting_id_for(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class SAPOutbox:
+    """
+    Durable queue of purchase invoices for SAP. The API only inserts into Mongo; a background
+    task claims due entries, posts them with $batch, and retries with backoff. An entry whose
+    previous attempt may have reached SAP is looked up in SAP before it is posted again.
+    """
+
+    def __init__(self, store=sap_outbox, client=async_sap_client):
+        self.store = store
+        self.client = client
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def enqueue(self, invoice: dict, document_uid: Optional[int] = None) -> tuple[dict, bool]:
+        """Stores the invoice for posting. Returns the outbox entry and whether it was new."""
+        key = idempotency_key(invoice)
+        now = utcnow()
+        entry = {
+            "posting_id": posting_id_for(key),
+            "idempotency_key": key,
+            "status": PENDING,
+            "payload": invoice,
+            "document_uid": document_uid,
+            "attempts": 0,
+            "uncertain": False,
+            "next_attempt_at": now,
+            "created_at": now,
+            "updated_at": now,
+            "doc_entry": None,
+            "last_error": None,
+        }
+        try:
+            self.store.insert_one(entry)
+        except DuplicateKeyError:
+            logger.info(f"Purchase invoice {key} is already in the outbox.")
+            return self.store.find_one({"idempotency_key": key}, OUTBOX_PROJECTION), False
+        self.wake()
+        entry.pop("_id", None)
+        return entry, True
+
+    def get(self, posting_id: str) -> Optional[dict]:
+        return self.store.find_one({"posting_id": posting_id}, OUTBOX_PROJECTION)
+
+    def recent(self, status: Optional[str] = None, limit: int = 100) -> list[dict]:
+        query = {"status": status} if status else {}
+        return list(self.store.find(query, OUTBOX_PROJECTION).sort("created_at", -1).limit(limit))
+
+    def claim(self, limit: int) -> list[dict]:
+        """Atomically takes up to `limit` due entries, including ones whose previous claim expired."""
+        now = utcnow()
+        claimed = []
+        sources = [
+            # A claim that expired mid-post may have reached SAP
+            ({"status": POSTING, "lease_until": {"$lt": now}}, {"uncertain": True}),
+            ({"status": PENDING, "next_attempt_at": {"$lte": now}}, {}),
+        ]
+        for query, extra in sources:
+            while len(claimed) < limit:
+                entry = self.store.find_one_and_update(
+                    query,
+                    {
+                        "$set": {
+                            **extra,
+                            "status": POSTING,
+                            "claim_id": uuid.uuid4().hex,
+                            "lease_until": now + timedelta(seconds=settings.SAP_OUTBOX_LEASE_SECONDS),
+                            "updated_at": now,
+                        },
+                        "$inc": {"attempts": 1}
+                    },
+                    sort=[("next_attempt_at", 1)],
+                    return_document=ReturnDocument.AFTER
+                )
+                if not entry:
+                    break
+                claimed.append(entry)
+        return claimed
+
+    def finish(self, entry: dict, update: dict):
+        # Only the holder of the current claim may record the outcome
+        update = {**update, "updated_at": utcnow()}
+        self.store.update_one(
+            {"posting_id": entry["posting_id"], "claim_id": entry["claim_id"]},
+            {"$set": update, "$unset": {"lease_until": "", "claim_id": ""}}
+        )
+
+    def retry_later(self, entry: dict, error: str, uncertain: bool):
+        if entry["attempts"] >= settings.SAP_OUTBOX_MAX_ATTEMPTS:
+            status = NEEDS_REVIEW if uncertain else FAILED
+            logger.error(f"Giving up on posting {entry['posting_id']} after {entry['attempts']} attempt(s): {error}")
+            self.finish(entry, {"status": status, "last_error": error, "uncertain": uncertain})
+            return
+        delay = min(settings.SAP_OUTBOX_BACKOFF_MAX_SECONDS, settings.SAP_OUTBOX_BACKOFF_BASE_SECONDS * 2 ** (entry["attempts"] - 1))
+        delay *= random.uniform(0.5, 1.0)
+        logger.warning(f"Posting {entry['posting_id']} failed ({error}); retrying in {delay:.0f}s")
+        self.finish(entry, {
+            "status": PENDING,
+            "last_error": error,
+            "uncertain": uncertain,
+            "next_attempt_at": utcnow() + timedelta(seconds=delay)
+        })
+
+    def record_result(self, entry: dict, result: dict):
+        if not result.get("error"):
+            logger.info(f"Posting {entry['posting_id']} created DocEntry {result.get('DocEntry')} in SAP.")
+            self.finish(entry, {"status": POSTED, "doc_entry": result.get("DocEntry"), "last_error": None, "uncertain": False})
+            return
+
+        status_code = result.get("status_code")
+        error = f"SAP Error: {result.get('detail', 'Unknown error')}"
+        if status_code is None:
+            # The $batch request itself failed, so SAP may or may not have executed it
+            self.retry_later(entry, error, uncertain=True)
+        elif status_code in RETRYABLE_STATUS_CODES:
+            # A failed changeset is rolled back, so nothing was posted
+            self.retry_later(entry, error, uncertain=False)
+        else:
+            logger.error(f"Posting {entry['posting_id']} rejected by SAP: {error}")
+            self.finish(entry, {"status": FAILED, "last_error": error, "uncertain": False})
+
+    async def find_in_sap(self, invoice: dict) -> Optional[dict]:
+        """Looks up a posted purchase invoice by CardCode and NumAtCard."""
+        def literal(value) -> str:
+            return "'" + str(value).replace("'", "''") + "'"
+
+        query = f"CardCode eq {literal(invoice['CardCode'])} and NumAtCard eq {literal(invoice['NumAtCard'])}"
+        url = f"{self.client.base_url}PurchaseInvoices?$filter={quote(query)}&$select=DocEntry,DocTotal"
+        response = await self.client.get(url)
+        response.raise_for_status()
+        matches = response.json().get("value", [])
+        return matches[0] if matches else None
+
+    async def reconcile(self, entry: dict) -> bool:
+        """
+        Settles an entry whose previous attempt may have been posted. Returns True when the
+        entry was handled here, False when SAP has no such invoice and it should be posted.
+        """
+        invoice = entry["payload"]
+        if not invoice.get("NumAtCard"):
+            await asyncio.to_thread(self.finish, entry, {
+                "status": NEEDS_REVIEW,
+                "last_error": "An earlier attempt may have reached SAP and the invoice has no NumAtCard to look it up."
+            })
+            return True
+        try:
+            existing = await self.find_in_sap(invoice)
+        except Exception as e:
+            await asyncio.to_thread(self.retry_later, entry, f"Could not check SAP for an earlier posting: {e}", True)
+            return True
+        if existing:
+            logger.info(f"Posting {entry['posting_id']} was already in SAP as DocEntry {existing.get('DocEntry')}.")
+            await asyncio.to_thread(self.finish, entry, {"status": POSTED, "doc_entry": existing.get("DocEntry"), "last_error": None, "uncertain": False})
+            return True
+        return False
+
+    async def drain_once(self) -> int:
+        """Posts one batch of due entries. Returns the number of entries claimed."""
+        entries = await asyncio.to_thread(self.claim, settings.SAP_BATCH_SIZE)
+        if not entries:
+            return 0
+
+        to_post = []
+        for entry in entries:
+            if entry.get("uncertain") and await self.reconcile(entry):
+                continue
+            to_post.append(entry)
+
+        if to_post:
+            logger.info(f"Draining {len(to_post)} purchase invoice(s) from the SAP outbox.")
+            results = await self.client.post_batch([
+                BatchOperation(method="POST", path="PurchaseInvoices", body=entry["payload"]) for entry in to_post
+            ])
+            for entry, result in zip(to_post, results):
+                await asyncio.to_thread(self.record_result, entry, result)
+        return len(entries)
+
+    def wake(self):
+        """Starts a drain now instead of at the next poll; safe to call from any thread."""
+        if self._wake is None or self._loop is None:
+            return
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self._wake.set()
+        else:
+            # enqueue runs in to_thread workers; asyncio.Event is not thread-safe
+            try:
+                self._loop.call_soon_threadsafe(self._wake.set)
+            except RuntimeError:
+                # The loop was closed while shutting down
+                pass
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                if await self.drain_once():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error draining the SAP outbox: {e}")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=settings.SAP_OUTBOX_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+            logger.info("SAP outbox drainer started.")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+sap_outbox_drainer = SAPOutbox()
@@ -0,0 +1,132 @@
+import logging
+import queue
+import time
+from contextlib import contextmanager
+from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from backend.services.metrics import observe_sap
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Consecutive failed requests after which a session logs in again before its next use
+UNHEALTHY_AFTER_FAILURES = 3
+
+
+class SAPLoginError(Exception):
+    pass
+
+
+class SAPSession:
+    """One authenticated Service Layer session and its health counters."""
+
+    def __init__(self, index: int, base_url: str, creds: dict, adapter: HTTPAdapter):
+        self.index = index
+        self.base_url = base_url
+        self.creds = creds
+        self.http = requests.Session()
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.logged_in = False
+        self.logins = 0
+        self.requests = 0
+        self.consecutive_failures = 0
+        self.last_error: Optional[str] = None
+        self.last_used: Optional[float] = None
+
+    def login(self):
+        self.http.cookies.clear()
+        try:
+            with observe_sap("POST", "Login") as observed:
+                response = self.http.post(f"{self.base_url}Login", json=self.creds, verify=False)
+                observed["status_code"] = response.status_code
+        except requests.exceptions.RequestException as e:
+            self.logged_in = False
+            self.last_error = f"Login request failed: {e}"
+            raise SAPLoginError(self.last_error) from e
+        if response.status_code != 200:
+            self.logged_in = False
+            self.last_error = f"Login failed with status code: {response.status_code}"
+            raise SAPLoginError(self.last_error)
+        self.logged_in = True
+        self.logins += 1
+        self.consecutive_failures = 0
+        logger.info(f"SAP session {self.index} logged in.")
+
+    @property
+    def healthy(self) -> bool:
+        return self.logged_in and self.consecutive_failures < UNHEALTHY_AFTER_FAILURES
+
+    def health(self) -> dict:
+        return {
+            "session": self.index,
+            "healthy": self.healthy,
+            "logged_in": self.logged_in,
+            "logins": self.logins,
+            "requests": self.requests,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1) if self.last_used else None,
+        }
+
+
+class SAPSessionPool:
+    """
+    A fixed pool of Service Layer sessions sharing one keep-alive connection pool of the
+    same size. Each request checks a session out, logs it in when needed, and logs in
+    again once and retries when the Service Layer answers 401 (session timed out).
+    """
+
+    def __init__(self, base_url: str, creds: dict, size: int):
+        self.base_url = base_url
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, size))
+        self.sessions = [SAPSession(index, base_url, creds, adapter) for index in range(max(1, size))]
+        self._idle = queue.Queue()
+        for session in self.sessions:
+            self._idle.put(session)
+
+    @contextmanager
+    def checkout(self):
+        session = self._idle.get()
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def login_one(self):
+        """Logs in one session up front so bad credentials are reported at startup."""
+        with self.checkout() as session:
+            session.login()
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        with self.checkout() as session:
+            if not session.healthy:
+                session.login()
+            response = self._send(session, method, url, **kwargs)
+            if response.status_code == 401:
+                logger.warning(f"SAP session {session.index} expired; logging in again.")
+                session.login()
+                response = self._send(session, method, url, **kwargs)
+            return response
+
+    def _send(self, session: SAPSession, method: str, url: str, **kwargs) -> requests.Response:
+        session.requests += 1
+        session.last_used = time.monotonic()
+        try:
+            with observe_sap(method, url) as observed:
+                response = session.http.request(method, url, verify=False, **kwargs)
+                observed["status_code"] = response.status_code
+        except requests.exceptions.RequestException as e:
+            session.consecutive_failures += 1
+            session.last_error = str(e)
+            raise
+        if response.status_code >= 500 or response.status_code == 401:
+            session.consecutive_failures += 1
+            session.last_error = f"HTTP {response.status_code}"
+        else:
+            session.consecutive_failures = 0
+        return response
+
+    def health(self) -> list[dict]:
+        return [session.health() for session in self.sessions]
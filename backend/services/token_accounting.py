@@ -0,0 +1,243 @@
+"""
+Token accounting and per-document token budgets for every prompt sent through the LLM gateway.
+
+Callers mark the document they work on with charge_to(uid); the mark is a context variable,
+so it follows the request into asyncio tasks and to_thread workers. Each generate() call is
+then checked against the document's budget before it is sent and recorded afterwards, per
+call in `llm_usage` and summed per day, model and stage in `llm_usage_daily`.
+"""
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+from ..core.config import settings
+from ..database import llm_usage, llm_usage_daily
+from .llm_gateway import estimate_tokens, llm_gateway
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROMPT_PREVIEW_CHARS = 300
+
+
+class TokenBudgetExceeded(Exception):
+    def __init__(self, uid: int, stage: str, needed: int, remaining: int):
+        super().__init__(
+            f"Token budget of document {uid} exceeded at stage '{stage}': "
+            f"the prompt needs ~{needed} tokens but only {remaining} of {settings.LLM_DOCUMENT_TOKEN_BUDGET} remain."
+        )
+        self.uid = uid
+        self.stage = stage
+        self.needed = needed
+        self.remaining = remaining
+
+
+class DocumentBudget:
+    """Tokens one document has used so far, shared by every thread working on it in this request."""
+
+    def __init__(self, uid: int):
+        self.uid = uid
+        self._used: Optional[int] = None
+        self._reserved = 0
+        self._lock = threading.Lock()
+
+    def _load(self) -> int:
+        # Earlier requests (extraction, classification, mapping) count against the same budget
+        if self._used is None:
+            totals = list(llm_usage.aggregate([
+                {"$match": {"uid": self.uid}},
+                {"$group": {"_id": None, "tokens": {"$sum": "$total_tokens"}}}
+            ]))
+            self._used = totals[0]["tokens"] if totals else 0
+        return self._used
+
+    def remaining(self) -> int:
+        with self._lock:
+            return settings.LLM_DOCUMENT_TOKEN_BUDGET - self._load() - self._reserved
+
+    def reserve(self, tokens: int) -> bool:
+        with self._lock:
+            if self._load() + self._reserved + tokens > settings.LLM_DOCUMENT_TOKEN_BUDGET:
+                return False
+            self._reserved += tokens
+            return True
+
+    def settle(self, reserved: int, used: int):
+        with self._lock:
+            self._reserved -= reserved
+            self._used = self._load() + used
+
+
+current_budget: ContextVar[Optional[DocumentBudget]] = ContextVar("current_budget", default=None)
+
+
+@contextmanager
+def charge_to(uid: int):
+    """Charges the model calls made inside the block to document `uid`."""
+    token = current_budget.set(DocumentBudget(uid))
+    try:
+        yield
+    finally:
+        current_budget.reset(token)
+
+
+def truncate_middle(text: str, max_chars: int) -> str:
+    """Keeps the start and the end of a text, where invoices put their parties and their totals."""
+    if len(text) <= max_chars:
+        return text
+    marker = f"\n[... {len(text) - max_chars} characters omitted to fit the token budget ...]\n"
+    head = max(0, (max_chars - len(marker)) * 2 // 3)
+    tail = max(0, max_chars - len(marker) - head)
+    return text[:head] + marker + (text[-tail:] if tail else "")
+
+
+class TokenAccountant:
+    """Installed on the LLM gateway: admits prompts against the budget and records their usage."""
+
+    def admit(self, model: str, stage: str, prompt: str, system: Optional[str], degrade: Optional[Callable[[int], str]]) -> tuple[str, int, bool]:
+        """
+        Returns the prompt to send, its estimated tokens and whether it was degraded. Raises
+        TokenBudgetExceeded when it does not fit and cannot be shortened to fit.
+        """
+        estimated = estimate_tokens(prompt + (system or ""))
+        budget = current_budget.get()
+        if budget is None or settings.LLM_DOCUMENT_TOKEN_BUDGET <= 0:
+            return prompt, estimated, False
+        if budget.reserve(estimated):
+            return prompt, estimated, False
+
+        remaining = budget.remaining()
+        if degrade is not None and settings.LLM_BUDGET_POLICY == "degrade" and remaining > 0:
+            shorter = degrade(remaining)
+            shorter_estimate = estimate_tokens(shorter + (system or ""))
+            if budget.reserve(shorter_estimate):
+                logger.warning(
+                    f"Prompt for '{stage}' of document {budget.uid} shortened from ~{estimated} to ~{shorter_estimate} tokens to fit the budget."
+                )
+                return shorter, shorter_estimate, True
+
+        self.record(model, stage, prompt, estimated, 0, 0, 0, "rejected", False)
+        raise TokenBudgetExceeded(budget.uid, stage, estimated, max(0, remaining))
+
+    def record(self, model: str, stage: str, prompt: str, estimated: int, prompt_tokens: int, completion_tokens: int,
+               latency_ms: float, status: str, degraded: bool):
+        budget = current_budget.get()
+        # Providers that report no usage are charged the estimate
+        prompt_tokens = prompt_tokens or (estimated if status == "success" else 0)
+        total_tokens = prompt_tokens + completion_tokens
+        if budget is not None and status != "rejected" and settings.LLM_DOCUMENT_TOKEN_BUDGET > 0:
+            budget.settle(estimated, total_tokens)
+
+        now = datetime.now(timezone.utc)
+        day = now.strftime("%Y-%m-%d")
+        try:
+            llm_usage.insert_one({
+                "uid": budget.uid if budget is not None else None,
+                "model": model,
+                "stage": stage,
+                "status": status,
+                "degraded": degraded,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": total_tokens,
+                "estimated_prompt_tokens": estimated,
+                "latency_ms": round(latency_ms, 1),
+                "prompt_chars": len(prompt),
+                "prompt_hash": hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16],
+                "prompt_preview": prompt.strip()[:PROMPT_PREVIEW_CHARS],
+                "day": day,
+                "created_at": now
+            })
+            llm_usage_daily.update_one(
+                {"_id": f"{day}|{model}|{stage}"},
+                {
+                    "$setOnInsert": {"day": day, "model": model, "stage": stage},
+                    "$inc": {
+                        "calls": 1,
+                        "errors": int(status == "error"),
+                        "rejected": int(status == "rejected"),
+                        "degraded": int(degraded),
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": total_tokens,
+                        "latency_ms_total": round(latency_ms, 1)
+                    }
+                },
+                upsert=True
+            )
+        except Exception as e:
+            # Accounting must never fail the call it accounts for
+            logger.error(f"Could not record token usage for '{stage}': {e}")
+
+
+token_accountant = TokenAccountant()
+llm_gateway.accounting = token_accountant
+
+
+def usage_totals(match: dict, group_by: dict) -> list[dict]:
+    return list(llm_usage.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": group_by,
+            "calls": {"$sum": 1},
+            "prompt_tokens": {"$sum": "$prompt_tokens"},
+            "completion_tokens": {"$sum": "$completion_tokens"},
+            "total_tokens": {"$sum": "$total_tokens"},
+            "latency_ms": {"$sum": "$latency_ms"}
+        }},
+        {"$sort": {"total_tokens": -1}}
+    ]))
+
+
+def document_usage(uid: int) -> dict:
+    """Every model call charged to a document, with totals per model and stage."""
+    calls = list(llm_usage.find({"uid": uid}, {"_id": 0, "uid": 0, "prompt_preview": 0}).sort("created_at", 1))
+    for call in calls:
+        call["created_at"] = call["created_at"].isoformat()
+    by_stage = [
+        {**row.pop("_id"), **row}
+        for row in usage_totals({"uid": uid}, {"model": "$model", "stage": "$stage"})
+    ]
+    return {
+        "document_uid": uid,
+        "budget": settings.LLM_DOCUMENT_TOKEN_BUDGET or None,
+        "total_tokens": sum(call["total_tokens"] for call in calls),
+        "by_model_and_stage": by_stage,
+        "calls": calls
+    }
+
+
+def first_day(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=max(1, days) - 1)).strftime("%Y-%m-%d")
+
+
+def daily_usage(days: int) -> list[dict]:
+    return list(llm_usage_daily.find({"day": {"$gte": first_day(days)}}, {"_id": 0}).sort([("day", -1), ("total_tokens", -1)]))
+
+
+def top_prompts(limit: int, days: int) -> list[dict]:
+    """The most expensive prompts; identical prompts are grouped by their hash."""
+    return list(llm_usage.aggregate([
+        {"$match": {"day": {"$gte": first_day(days)}, "status": "success"}},
+        {"$sort": {"total_tokens": -1}},
+        {"$group": {
+            "_id": "$prompt_hash",
+            "calls": {"$sum": 1},
+            "total_tokens": {"$sum": "$total_tokens"},
+            "max_tokens": {"$max": "$total_tokens"},
+            "model": {"$first": "$model"},
+            "stage": {"$first": "$stage"},
+            "document_uids": {"$addToSet": "$uid"},
+            "prompt_chars": {"$first": "$prompt_chars"},
+            "prompt_preview": {"$first": "$prompt_preview"}
+        }},
+        {"$sort": {"total_tokens": -1}},
+        {"$limit": limit},
+        {"$project": {
+            "_id": 0, "prompt_hash": "$_id", "calls": 1, "total_tokens": 1, "max_tokens": 1, "model": 1,
+            "stage": 1, "document_uids": 1, "prompt_chars": 1, "prompt_preview": 1
+        }}
+    ]))
@@ -0,0 +1,273 @@
+"""
+Per-request trace with nested timing spans, and an on-demand sampling profiler.
+
+The trace of the current request lives in a context variable, so spans opened in the
+event loop, in asyncio tasks and in asyncio.to_thread workers nest under the right parent.
+Outside a traced request span() does nothing beyond one context variable lookup.
+
+Profiling samples the stacks of the threads that are running the request's spans, since
+most of a request's CPU time is spent in worker threads that cProfile and pyinstrument,
+bound to the thread that started them, would not see.
+"""
+import logging
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Any, Optional
+from ..core.config import settings
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = "X-Trace-Id"
+PROFILE_HEADER = "X-Profile"
+TRACE_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+# Bounds the stored tree; master-data refreshes alone page through hundreds of SAP requests
+MAX_SPANS = 500
+MAX_STACK_DEPTH = 64
+PROFILES_KEPT = 20
+
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "name", "attributes", "started", "duration_ms", "children")
+
+    def __init__(self, trace: "Trace", name: str, attributes: dict, started: float):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+        self.started = started
+        self.duration_ms: Optional[float] = None
+        self.children: list[Span] = []
+
+    def to_dict(self) -> dict:
+        data = {
+            "name": self.name,
+            "start_ms": round((self.started - self.trace.started) * 1000, 3),
+            "duration_ms": round(self.duration_ms, 3) if self.duration_ms is not None else None,
+        }
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.children:
+            data["children"] = [child.to_dict() for child in sorted(self.children, key=lambda child: child.started)]
+        return data
+
+
+class Trace:
+    def __init__(self, trace_id: str, name: str):
+        self.trace_id = trace_id
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.root = Span(self, name, {}, self.started)
+        self.document_uids: set[int] = set()
+        # Threads currently inside one of this trace's spans, with their nesting depth
+        self.threads: Counter = Counter()
+        self.span_count = 0
+        self.dropped_spans = 0
+        self._lock = threading.Lock()
+
+    def add(self, parent: Span, span: Span):
+        with self._lock:
+            if self.span_count >= MAX_SPANS:
+                self.dropped_spans += 1
+                return
+            self.span_count += 1
+            parent.children.append(span)
+
+    def enter_thread(self, ident: int):
+        with self._lock:
+            self.threads[ident] += 1
+
+    def leave_thread(self, ident: int):
+        with self._lock:
+            self.threads[ident] -= 1
+            if self.threads[ident] <= 0:
+                del self.threads[ident]
+
+    def finish(self):
+        self.root.duration_ms = (time.perf_counter() - self.started) * 1000
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "trace_id": self.trace_id,
+                "started_at": self.started_at.isoformat(),
+                "duration_ms": round(self.root.duration_ms, 3) if self.root.duration_ms is not None else None,
+                "dropped_spans": self.dropped_spans,
+                "spans": self.root.to_dict()
+            }
+
+
+def trace_id_from(header: Optional[str]) -> str:
+    """The caller's trace id when it is a sane token, otherwise a new one."""
+    if header and TRACE_ID_PATTERN.match(header):
+        return header
+    return uuid.uuid4().hex
+
+
+def start_trace(trace_id: str, name: str):
+    """Makes a new trace current; pass the returned token to end_trace."""
+    trace = Trace(trace_id, name)
+    return trace, current_span.set(trace.root)
+
+
+def end_trace(trace: Trace, token):
+    trace.finish()
+    current_span.reset(token)
+
+
+def current_trace() -> Optional[Trace]:
+    parent = current_span.get()
+    return parent.trace if parent is not None else None
+
+
+def attach_document(uid: int):
+    """Marks a document as processed by the current request, so the trace is stored with it."""
+    parent = current_span.get()
+    if parent is not None and uid is not None:
+        parent.trace.document_uids.add(uid)
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    trace = parent.trace
+    child = Span(trace, name, attributes, time.perf_counter())
+    trace.add(parent, child)
+    ident = threading.get_ident()
+    trace.enter_thread(ident)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        child.duration_ms = (time.perf_counter() - child.started) * 1000
+        current_span.reset(token)
+        trace.leave_thread(ident)
+
+
+def record_span(name: str, duration_ms: float, **attributes: Any):
+    """Adds a span measured elsewhere (e.g. by a driver event) that ended just now."""
+    parent = current_span.get()
+    if parent is None:
+        return
+    child = Span(parent.trace, name, attributes, time.perf_counter() - duration_ms / 1000)
+    child.duration_ms = duration_ms
+    parent.trace.add(parent, child)
+
+
+class StackSampler:
+    """Samples the stacks of a trace's active threads at a fixed interval in a daemon thread."""
+
+    def __init__(self, trace: Trace, interval_ms: float):
+        self.trace = trace
+        self.interval = max(0.001, interval_ms / 1000)
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{trace.trace_id[:8]}", daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+
+    def _run(self):
+        names = {}
+        while not self._stopped.wait(self.interval):
+            with self.trace._lock:
+                idents = list(self.trace.threads)
+            if not idents:
+                continue
+            frames = sys._current_frames()
+            for ident in idents:
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                if ident not in names:
+                    names[ident] = next((thread.name for thread in threading.enumerate() if thread.ident == ident), str(ident))
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename.rsplit("/", 1)[-1], frame.f_lineno))
+                    frame = frame.f_back
+                stack.append((names[ident], "thread", 0))
+                self.samples[tuple(reversed(stack))] += 1
+                self.sample_count += 1
+
+    def stop(self) -> dict:
+        self._stopped.set()
+        self._thread.join()
+        own, total = Counter(), Counter()
+        for stack, count in self.samples.items():
+            name, file, line = stack[-1]
+            own[f"{name} ({file}:{line})"] += count
+            # A recursive function counts once per sample
+            for function in {f"{name} ({file})" for name, file, _ in stack[1:]}:
+                total[function] += count
+        return {
+            "trace_id": self.trace.trace_id,
+            "interval_ms": self.interval * 1000,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 3),
+            "samples": self.sample_count,
+            "top_self": [{"function": function, "samples": count} for function, count in own.most_common(25)],
+            "top_total": [{"function": function, "samples": count} for function, count in total.most_common(25)],
+            # Collapsed stacks, the input format of flamegraph.pl and speedscope
+            "folded": [
+                ";".join(f"{name} ({file}:{line})" if line else name for name, file, line in stack) + f" {count}"
+                for stack, count in self.samples.most_common()
+            ]
+        }
+
+
+class Profiler:
+    """Decides which requests are profiled and keeps their recent profiles in memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.armed = 0
+        self.path_prefix = ""
+        self.profiles: OrderedDict[str, dict] = OrderedDict()
+
+    def authorized(self, token: Optional[str]) -> bool:
+        return bool(settings.PROFILING_TOKEN) and token == settings.PROFILING_TOKEN
+
+    def arm(self, requests: int, path_prefix: str = ""):
+        with self._lock:
+            self.armed = requests
+            self.path_prefix = path_prefix
+
+    def should_profile(self, path: str, header_token: Optional[str]) -> bool:
+        if path.startswith("/debug"):
+            return False
+        if header_token is not None:
+            return self.authorized(header_token)
+        with self._lock:
+            if self.armed > 0 and path.startswith(self.path_prefix):
+                self.armed -= 1
+                return True
+        return False
+
+    def store(self, profile: dict):
+        with self._lock:
+            self.profiles[profile["trace_id"]] = profile
+            while len(self.profiles) > PROFILES_KEPT:
+                self.profiles.popitem(last=False)
+
+    def get(self, trace_id: str) -> Optional[dict]:
+        with self._lock:
+            return self.profiles.get(trace_id)
+
+
+profiler = Profiler()
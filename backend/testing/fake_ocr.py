@@ -0,0 +1,31 @@
+"""
+Local stand-in for Mistral OCR, for tests and benchmarks. Enabled with OCR_BACKEND=fake.
+
+Reads the text layer of the PDF with PyMuPDF in the CPU pool, so synthetic invoices come
+back as the text they were generated from. FAKE_OCR_LATENCY_MS adds a delay per page and
+FAKE_OCR_ERROR_RATE makes a share of calls fail with a retryable 503.
+"""
+import random
+import time
+import httpx
+from ..services import cpu_tasks
+from ..services.cpu_pool import cpu_pool
+
+
+class FakeOCR:
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+
+    def process(self, file_path: str) -> list[str]:
+        """Returns the markdown of every page, like ocr.process(...).pages."""
+        pages = cpu_pool.call("pdf_text", cpu_tasks.pdf_text_pages, file_path)
+        if self.latency_ms:
+            time.sleep(self.latency_ms * max(1, len(pages)) / 1000)
+        if self.error_rate and random.random() < self.error_rate:
+            raise httpx.HTTPStatusError(
+                "Fake OCR error",
+                request=httpx.Request("POST", "http://fake-ocr"),
+                response=httpx.Response(503)
+            )
+        return pages
@@ -0,0 +1,275 @@
+"""
+Local stand-in for the SAP Business One Service Layer, for tests and benchmarks.
+
+    uvicorn backend.testing.fake_sap:app --port 50000
+
+then point the service at it with BASE_URL=http://localhost:50000/b1s/v1/.
+Master data is seeded from the CSVs in backend/assets. Supports Login, paged GETs
+of the collections SAPClient reads (with `Field eq 'value'` $filter), POST Items,
+POST PurchaseInvoices and $batch with changesets. FAKE_SAP_LATENCY_MS adds a delay to every request and
+FAKE_SAP_SESSION_TIMEOUT_SECONDS expires sessions so re-login can be exercised.
+"""
+import asyncio
+import copy
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Optional
+import pandas as pd
+from fastapi import FastAPI, Request, Response
+from backend.services.sap_batch import boundary_of, split_headers, split_parts
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+ASSETS_DIR = Path(__file__).resolve().parents[1] / "assets"
+PAGE_SIZE = 20
+FILTER_CLAUSE = re.compile(r"(\w+)\s+eq\s+(?:'((?:[^']|'')*)'|(-?\d+(?:\.\d+)?))")
+HTTP_REASONS = {200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found"}
+
+
+def sap_error(message: str, code: int = -5002) -> dict:
+    return {"error": {"code": code, "message": {"lang": "en-us", "value": message}}}
+
+
+def apply_filter(records: list[dict], expression: str) -> list[dict]:
+    """Supports the `Field eq 'value' and ...` subset of OData $filter."""
+    conditions = []
+    for clause in re.split(r"\s+and\s+", expression.strip()):
+        match = FILTER_CLAUSE.fullmatch(clause.strip())
+        if not match:
+            raise ValueError(f"Unsupported $filter clause: {clause}")
+        field, text, number = match.groups()
+        conditions.append((field, text.replace("''", "'") if text is not None else float(number)))
+    return [
+        record for record in records
+        if all(
+            (str(record.get(field)) == value) if isinstance(value, str) else (record.get(field) == value)
+            for field, value in conditions
+        )
+    ]
+
+
+def read_records(file_name: str) -> list[dict]:
+    path = ASSETS_DIR / file_name
+    if not path.exists():
+        return []
+    try:
+        return pd.read_csv(path).dropna(how="all").to_dict(orient="records")
+    except pd.errors.EmptyDataError:
+        return []
+
+
+class FakeServiceLayer:
+    def __init__(self, session_timeout_seconds: float = 1800):
+        self.session_timeout_seconds = session_timeout_seconds
+        self.sessions: dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.reset()
+
+    def reset(self):
+        """Reloads master data from the asset CSVs and forgets posted documents."""
+        self.items = {
+            str(item["ItemCode"]): {
+                "ItemCode": str(item["ItemCode"]),
+                "ItemName": item["ItemName"],
+                "UoMGroupEntry": int(item["UoMGroupEntry"]),
+                "InventoryUoMEntry": int(item["InventoryUoMEntry"]),
+            }
+            for item in read_records("item_list.csv") if not pd.isna(item.get("ItemCode"))
+        }
+        self.item_groups = [{"Number": int(group["Series"]), "GroupName": group["GroupName"]} for group in read_records("item_groups.csv")]
+        self.uom_groups = [
+            {"AbsEntry": int(group["UoMGroupEntry"]), "Code": group["Code"], "BaseUoM": int(group["BaseUoM"])}
+            for group in read_records("uom_groups.csv")
+        ]
+        self.accounts = [{"Code": str(account["AccountCode"]), "Name": account["Name"]} for account in read_records("account_codes.csv")]
+        self.cost_codes = [
+            {"FactorCode": code["FactorCode"], "FactorDescription": code["FactorDescription"]}
+            for code in read_records("cost_codes.csv")
+        ]
+        self.business_partners = {
+            str(partner["CardCode"]): {"CardCode": str(partner["CardCode"]), "CardName": partner["CardName"], "CardType": "cSupplier"}
+            for partner in read_records("vendor_list.csv")
+        }
+        self.purchase_invoices: list[dict] = []
+        self.next_item_number = 1
+        self.next_doc_entry = 1
+
+    def login(self) -> str:
+        session_id = str(uuid.uuid4())
+        with self.lock:
+            self.sessions[session_id] = time.monotonic() + self.session_timeout_seconds
+        return session_id
+
+    def is_valid_session(self, session_id: Optional[str]) -> bool:
+        with self.lock:
+            expires_at = self.sessions.get(session_id)
+            return expires_at is not None and expires_at > time.monotonic()
+
+    def collection(self, name: str) -> Optional[list]:
+        return {
+            "Items": lambda: list(self.items.values()),
+            "ItemGroups": lambda: self.item_groups,
+            "UnitOfMeasurementGroups": lambda: self.uom_groups,
+            "ChartOfAccounts": lambda: self.accounts,
+            "DistributionRules": lambda: self.cost_codes,
+            "BusinessPartners": lambda: list(self.business_partners.values()),
+            "PurchaseInvoices": lambda: self.purchase_invoices,
+        }.get(name, lambda: None)()
+
+    def handle(self, method: str, path: str, query: dict, body: Any) -> tuple[int, Any]:
+        """Executes one Service Layer operation and returns (status code, response body)."""
+        name = path.strip("/")
+        if method == "GET":
+            records = self.collection(name)
+            if records is None:
+                return 404, sap_error(f"Resource not found for the segment '{name}'.", -1)
+            if query.get("$filter"):
+                try:
+                    records = apply_filter(records, query["$filter"])
+                except ValueError as e:
+                    return 400, sap_error(str(e), -1)
+            skip = int(query.get("$skip", 0))
+            page = {"value": records[skip:skip + PAGE_SIZE]}
+            if skip + PAGE_SIZE < len(records):
+                page["odata.nextLink"] = f"{name}?$skip={skip + PAGE_SIZE}"
+            return 200, page
+        if method == "POST" and name == "Items":
+            return self.create_item(body or {})
+        if method == "POST" and name == "PurchaseInvoices":
+            return self.create_purchase_invoice(body or {})
+        return 404, sap_error(f"Resource not found for the segment '{name}'.", -1)
+
+    def create_item(self, item: dict) -> tuple[int, Any]:
+        if not item.get("ItemName"):
+            return 400, sap_error("Item name is missing.")
+        uom_group = next((group for group in self.uom_groups if group["AbsEntry"] == item.get("UoMGroupEntry")), None)
+        if item.get("UoMGroupEntry") is not None and uom_group is None:
+            return 400, sap_error(f"UoM group {item.get('UoMGroupEntry')} does not exist.")
+        item_code = f"FK{self.next_item_number:05d}"
+        self.next_item_number += 1
+        created = {
+            "ItemCode": item_code,
+            "ItemName": item["ItemName"],
+            "ItemsGroupCode": item.get("Series"),
+            "UoMGroupEntry": item.get("UoMGroupEntry", -1),
+            "InventoryUoMEntry": uom_group["BaseUoM"] if uom_group else -1,
+        }
+        self.items[item_code] = created
+        return 201, created
+
+    def create_purchase_invoice(self, invoice: dict) -> tuple[int, Any]:
+        if str(invoice.get("CardCode")) not in self.business_partners:
+            return 400, sap_error(f"Invalid BP code '{invoice.get('CardCode')}'.", -10)
+        lines = invoice.get("DocumentLines") or []
+        if not lines:
+            return 400, sap_error("To generate this document, first define the numbering series in the Administration module.", -5002)
+        for number, line in enumerate(lines):
+            if str(line.get("ItemCode")) not in self.items:
+                return 400, sap_error(f"[PCH1.ItemCode][line: {number + 1}] , 'Invalid item code '{line.get('ItemCode')}''", -10)
+        created = {**invoice, "DocEntry": self.next_doc_entry, "DocNum": self.next_doc_entry}
+        self.next_doc_entry += 1
+        self.purchase_invoices.append(created)
+        return 201, created
+
+    def execute_changeset(self, operations: list[tuple[str, str, Any]]) -> list[tuple[int, Any]]:
+        """Runs a changeset atomically. On failure the state is restored and only the failing response is returned."""
+        with self.lock:
+            items_before = set(self.items)
+            invoice_count, next_item_number, next_doc_entry = len(self.purchase_invoices), self.next_item_number, self.next_doc_entry
+            results = []
+            for method, path, body in operations:
+                status_code, response_body = self.handle(method, path, {}, copy.deepcopy(body))
+                if status_code >= 400:
+                    for item_code in set(self.items) - items_before:
+                        del self.items[item_code]
+                    del self.purchase_invoices[invoice_count:]
+                    self.next_item_number, self.next_doc_entry = next_item_number, next_doc_entry
+                    return [(status_code, response_body)]
+                results.append((status_code, response_body))
+            return results
+
+
+def http_part(status_code: int, body: Any, content_id: Optional[str] = None) -> list[str]:
+    lines = ["Content-Type: application/http", "Content-Transfer-Encoding: binary"]
+    if content_id:
+        lines.append(f"Content-ID: {content_id}")
+    lines += ["", f"HTTP/1.1 {status_code} {HTTP_REASONS.get(status_code, '')}", "Content-Type: application/json;odata=minimalmetadata;charset=utf-8", "", json.dumps(body, default=str)]
+    return lines
+
+
+def parse_request_part(part: str) -> tuple[Optional[str], str, str, Any]:
+    headers, http_message = split_headers(part)
+    request_line, _, rest = http_message.strip("\n").partition("\n")
+    _, body = split_headers(rest) if rest else ({}, "")
+    method, url = request_line.split()[:2]
+    path = url.split("/b1s/v1/", 1)[-1]
+    return headers.get("content-id"), method, path, json.loads(body) if body.strip() else None
+
+
+def run_batch(service: FakeServiceLayer, content_type: str, body: str) -> tuple[str, str]:
+    boundary = f"batchresponse_{uuid.uuid4().hex}"
+    lines = []
+    for part in split_parts(body, boundary_of(content_type)):
+        headers, content = split_headers(part)
+        changeset_boundary = boundary_of(headers.get("content-type", ""))
+        requests = [parse_request_part(inner) for inner in split_parts(content, changeset_boundary)] if changeset_boundary else [parse_request_part(part)]
+        results = service.execute_changeset([(method, path, request_body) for _, method, path, request_body in requests])
+
+        lines.append(f"--{boundary}")
+        if changeset_boundary and results[0][0] < 400:
+            response_changeset = f"changesetresponse_{uuid.uuid4().hex}"
+            lines += [f"Content-Type: multipart/mixed;boundary={response_changeset}", ""]
+            for (content_id, _, _, _), (status_code, response_body) in zip(requests, results):
+                lines += [f"--{response_changeset}"] + http_part(status_code, response_body, content_id)
+            lines.append(f"--{response_changeset}--")
+        else:
+            lines += http_part(*results[0])
+    lines.append(f"--{boundary}--")
+    return boundary, "\r\n".join(lines) + "\r\n"
+
+
+service = FakeServiceLayer(float(os.getenv("FAKE_SAP_SESSION_TIMEOUT_SECONDS", "1800")))
+latency_seconds = float(os.getenv("FAKE_SAP_LATENCY_MS", "0")) / 1000
+
+app = FastAPI(title="Fake SAP Service Layer")
+
+
+@app.api_route("/b1s/v1/{path:path}", methods=["GET", "POST"])
+async def service_layer(path: str, request: Request):
+    if latency_seconds:
+        await asyncio.sleep(latency_seconds)
+    service.request_count += 1
+
+    if path == "Login":
+        session_id = service.login()
+        response = Response(
+            content=json.dumps({"SessionId": session_id, "Version": "1000000", "SessionTimeout": service.session_timeout_seconds / 60}),
+            media_type="application/json"
+        )
+        response.set_cookie("B1SESSION", session_id)
+        return response
+
+    if not service.is_valid_session(request.cookies.get("B1SESSION")):
+        return Response(content=json.dumps(sap_error("Invalid session or session already timeout.", 301)), status_code=401, media_type="application/json")
+
+    if path == "$batch":
+        raw_body = (await request.body()).decode("utf-8")
+        boundary, response_body = run_batch(service, request.headers.get("content-type", ""), raw_body)
+        return Response(content=response_body, status_code=202, media_type=f"multipart/mixed;boundary={boundary}")
+
+    raw_body = await request.body()
+    body = json.loads(raw_body) if raw_body else None
+    if request.method == "POST":
+        # Writes touch shared state, so they take the same lock as changesets
+        status_code, response_body = service.execute_changeset([("POST", path, body)])[0]
+    else:
+        status_code, response_body = service.handle(request.method, path, dict(request.query_params), body)
+    return Response(content=json.dumps(response_body, default=str), status_code=status_code, media_type="application/json")
@@ -0,0 +1,370 @@
+"""
+Offline end-to-end load benchmark.
+
+Starts the FastAPI app in this process against local stand-ins (fake OCR, fake LLM with
+canned answers, the fake SAP Service Layer and mongomock unless --mongodb-uri is given),
+drives it with synthetic invoice PDFs at a fixed concurrency and writes throughput and
+p50/p95/p99 per endpoint and per provider stage to a JSON file.
+
+    python -m benchmarks.load_test --concurrency 8 --iterations 200
+    python -m benchmarks.load_test --scenario pipeline --llm-latency-ms 800 --ocr-latency-ms 1500
+    python -m benchmarks.load_test --compare benchmarks/results/load-20250101-120000.json
+
+Scenarios: "steps" calls /extract/, /classification/{id}, /mapping/get-mappings/{id} and
+/sap/PurchaseInvoices the way the UI does; "pipeline" calls POST /pipeline once per invoice.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+import httpx
+import uvicorn
+from benchmarks.stats import compare, summarize
+from benchmarks.synthetic_invoices import SyntheticInvoice, extraction_from_text, generate_invoice, load_catalogs, render_pdf
+
+logger = logging.getLogger("benchmarks.load_test")
+
+# Quotas high enough that the shared rate limiters never wait (see --keep-quotas)
+UNLIMITED_QUOTAS = {
+    "GEMINI_REQUESTS_PER_MINUTE": "1000000", "GEMINI_BURST": "100000", "GEMINI_MAX_CONCURRENCY": "1000",
+    "MISTRAL_REQUESTS_PER_SECOND": "100000", "MISTRAL_BURST": "100000", "MISTRAL_MAX_CONCURRENCY": "1000",
+    "HF_REQUESTS_PER_SECOND": "100000", "HF_BURST": "100000", "HF_MAX_CONCURRENCY": "1000",
+    "SAP_REQUESTS_PER_SECOND": "100000", "SAP_BURST": "100000", "SAP_MAX_CONCURRENCY": "1000",
+}
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=("steps", "pipeline"), default="steps")
+    parser.add_argument("--concurrency", type=int, default=4, help="invoices in flight at once")
+    parser.add_argument("--iterations", type=int, default=40, help="invoices processed in the measured run")
+    parser.add_argument("--warmup", type=int, default=2, help="invoices processed before measuring")
+    parser.add_argument("--pages", type=int, default=1, help="pages per synthetic invoice")
+    parser.add_argument("--noise", type=float, default=0.02, help="character error rate applied to printed vendor names")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--llm-latency-ms", type=float, default=0)
+    parser.add_argument("--llm-error-rate", type=float, default=0)
+    parser.add_argument("--ocr-latency-ms", type=float, default=0, help="per page")
+    parser.add_argument("--ocr-error-rate", type=float, default=0)
+    parser.add_argument("--sap-latency-ms", type=float, default=0)
+    parser.add_argument("--mongodb-uri", default="mongomock://", help="a local mongod, e.g. mongodb://localhost:27017, instead of mongomock")
+    parser.add_argument("--keep-quotas", action="store_true", help="keep the production rate limits instead of lifting them")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for the SAP outbox to drain")
+    parser.add_argument("--output", type=Path, help="result file (default: benchmarks/results/load-<timestamp>.json)")
+    parser.add_argument("--compare", type=Path, help="earlier result file to compare against")
+    return parser.parse_args(argv)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_environment(args: argparse.Namespace, sap_port: int):
+    """Points the service at the stand-ins. Must run before anything under backend is imported."""
+    os.environ.update({
+        "MONGODB_URI": args.mongodb_uri,
+        "LLM_BACKEND": "fake",
+        "FAKE_LLM_LATENCY_MS": str(args.llm_latency_ms),
+        "FAKE_LLM_ERROR_RATE": str(args.llm_error_rate),
+        "OCR_BACKEND": "fake",
+        "FAKE_OCR_LATENCY_MS": str(args.ocr_latency_ms),
+        "FAKE_OCR_ERROR_RATE": str(args.ocr_error_rate),
+        "FAKE_SAP_LATENCY_MS": str(args.sap_latency_ms),
+        "BASE_URL": f"http://127.0.0.1:{sap_port}/b1s/v1/",
+        "COMPANY_DB": "BENCH", "USERNAME": "bench", "PASSWORD": "bench",
+        "GOOGLE_API_KEY": os.environ.get("GOOGLE_API_KEY") or "fake",
+        "MISTRAL_API_KEY": os.environ.get("MISTRAL_API_KEY") or "fake",
+        "LLM_BACKOFF_BASE_SECONDS": "0.05",
+        "SAP_OUTBOX_POLL_SECONDS": "0.2",
+        "SAP_OUTBOX_BACKOFF_BASE_SECONDS": "0.2",
+    })
+    if not args.keep_quotas:
+        os.environ.update(UNLIMITED_QUOTAS)
+
+
+class ServerThread:
+    """Runs a uvicorn server on its own event loop in a daemon thread."""
+
+    def __init__(self, app, port: int):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.url = f"http://127.0.0.1:{port}"
+
+    def start(self, timeout: float = 60):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"Server on {self.url} did not start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.measuring = False
+        self.requests: dict[str, list[float]] = defaultdict(list)
+        self.request_errors: Counter = Counter()
+        self.status_codes: dict[str, Counter] = defaultdict(Counter)
+        self.stages: dict[str, list[float]] = defaultdict(list)
+        self.stage_errors: Counter = Counter()
+        self.accuracy: dict[str, list[bool]] = defaultdict(list)
+        self.invoices: list[float] = []
+        self.failed_invoices = 0
+
+    def request(self, endpoint: str, status_code: int, latency_ms: float):
+        if not self.measuring:
+            return
+        with self.lock:
+            self.requests[endpoint].append(latency_ms)
+            self.status_codes[endpoint][str(status_code)] += 1
+            if status_code >= 400:
+                self.request_errors[endpoint] += 1
+
+    def stage(self, name: str, latency_ms: float, ok: bool = True):
+        if not self.measuring:
+            return
+        with self.lock:
+            self.stages[name].append(latency_ms)
+            if not ok:
+                self.stage_errors[name] += 1
+
+    def check(self, name: str, correct: bool):
+        if self.measuring:
+            with self.lock:
+                self.accuracy[name].append(correct)
+
+
+async def timed(recorder: Recorder, endpoint: str, request) -> httpx.Response:
+    started = time.perf_counter()
+    try:
+        response = await request
+    except httpx.HTTPError:
+        recorder.request(endpoint, 599, (time.perf_counter() - started) * 1000)
+        raise
+    recorder.request(endpoint, response.status_code, (time.perf_counter() - started) * 1000)
+    return response
+
+
+def check_mapping(recorder: Recorder, invoice: SyntheticInvoice, mapped: dict):
+    recorder.check("vendor_code", mapped.get("CardCode") == invoice.card_code)
+    lines = mapped.get("DocumentLines") or []
+    for position, line in enumerate(invoice.lines):
+        recorder.check("item_code", position < len(lines) and lines[position].get("ItemCode") == line.item_code)
+
+
+async def steps_scenario(client: httpx.AsyncClient, recorder: Recorder, invoice: SyntheticInvoice, pdf: bytes) -> bool:
+    response = await timed(recorder, "POST /extract/", client.post(
+        "/extract/", files=[("file_list", (invoice.file_name, pdf, "application/pdf"))]
+    ))
+    if response.status_code != 200:
+        return False
+    uid = response.json()["data"][0]["document_id"]
+
+    response = await timed(recorder, "GET /classification/{id}", client.get(f"/classification/{uid}"))
+    if response.status_code != 200:
+        return False
+
+    response = await timed(recorder, "GET /mapping/get-mappings/{id}", client.get(f"/mapping/get-mappings/{uid}"))
+    if response.status_code != 200:
+        return False
+    check_mapping(recorder, invoice, response.json()["mapped_result"])
+
+    response = await timed(recorder, "POST /sap/PurchaseInvoices", client.post("/sap/PurchaseInvoices", json=invoice.sap_payload()))
+    return response.status_code in (200, 202)
+
+
+async def pipeline_scenario(client: httpx.AsyncClient, recorder: Recorder, invoice: SyntheticInvoice, pdf: bytes) -> bool:
+    response = await timed(recorder, "POST /pipeline", client.post(
+        "/pipeline", files={"file": (invoice.file_name, pdf, "application/pdf")}, data={"post": "true"}
+    ))
+    if response.status_code != 200:
+        return False
+    result = response.json()
+    for stage, latency_ms in result["timings"]["stages_ms"].items():
+        recorder.stage(f"pipeline:{stage}", latency_ms)
+    if result.get("mapped_result"):
+        check_mapping(recorder, invoice, result["mapped_result"])
+    return True
+
+
+async def run_load(base_url: str, recorder: Recorder, scenario, work: list[tuple[SyntheticInvoice, bytes]], concurrency: int):
+    queue = list(reversed(work))
+
+    async def worker(client: httpx.AsyncClient):
+        while queue:
+            invoice, pdf = queue.pop()
+            started = time.perf_counter()
+            try:
+                ok = await scenario(client, recorder, invoice, pdf)
+            except Exception as e:
+                logger.error(f"{invoice.file_name} failed: {type(e).__name__}: {e}")
+                ok = False
+            if recorder.measuring:
+                with recorder.lock:
+                    if ok:
+                        recorder.invoices.append((time.perf_counter() - started) * 1000)
+                    else:
+                        recorder.failed_invoices += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=600, limits=limits) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+
+
+def wait_for_outbox(outbox, timeout: float) -> tuple[float, dict]:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if outbox.store.count_documents({"status": {"$in": ["pending", "posting"]}}) == 0:
+            break
+        time.sleep(0.1)
+    statuses = Counter(entry["status"] for entry in outbox.store.find({}, {"status": 1}))
+    return round(time.perf_counter() - started, 3), dict(statuses)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    rng = random.Random(args.seed)
+    vendors, items = load_catalogs()
+    total = args.warmup + args.iterations
+    logger.info(f"Generating {total} synthetic invoice(s)...")
+    work = []
+    for index in range(total):
+        invoice = generate_invoice(rng, vendors, items, index, noise=args.noise)
+        work.append((invoice, render_pdf(invoice, pages=args.pages)))
+
+    sap_port, app_port = free_port(), free_port()
+    configure_environment(args, sap_port)
+
+    # Master-data refreshes rewrite the asset CSVs, so the app runs on a copy of them
+    workdir = tempfile.mkdtemp(prefix="ocr-bench-")
+    shutil.copytree(REPO_ROOT / "backend" / "assets", Path(workdir) / "backend" / "assets")
+    os.chdir(workdir)
+
+    from backend.testing import fake_sap
+    sap_server = ServerThread(fake_sap.app, sap_port)
+    sap_server.start()
+
+    from backend.main import app
+    from backend.services.llm_gateway import llm_gateway
+    from backend.services.sap_outbox import sap_outbox_drainer
+
+    recorder = Recorder()
+    llm_gateway.backend.register("extraction", extraction_from_text)
+    llm_gateway.backend.register("classification", "ap_invoice")
+    llm_gateway.metrics.listeners.append(
+        lambda record: recorder.stage(f"{record.provider}:{record.stage}", record.latency_ms, record.status == "success")
+    )
+
+    app_server = ServerThread(app, app_port)
+    app_server.start()
+    scenario = steps_scenario if args.scenario == "steps" else pipeline_scenario
+
+    try:
+        if args.warmup:
+            logger.info(f"Warming up with {args.warmup} invoice(s)...")
+            asyncio.run(run_load(app_server.url, recorder, scenario, work[:args.warmup], min(args.concurrency, args.warmup)))
+
+        logger.info(f"Running {args.iterations} invoice(s) at concurrency {args.concurrency} ({args.scenario})...")
+        sap_requests_before = fake_sap.service.request_count
+        recorder.measuring = True
+        started = time.perf_counter()
+        asyncio.run(run_load(app_server.url, recorder, scenario, work[args.warmup:], args.concurrency))
+        duration_s = time.perf_counter() - started
+        recorder.measuring = False
+
+        drain_s, outbox_statuses = wait_for_outbox(sap_outbox_drainer, args.drain_timeout)
+        sap_requests = fake_sap.service.request_count - sap_requests_before
+    finally:
+        app_server.stop()
+        sap_server.stop()
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        "run": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        },
+        "totals": {
+            "invoices": len(recorder.invoices),
+            "failed_invoices": recorder.failed_invoices,
+            "duration_s": round(duration_s, 3),
+            "invoices_per_s": round(len(recorder.invoices) / duration_s, 3) if duration_s else None,
+            "sap_requests": sap_requests,
+            "outbox_drain_s": drain_s,
+            "outbox_statuses": outbox_statuses,
+        },
+        "invoice": summarize(recorder.invoices, duration_s, recorder.failed_invoices),
+        "endpoints": {
+            endpoint: {**summarize(latencies, duration_s, recorder.request_errors[endpoint]), "status_codes": dict(recorder.status_codes[endpoint])}
+            for endpoint, latencies in sorted(recorder.requests.items())
+        },
+        "stages": {
+            stage: summarize(latencies, duration_s, recorder.stage_errors[stage])
+            for stage, latencies in sorted(recorder.stages.items())
+        },
+        "accuracy": {
+            name: {"checked": len(checks), "correct": sum(checks), "rate": round(sum(checks) / len(checks), 4) if checks else None}
+            for name, checks in sorted(recorder.accuracy.items())
+        },
+    }
+
+    output = args.output or RESULTS_DIR / f"load-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+
+    print(f"\n{results['totals']['invoices']} invoice(s) in {results['totals']['duration_s']}s "
+          f"({results['totals']['invoices_per_s']}/s), {recorder.failed_invoices} failed")
+    for section in ("endpoints", "stages"):
+        print(f"\n{section}:")
+        for name, summary in results[section].items():
+            print(f"  {name:45} n={summary['count']:<5} err={summary['errors']:<4} "
+                  f"p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms")
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        previous = json.loads(args.compare.read_text())
+        print(f"\nCompared with {args.compare}:")
+        for line in compare(previous, results, ("endpoints", "stages")) or ["nothing in common to compare"]:
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
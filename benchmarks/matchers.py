@@ -0,0 +1,330 @@
+"""
+Microbenchmarks for vendor and item resolution.
+
+Runs Mapper.find_similar_vendor, Mapper.map_items_to_codes and Classifier.match_vendor_name
+on the catalogs in backend/assets and on synthetic catalogs scaled up from them, with a
+labeled set of noisy lookups drawn from each catalog. Reports latency per lookup, batch
+throughput, peak memory and accuracy per catalog size, matcher and noise level.
+
+    python -m benchmarks.matchers
+    python -m benchmarks.matchers --sizes real,100000,1000000 --noise 0.02,0.08 --lookups 50
+    python -m benchmarks.matchers --compare benchmarks/results/matchers-20250101-120000.json
+
+Synthetic entries are made of words from the real names, so near-duplicates become more
+common as the catalog grows, as they do in a real vendor master. The real entries are kept
+in every scaled catalog. Vendor similarity uses the fake backend's rapidfuzz scorer in
+place of the Hugging Face model, so match_vendor_name numbers exclude network time.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Optional
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+import numpy as np
+import pandas as pd
+from benchmarks.load_test import UNLIMITED_QUOTAS, git_revision
+from benchmarks.stats import compare, summarize
+from benchmarks.synthetic_invoices import ASSETS_DIR, add_noise
+
+logger = logging.getLogger("benchmarks.matchers")
+
+WORD = re.compile(r"[A-Za-z][A-Za-z&.\-]{2,}")
+MATCHERS = ("find_similar_vendor", "match_vendor_name", "map_items_to_codes")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="real,100000,1000000", help="comma-separated catalog sizes; 'real' is the asset files as they are")
+    parser.add_argument("--matchers", default=",".join(MATCHERS))
+    parser.add_argument("--noise", default="0.05", help="comma-separated character error rates for the lookups")
+    parser.add_argument("--lookups", type=int, default=100, help="labeled lookups per catalog, matcher and noise level")
+    parser.add_argument("--batch-size", type=int, default=10, help="line items per document for map_items_to_codes")
+    parser.add_argument("--budget-seconds", type=float, default=60, help="stop a matcher early once it has run this long")
+    parser.add_argument("--memory-lookups", type=int, default=3, help="lookups repeated under tracemalloc for peak memory")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--output", type=Path, help="result file (default: benchmarks/results/matchers-<timestamp>.json)")
+    parser.add_argument("--compare", type=Path, help="earlier result file to compare against")
+    return parser.parse_args(argv)
+
+
+def configure_environment():
+    """Fake LLM backend and in-memory Mongo. Must run before anything under backend is imported."""
+    os.environ.update({
+        "LLM_BACKEND": "fake",
+        "MONGODB_URI": os.environ.get("BENCHMARK_MONGODB_URI", "mongomock://"),
+        "GOOGLE_API_KEY": os.environ.get("GOOGLE_API_KEY") or "fake",
+        **UNLIMITED_QUOTAS,
+    })
+
+
+def word_pool(names: pd.Series) -> np.ndarray:
+    words = {}
+    for name in names.dropna().astype(str):
+        for word in WORD.findall(name):
+            words.setdefault(word.lower(), word)
+    return np.array(list(words.values()))
+
+
+def synthesize_names(words: np.ndarray, count: int, taken: set, rng: np.random.Generator, min_words: int, max_words: int) -> list[str]:
+    """`count` names of min..max random words, unique ignoring case and not already in `taken`."""
+    names = {}
+    while len(names) < count:
+        needed = int((count - len(names)) * 1.1) + 16
+        lengths = rng.integers(min_words, max_words + 1, size=needed)
+        picks = rng.integers(0, len(words), size=(needed, max_words))
+        for row, length in zip(picks, lengths):
+            name = " ".join(words[row[:length]])
+            key = name.lower()
+            if key not in taken and key not in names:
+                names[key] = name
+                if len(names) == count:
+                    break
+    return list(names.values())
+
+
+def build_catalogs(size: Optional[int], rng: np.random.Generator) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """The asset catalogs, padded with synthetic entries up to `size` rows each (None keeps them as they are)."""
+    vendors = pd.read_csv(ASSETS_DIR / "vendor_list.csv")
+    items = pd.read_csv(ASSETS_DIR / "item_list.csv")
+    if size is None:
+        return vendors, items
+
+    extra = max(0, size - len(vendors))
+    names = synthesize_names(word_pool(vendors["CardName"]), extra, set(vendors["CardName"].dropna().str.lower()), rng, 2, 4)
+    vendors = pd.concat([vendors, pd.DataFrame({
+        "CardCode": [f"VS{index:07d}" for index in range(extra)],
+        "CardName": names
+    })], ignore_index=True)
+
+    extra = max(0, size - len(items))
+    names = synthesize_names(word_pool(items["ItemName"]), extra, set(items["ItemName"].dropna().str.lower()), rng, 3, 7)
+    units = items[["UoMGroupEntry", "InventoryUoMEntry"]].dropna().to_numpy()
+    picked = units[rng.integers(0, len(units), size=extra)]
+    items = pd.concat([items, pd.DataFrame({
+        "ItemCode": [f"IS{index:07d}" for index in range(extra)],
+        "ItemName": [name.upper() for name in names],
+        "UoMGroupEntry": picked[:, 0].astype(int),
+        "InventoryUoMEntry": picked[:, 1].astype(int)
+    })], ignore_index=True)
+    return vendors, items
+
+
+def labeled_lookups(catalog: pd.DataFrame, code_column: str, name_column: str, count: int, noise: float, rng: random.Random) -> list[tuple[str, str, str]]:
+    """(printed name, true code, true name) for `count` active entries, printed with OCR-like noise."""
+    active = catalog.dropna(subset=[code_column, name_column])
+    active = active[~active[name_column].str.contains("do not use", case=False)]
+    rows = active.iloc[rng.sample(range(len(active)), min(count, len(active)))]
+    return [(add_noise(str(name), rng, noise), str(code), str(name)) for code, name in zip(rows[code_column], rows[name_column])]
+
+
+class Outcomes:
+    def __init__(self):
+        self.correct = self.wrong = self.unmatched = 0
+
+    def add(self, matched: Optional[str], truth: str):
+        if not matched:
+            self.unmatched += 1
+        elif matched.lower() == truth.lower():
+            self.correct += 1
+        else:
+            self.wrong += 1
+
+    def report(self) -> dict:
+        total = self.correct + self.wrong + self.unmatched
+        return {
+            "labeled": total, "correct": self.correct, "wrong": self.wrong, "unmatched": self.unmatched,
+            "accuracy": round(self.correct / total, 4) if total else None
+        }
+
+
+def timed_run(batches: list, call: Callable[[object], None], budget_s: float) -> tuple[list[float], float, int]:
+    """Runs each batch once, stopping after `budget_s`. Returns per-batch ms, wall time and batches run."""
+    latencies = []
+    started = time.perf_counter()
+    for batch in batches:
+        begin = time.perf_counter()
+        call(batch)
+        latencies.append((time.perf_counter() - begin) * 1000)
+        if time.perf_counter() - started > budget_s:
+            break
+    return latencies, time.perf_counter() - started, len(latencies)
+
+
+def peak_memory_mb(batches: list, call: Callable[[object], None]) -> Optional[float]:
+    if not batches:
+        return None
+    tracemalloc.start()
+    try:
+        for batch in batches:
+            call(batch)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return round(peak / 2**20, 2)
+
+
+def vendor_document(name: str) -> dict:
+    return {"extracted_details": {"vendor_details": {"name": name}, "line_items": []}}
+
+
+def item_document(lookups: list[tuple[str, str, str]]) -> dict:
+    return {"extracted_details": {"vendor_details": {"name": ""}, "line_items": [{"products": printed} for printed, _, _ in lookups]}}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    configure_environment()
+
+    from backend.services.classification import Classifier
+    from backend.services.document_session import DocumentSession
+    from backend.services.mapping import Mapper
+
+    classifier = Classifier()
+    matchers = [name.strip() for name in args.matchers.split(",") if name.strip()]
+    unknown = set(matchers) - set(MATCHERS)
+    if unknown:
+        raise SystemExit(f"Unknown matcher(s) {', '.join(sorted(unknown))}; choose from {', '.join(MATCHERS)}")
+    noise_levels = [float(value) for value in args.noise.split(",")]
+    results = {
+        "run": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        },
+        "catalogs": {},
+        "matchers": {},
+    }
+
+    # load_vendor_names reads backend/assets/vendor_list.csv from the working directory,
+    # so each catalog is written to a scratch copy of the assets
+    workdir = tempfile.mkdtemp(prefix="ocr-matchers-")
+    assets = Path(workdir) / "backend" / "assets"
+    assets.mkdir(parents=True)
+    os.chdir(workdir)
+    try:
+        for size_label in [value.strip() for value in args.sizes.split(",") if value.strip()]:
+            size = None if size_label == "real" else int(size_label)
+            rng = np.random.default_rng(args.seed)
+            started = time.perf_counter()
+            vendors, items = build_catalogs(size, rng)
+            vendors.to_csv(assets / "vendor_list.csv", index=False)
+            results["catalogs"][size_label] = {
+                "vendors": len(vendors),
+                "items": len(items),
+                "vendors_mb": round(vendors.memory_usage(deep=True).sum() / 2**20, 2),
+                "items_mb": round(items.memory_usage(deep=True).sum() / 2**20, 2),
+                "build_s": round(time.perf_counter() - started, 3),
+            }
+            logger.info(f"Catalog '{size_label}': {len(vendors)} vendors, {len(items)} items")
+
+            # Skips __init__, which refreshes the catalogs from SAP
+            mapper = Mapper.__new__(Mapper)
+            mapper.vendor_names_with_codes = vendors
+            mapper.item_list_df = items
+            mapper.item_names_list = items["ItemName"].str.lower().dropna().to_list()
+            # Lines below the threshold would create SAP items through the LLM; here they count as unmatched
+            mapper.create_unknown_items = lambda unknown_items: {}
+            vendor_names_by_code = dict(zip(vendors["CardCode"].astype(str), vendors["CardName"].astype(str)))
+            item_names_by_code = dict(zip(items["ItemCode"].astype(str), items["ItemName"].astype(str)))
+
+            for noise in noise_levels:
+                lookup_rng = random.Random(args.seed)
+                vendor_lookups = labeled_lookups(vendors, "CardCode", "CardName", args.lookups, noise, lookup_rng)
+                item_lookups = labeled_lookups(items, "ItemCode", "ItemName", args.lookups, noise, lookup_rng)
+
+                for matcher in matchers:
+                    outcomes = Outcomes()
+                    if matcher == "find_similar_vendor":
+                        batches = [[lookup] for lookup in vendor_lookups]
+
+                        def call(batch, record=True):
+                            printed, _, truth = batch[0]
+                            session = DocumentSession(0, vendor_document(printed))
+                            mapper.find_similar_vendor(session)
+                            if record:
+                                code = session.get("extracted_details.vendor_details.code")
+                                outcomes.add(vendor_names_by_code.get(str(code)) if code else None, truth)
+                    elif matcher == "match_vendor_name":
+                        batches = [[lookup] for lookup in vendor_lookups]
+
+                        def call(batch, record=True):
+                            printed, _, truth = batch[0]
+                            session = DocumentSession(0, vendor_document(printed))
+                            classifier.match_vendor_name(session)
+                            if record:
+                                outcomes.add(session.get("extracted_details.vendor_details.name") if session.dirty else None, truth)
+                    else:
+                        batches = [item_lookups[start:start + args.batch_size] for start in range(0, len(item_lookups), args.batch_size)]
+
+                        def call(batch, record=True):
+                            session = DocumentSession(0, item_document(batch))
+                            mapper.map_items_to_codes(session)
+                            if record:
+                                for index, (_, _, truth) in enumerate(batch):
+                                    code = session.get(f"extracted_details.line_items.{index}.ItemCode")
+                                    outcomes.add(item_names_by_code.get(str(code)) if code else None, truth)
+
+                    logger.info(f"{size_label} / {matcher} / noise {noise}: {len(batches)} batch(es)")
+                    # The matchers log every lookup; formatting those lines is not what is measured
+                    logging.disable(logging.WARNING)
+                    try:
+                        latencies, duration_s, ran = timed_run(batches, call, args.budget_seconds)
+                        peak_mb = peak_memory_mb(batches[:args.memory_lookups], lambda batch: call(batch, record=False))
+                    finally:
+                        logging.disable(logging.NOTSET)
+
+                    lookups_run = sum(len(batch) for batch in batches[:ran])
+                    per_lookup = [latency / len(batch) for latency, batch in zip(latencies, batches) for _ in batch]
+                    results["matchers"][f"{size_label}/{matcher}/noise={noise:g}"] = {
+                        **summarize(per_lookup),
+                        "throughput_per_s": round(lookups_run / duration_s, 3) if duration_s else None,
+                        "batch_size": len(batches[0]) if batches else 0,
+                        "batch_p50_ms": summarize(latencies)["p50_ms"],
+                        "peak_mb": peak_mb,
+                        **outcomes.report(),
+                    }
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results["run"]["max_rss_mb"] = round(max_rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+    output = args.output or RESULTS_DIR / f"matchers-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+
+    print()
+    for name, summary in results["matchers"].items():
+        print(f"  {name:50} n={summary['count']:<5} p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms "
+              f"{summary['throughput_per_s']}/s peak={summary['peak_mb']}MB accuracy={summary['accuracy']}")
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        previous = json.loads(args.compare.read_text())
+        print(f"\nCompared with {args.compare}:")
+        for line in compare(previous, results, ("matchers",)) or ["nothing in common to compare"]:
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
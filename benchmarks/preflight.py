@@ -0,0 +1,186 @@
+"""
+Comparison of OCR on uploaded PDFs and on their preflight copies.
+
+Preflights each PDF the way the service does before OCR (images downsampled to
+PDF_PREFLIGHT_DPI and recompressed, attachments and metadata removed, fonts subset), then
+runs OCR on both versions and reports file sizes, preflight time, OCR time and how similar
+the two OCR texts are.
+
+    python -m benchmarks.preflight
+    python -m benchmarks.preflight --scans 10 --scan-dpi 600 --pages 3
+    OCR_BACKEND=mistral MISTRAL_API_KEY=... python -m benchmarks.preflight invoices/*.pdf
+
+Without input files it draws synthetic invoices and turns them into phone-style scans: every
+page rasterized at --scan-dpi and stored as a JPEG, with the text kept as an invisible layer
+the way searchable scans carry it. The fake OCR backend reads that text layer, so offline the
+similarity shows that preflight keeps it; whether downsampling costs recognition accuracy on
+real scans needs the Mistral backend.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+RESULTS_DIR = REPO_ROOT / "benchmarks" / "results"
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+import fitz
+from rapidfuzz import fuzz
+from benchmarks.load_test import UNLIMITED_QUOTAS, git_revision
+from benchmarks.stats import summarize
+from benchmarks.synthetic_invoices import generate_invoice, load_catalogs, render_pdf
+
+logger = logging.getLogger("benchmarks.preflight")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", type=Path, help="PDFs to compare (default: synthetic scans)")
+    parser.add_argument("--scans", type=int, default=5, help="synthetic scans when no files are given")
+    parser.add_argument("--pages", type=int, default=2, help="pages per synthetic scan")
+    parser.add_argument("--scan-dpi", type=int, default=600, help="resolution the synthetic pages are rasterized at")
+    parser.add_argument("--scan-quality", type=int, default=92, help="JPEG quality of the synthetic page images")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", type=Path, help="result file (default: benchmarks/results/preflight-<timestamp>.json)")
+    return parser.parse_args(argv)
+
+
+def configure_environment():
+    """Fake OCR unless OCR_BACKEND is set, in-memory Mongo. Must run before anything under backend is imported."""
+    os.environ.setdefault("OCR_BACKEND", "fake")
+    os.environ.update({
+        "LLM_BACKEND": "fake",
+        "MONGODB_URI": os.environ.get("BENCHMARK_MONGODB_URI", "mongomock://"),
+        "GOOGLE_API_KEY": os.environ.get("GOOGLE_API_KEY") or "fake",
+        "MISTRAL_API_KEY": os.environ.get("MISTRAL_API_KEY") or "fake",
+        **UNLIMITED_QUOTAS,
+    })
+
+
+def render_scan(pdf: bytes, dpi: int, quality: int) -> bytes:
+    """Replaces every page with a JPEG of itself at `dpi`, keeping its text as an invisible layer."""
+    with fitz.open(stream=pdf, filetype="pdf") as source, fitz.open() as scan:
+        for page in source:
+            image = page.get_pixmap(dpi=dpi).tobytes("jpeg", jpg_quality=quality)
+            scanned = scan.new_page(width=page.rect.width, height=page.rect.height)
+            scanned.insert_image(scanned.rect, stream=image)
+            for block in page.get_text("dict")["blocks"]:
+                for line in block.get("lines", []):
+                    for text_span in line["spans"]:
+                        scanned.insert_text(text_span["origin"], text_span["text"], fontsize=text_span["size"], render_mode=3)
+        return scan.tobytes(garbage=3, deflate=True)
+
+
+def synthetic_scans(args: argparse.Namespace, workdir: str) -> list[Path]:
+    vendors, items = load_catalogs()
+    rng = random.Random(args.seed)
+    paths = []
+    for index in range(args.scans):
+        invoice = generate_invoice(rng, vendors, items, index)
+        path = Path(workdir) / f"scan_{index:03d}.pdf"
+        path.write_bytes(render_scan(render_pdf(invoice, pages=args.pages), args.scan_dpi, args.scan_quality))
+        paths.append(path)
+    return paths
+
+
+def timed_ocr(ocr_client, path: str) -> tuple[str, float]:
+    started = time.perf_counter()
+    text = "\n\n".join(ocr_client.ocr_pages(path))
+    return text, time.perf_counter() - started
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    configure_environment()
+
+    from backend.core.config import settings
+    from backend.services.cpu_pool import cpu_pool
+    from backend.services.ocr_processor import OCR_Processor
+    from backend.services.pdf_preflight import run_preflight
+
+    ocr_client = OCR_Processor()
+    results = {
+        "run": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "ocr_backend": settings.OCR_BACKEND,
+            "preflight": {"dpi": settings.PDF_PREFLIGHT_DPI, "jpeg_quality": settings.PDF_PREFLIGHT_JPEG_QUALITY},
+            "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        },
+        "files": {},
+    }
+
+    workdir = tempfile.mkdtemp(prefix="ocr-preflight-")
+    cpu_pool.start()
+    try:
+        paths = args.files or synthetic_scans(args, workdir)
+        for path in paths:
+            out_path = os.path.join(workdir, f"preflight-{path.name}")
+            result = run_preflight(str(path), out_path)
+            if not result["applied"]:
+                logger.info(f"{path.name}: preflight not applied ({result.get('reason')})")
+                results["files"][path.name] = {"applied": False, "reason": result.get("reason")}
+                continue
+
+            original_text, original_s = timed_ocr(ocr_client, str(path))
+            optimized_text, optimized_s = timed_ocr(ocr_client, out_path)
+            results["files"][path.name] = {
+                "applied": True,
+                "pages": result["pages"],
+                "images": result["images"],
+                "original_bytes": result["original_bytes"],
+                "optimized_bytes": result["optimized_bytes"],
+                "saved": round(1 - result["optimized_bytes"] / result["original_bytes"], 4),
+                "preflight_ms": round(result["seconds"] * 1000, 3),
+                "ocr_original_ms": round(original_s * 1000, 3),
+                "ocr_optimized_ms": round(optimized_s * 1000, 3),
+                "text_similarity": round(fuzz.ratio(original_text, optimized_text) / 100, 4),
+            }
+            logger.info(f"{path.name}: {result['original_bytes']} -> {result['optimized_bytes']} bytes")
+    finally:
+        cpu_pool.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    compared = [row for row in results["files"].values() if row["applied"]]
+    if compared:
+        original_bytes = sum(row["original_bytes"] for row in compared)
+        optimized_bytes = sum(row["optimized_bytes"] for row in compared)
+        results["totals"] = {
+            "files": len(compared),
+            "original_bytes": original_bytes,
+            "optimized_bytes": optimized_bytes,
+            "saved": round(1 - optimized_bytes / original_bytes, 4),
+            "preflight": summarize([row["preflight_ms"] for row in compared]),
+            "ocr_original": summarize([row["ocr_original_ms"] for row in compared]),
+            "ocr_optimized": summarize([row["ocr_optimized_ms"] for row in compared]),
+            "min_text_similarity": min(row["text_similarity"] for row in compared),
+        }
+
+    output = args.output or RESULTS_DIR / f"preflight-{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+
+    print()
+    for name, row in results["files"].items():
+        if not row["applied"]:
+            print(f"  {name:30} not applied ({row['reason']})")
+            continue
+        print(f"  {name:30} {row['original_bytes'] / 2**20:.2f}MB -> {row['optimized_bytes'] / 2**20:.2f}MB "
+              f"(-{row['saved']:.0%}) preflight={row['preflight_ms']}ms ocr={row['ocr_original_ms']}ms -> {row['ocr_optimized_ms']}ms "
+              f"similarity={row['text_similarity']}")
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
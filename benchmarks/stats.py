@@ -0,0 +1,46 @@
+import math
+from typing import Optional
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """Linearly interpolated percentile, q in [0, 100]."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    value = ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+    return round(value, 3)
+
+
+def summarize(latencies_ms: list[float], duration_s: Optional[float] = None, errors: int = 0) -> dict:
+    """Count, error count, throughput and latency percentiles of one series."""
+    summary = {
+        "count": len(latencies_ms),
+        "errors": errors,
+        "mean_ms": round(sum(latencies_ms) / len(latencies_ms), 3) if latencies_ms else None,
+        "p50_ms": percentile(latencies_ms, 50),
+        "p95_ms": percentile(latencies_ms, 95),
+        "p99_ms": percentile(latencies_ms, 99),
+        "max_ms": round(max(latencies_ms), 3) if latencies_ms else None,
+    }
+    if duration_s:
+        summary["throughput_per_s"] = round(len(latencies_ms) / duration_s, 3)
+    return summary
+
+
+def compare(previous: dict, current: dict, sections: tuple[str, ...]) -> list[str]:
+    """Lines describing how p50/p95/p99 and throughput moved between two result files."""
+    lines = []
+    for section in sections:
+        for name, now in current.get(section, {}).items():
+            before = previous.get(section, {}).get(name)
+            if not before:
+                continue
+            changes = []
+            for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_per_s"):
+                if before.get(key) and now.get(key) is not None:
+                    changes.append(f"{key} {before[key]:g} -> {now[key]:g} ({(now[key] - before[key]) / before[key]:+.1%})")
+            if changes:
+                lines.append(f"{section}/{name}: " + ", ".join(changes))
+    return lines
@@ -0,0 +1,206 @@
+"""
+Synthetic vendor invoices for benchmarks: PDFs drawn with PyMuPDF from the vendors and
+items in backend/assets, with the ground truth they were generated from, and a parser
+that turns their text back into the JSON the extraction prompt asks for (used as the
+fake model's canned answer).
+"""
+import random
+import re
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Optional
+import fitz
+import pandas as pd
+from pydantic import BaseModel
+
+ASSETS_DIR = Path(__file__).resolve().parents[1] / "backend" / "assets"
+LINES_PER_PAGE = 30
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in points
+
+
+class SyntheticLine(BaseModel):
+    item_code: str
+    item_name: str
+    uom_entry: int
+    quantity: int
+    rate: float
+
+    @property
+    def amount(self) -> float:
+        return round(self.quantity * self.rate, 2)
+
+
+class SyntheticInvoice(BaseModel):
+    file_name: str
+    vendor_name: str
+    printed_vendor_name: str
+    card_code: str
+    bill_number: str
+    bill_date: str
+    mode_of_payment: str
+    lines: list[SyntheticLine]
+
+    @property
+    def net_amount(self) -> float:
+        return round(sum(line.amount for line in self.lines), 2)
+
+    @property
+    def vat_amount(self) -> float:
+        return round(self.net_amount * 0.13, 2)
+
+    @property
+    def grand_total(self) -> float:
+        return round(self.net_amount + self.vat_amount, 2)
+
+    def sap_payload(self) -> dict:
+        """The purchase invoice a perfect extraction and mapping would post."""
+        return {
+            "CardCode": self.card_code,
+            "NumAtCard": self.bill_number,
+            "DocDate": self.bill_date,
+            "DocumentLines": [
+                {"ItemCode": line.item_code, "UoMEntry": line.uom_entry, "TaxCode": "VAT13", "Quantity": line.quantity, "UnitPrice": line.rate}
+                for line in self.lines
+            ]
+        }
+
+
+def load_catalogs() -> tuple[pd.DataFrame, pd.DataFrame]:
+    vendors = pd.read_csv(ASSETS_DIR / "vendor_list.csv").dropna(subset=["CardCode", "CardName"])
+    vendors = vendors[~vendors["CardName"].str.contains("do not use", case=False)]
+    items = pd.read_csv(ASSETS_DIR / "item_list.csv").dropna(subset=["ItemCode", "ItemName"])
+    return vendors, items
+
+
+def add_noise(text: str, rng: random.Random, rate: float) -> str:
+    """Applies OCR-like damage: dropped, doubled, swapped or replaced characters and case changes."""
+    if rate <= 0:
+        return text
+    characters = list(text)
+    result = []
+    index = 0
+    while index < len(characters):
+        character = characters[index]
+        if character.isalnum() and rng.random() < rate:
+            kind = rng.choice(("drop", "double", "swap", "replace", "case"))
+            if kind == "drop":
+                index += 1
+                continue
+            if kind == "double":
+                result += [character, character]
+            elif kind == "swap" and index + 1 < len(characters):
+                result += [characters[index + 1], character]
+                index += 1
+            elif kind == "replace":
+                result.append(rng.choice("abcdefghijklmnopqrstuvwxyz0123456789"))
+            else:
+                result.append(character.swapcase())
+        else:
+            result.append(character)
+        index += 1
+    return "".join(result)
+
+
+def printable(text: str) -> str:
+    # The base-14 Helvetica font only covers Latin-1
+    return str(text).encode("latin-1", "replace").decode("latin-1")
+
+
+def generate_invoice(rng: random.Random, vendors: pd.DataFrame, items: pd.DataFrame, index: int,
+                     noise: float = 0.0, line_count: Optional[int] = None) -> SyntheticInvoice:
+    vendor = vendors.iloc[rng.randrange(len(vendors))]
+    lines = []
+    for _ in range(line_count or rng.randint(1, 8)):
+        item = items.iloc[rng.randrange(len(items))]
+        lines.append(SyntheticLine(
+            item_code=str(item["ItemCode"]),
+            item_name=printable(item["ItemName"]),
+            uom_entry=int(item["InventoryUoMEntry"]),
+            quantity=rng.randint(1, 50),
+            rate=round(rng.uniform(100, 5000), 2)
+        ))
+    return SyntheticInvoice(
+        file_name=f"synthetic_invoice_{index:05d}.pdf",
+        vendor_name=printable(vendor["CardName"]),
+        printed_vendor_name=add_noise(printable(vendor["CardName"]), rng, noise),
+        card_code=str(vendor["CardCode"]),
+        bill_number=f"BN-{rng.randint(100000, 999999)}-{index}",
+        bill_date=(date(2025, 1, 1) + timedelta(days=rng.randrange(365))).isoformat(),
+        mode_of_payment=rng.choice(("Cash", "Credit", "Cheque")),
+        lines=lines
+    )
+
+
+def render_pdf(invoice: SyntheticInvoice, pages: int = 1) -> bytes:
+    """Draws the invoice over `pages` pages (at least as many as the line items need)."""
+    header = [
+        "TAX INVOICE",
+        f"Supplier Name: {invoice.printed_vendor_name}",
+        "Supplier PAN: 600000001",
+        f"Bill No: {invoice.bill_number}",
+        f"Bill Date: {invoice.bill_date}",
+        f"Mode of Payment: {invoice.mode_of_payment}",
+        "Customer Name: Sample Customer Pvt. Ltd.",
+        "",
+        "SN | Particulars | Qty | Rate | Amount",
+    ]
+    rows = [f"{number}. {line.item_name} | {line.quantity} | {line.rate:.2f} | {line.amount:.2f}" for number, line in enumerate(invoice.lines, 1)]
+    footer = [
+        "",
+        f"Net Amount: {invoice.net_amount:.2f}",
+        f"VAT 13%: {invoice.vat_amount:.2f}",
+        f"Grand Total: {invoice.grand_total:.2f}",
+    ]
+
+    per_page = max(1, min(LINES_PER_PAGE, -(-len(rows) // max(1, pages))))
+    chunks = [rows[start:start + per_page] for start in range(0, len(rows), per_page)] or [[]]
+    chunks += [[] for _ in range(max(0, pages - len(chunks)))]
+
+    document = fitz.open()
+    for number, chunk in enumerate(chunks):
+        page = document.new_page(width=PAGE_WIDTH, height=PAGE_HEIGHT)
+        text = (header if number == 0 else [f"Bill No: {invoice.bill_number} (continued)"]) + chunk
+        if number == len(chunks) - 1:
+            text += footer
+        page.insert_text((40, 50), "\n".join(text), fontsize=9)
+    data = document.tobytes(garbage=3, deflate=True)
+    document.close()
+    return data
+
+
+LABEL_PATTERNS = {
+    "vendor_name": re.compile(r"^\s*Supplier Name: (.*)$", re.MULTILINE),
+    "vendor_pan": re.compile(r"^\s*Supplier PAN: (.*)$", re.MULTILINE),
+    "bill_number": re.compile(r"^\s*Bill No: (\S+)$", re.MULTILINE),
+    "bill_date": re.compile(r"^\s*Bill Date: (.*)$", re.MULTILINE),
+    "mode_of_payment": re.compile(r"^\s*Mode of Payment: (.*)$", re.MULTILINE),
+    "customer_name": re.compile(r"^\s*Customer Name: (.*)$", re.MULTILINE),
+    "net_amount": re.compile(r"^\s*Net Amount: (.*)$", re.MULTILINE),
+    "vat_amount": re.compile(r"^\s*VAT 13%: (.*)$", re.MULTILINE),
+    "grand_total": re.compile(r"^\s*Grand Total: (.*)$", re.MULTILINE),
+}
+LINE_PATTERN = re.compile(r"^\s*\d+\. (.+?) \| (\d+) \| ([\d.]+) \| ([\d.]+)$", re.MULTILINE)
+
+
+def extraction_from_text(prompt: str) -> dict:
+    """Reads a synthetic invoice's text (inside the extraction prompt) into the default extraction JSON."""
+    def field(name: str) -> str:
+        match = LABEL_PATTERNS[name].search(prompt)
+        return match.group(1).strip() if match else ""
+
+    return {
+        "vendor_details": {"name": field("vendor_name"), "address": "", "contact_number": "", "email": "", "website": "", "pan_number": field("vendor_pan")},
+        "customer_details": {"name": field("customer_name"), "address": "", "contact_number": "", "pan_number": ""},
+        "invoice_details": {
+            "bill_number": field("bill_number"), "bill_date": field("bill_date"), "nepali_miti": "",
+            "mode_of_payment": field("mode_of_payment"), "finance_manager": "", "authorized_signatory": "", "lc_no": ""
+        },
+        "payment_details": {
+            "net_amount": field("net_amount"), "discount_amount": "", "taxable_amount": field("net_amount"),
+            "vat_percentage": "13", "vat_amount": field("vat_amount"), "grand_total": field("grand_total"), "grand_total_in_words": ""
+        },
+        "line_items": [
+            {"hs_code": "", "products": products, "quantity": quantity, "rate": rate, "amount": amount}
+            for products, quantity, rate, amount in LINE_PATTERN.findall(prompt)
+        ]
+    }
@@ -0,0 +1,14 @@
+import os
+import sys
+from pathlib import Path
+
+# Offline stand-ins; must be set before anything under backend is imported
+os.environ.update({
+    "MONGODB_URI": "mongomock://",
+    "LLM_BACKEND": "fake",
+    "OCR_BACKEND": "fake",
+    "GOOGLE_API_KEY": "fake",
+    "MISTRAL_API_KEY": "fake",
+    "CPU_POOL_WORKERS": "0",
+})
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
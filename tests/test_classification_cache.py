@@ -0,0 +1,67 @@
+import asyncio
+import json
+import pandas as pd
+import pytest
+from backend.api.routers import classification_router
+from backend.database import collection
+from backend.services import classification
+from backend.services.document_session import DocumentSession
+from backend.services.llm_gateway import llm_gateway
+from backend.services.mapping import Mapper
+
+UID = 9001
+
+
+@pytest.fixture
+def document():
+    collection.delete_many({"uid": UID})
+    collection.insert_one({
+        "uid": UID,
+        "file_name": "invoice.pdf",
+        "extracted_details": {
+            "vendor_details": {"name": "Himalayan Traders"},
+            "invoice_details": {"bill_number": "BN-1", "bill_date": "2025-01-01"},
+            "payment_details": {"mode_of_payment": "Credit"},
+            "line_items": [{"products": "Green Tea 1kg", "quantity": "2", "rate": "500"}]
+        }
+    })
+    yield
+    collection.delete_many({"uid": UID})
+
+
+@pytest.fixture
+def mapper():
+    # Skips __init__, which refreshes the catalogs from SAP
+    mapper = Mapper.__new__(Mapper)
+    mapper.vendor_names_with_codes = pd.DataFrame({"CardCode": ["V0001"], "CardName": ["Himalayan Traders"]})
+    mapper.item_list_df = pd.DataFrame({"ItemCode": ["I0001"], "ItemName": ["Green Tea 1kg"], "InventoryUoMEntry": [1]})
+    mapper.item_names_list = ["green tea 1kg"]
+    mapper.create_unknown_items = lambda unknown_items: {}
+    return mapper
+
+
+def classify() -> dict:
+    response = asyncio.run(classification_router.classify_document(UID))
+    assert response.status_code == 200
+    return json.loads(response.body)
+
+
+def test_mapping_a_classified_document_keeps_its_cached_classification(document, mapper, monkeypatch):
+    llm_gateway.backend.register("classification", "ap_invoice")
+    monkeypatch.setattr(classification, "load_vendor_names", lambda: ["Himalayan Traders"])
+
+    first = classify()
+    assert first["cached"] is False
+    assert first["classification"] == "ap_invoice"
+
+    session = DocumentSession.load(UID)
+    mapper.find_similar_vendor(session)
+    mapper.map_items_to_codes(session)
+    session.flush()
+    mapped = collection.find_one({"uid": UID})["extracted_details"]
+    assert mapped["vendor_details"]["code"] == "V0001"
+    assert mapped["line_items"][0]["ItemCode"] == "I0001"
+
+    second = classify()
+    assert second["cached"] is True
+    assert second["classification"] == "ap_invoice"
@@ -0,0 +1,48 @@
+import mongomock
+import pytest
+from backend.services.document_session import DocumentPathError, DocumentSession
+
+
+@pytest.fixture
+def store():
+    return mongomock.MongoClient()["test"]["prompts"]
+
+
+def stored_session(store, document: dict) -> DocumentSession:
+    store.insert_one({"uid": 1, **document})
+    return DocumentSession.load(1, store=store)
+
+
+def test_set_list_index_past_the_end_pads_like_mongo(store):
+    session = stored_session(store, {"extracted_details": {"line_items": []}})
+    session.set("extracted_details.line_items.1.ItemCode", "I-1")
+    assert session.get("extracted_details.line_items") == [None, {"ItemCode": "I-1"}]
+    session.flush()
+    assert store.find_one({"uid": 1})["extracted_details"]["line_items"] == [None, {"ItemCode": "I-1"}]
+
+
+def test_set_inside_null_writes_the_new_subdocument(store):
+    session = stored_session(store, {"extracted_details": {"line_items": None}})
+    session.set("extracted_details.line_items.0.ItemCode", "I-1")
+    session.flush()
+    assert store.find_one({"uid": 1})["extracted_details"]["line_items"] == {"0": {"ItemCode": "I-1"}}
+
+
+def test_set_existing_list_element(store):
+    session = stored_session(store, {"extracted_details": {"line_items": [{"products": "Tea"}]}})
+    session.set("extracted_details.line_items.0.ItemCode", "I-1")
+    session.flush()
+    assert store.find_one({"uid": 1})["extracted_details"]["line_items"] == [{"products": "Tea", "ItemCode": "I-1"}]
+
+
+@pytest.mark.parametrize("document, path", [
+    ({"extracted_details": {"line_items": "none"}}, "extracted_details.line_items.0.ItemCode"),
+    ({"extracted_details": {"line_items": [5]}}, "extracted_details.line_items.0.ItemCode"),
+    ({"extracted_details": {"line_items": []}}, "extracted_details.line_items.first.ItemCode"),
+    ({"extracted_details": {"line_items": []}}, "extracted_details.line_items.first"),
+])
+def test_set_through_a_scalar_or_a_non_index_raises_a_path_error(store, document, path):
+    session = stored_session(store, document)
+    with pytest.raises(DocumentPathError):
+        session.set(path, "I-1")
+    assert not session.dirty